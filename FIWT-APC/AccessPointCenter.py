@@ -27,6 +27,8 @@ from multiprocessing import Process, Queue, freeze_support
 from AccessPointFrame import MyFrame
 from MessageCenter import worker
 from DynamicGraph import drawer
+from StateRing import StateRing
+from ExpData import GUI_INDEX
 
 class MyApp(wx.App):
     """
@@ -41,7 +43,8 @@ class MyApp(wx.App):
                  process=None,
                  gui2drawerQueue=None,
                  gui2msgcQueue=None,
-                 msgc2guiQueue=None):
+                 msgc2guiQueue=None,
+                 state_ring=None):
         """
         Initialise the App.
         """
@@ -49,6 +52,7 @@ class MyApp(wx.App):
         self.gui2msgcQueue = gui2msgcQueue
         self.msgc2guiQueue = msgc2guiQueue
         self.gui2drawerQueue=gui2drawerQueue
+        self.state_ring = state_ring
         wx.App.__init__(self, redirect, filename, useBestVisual, clearSigInt)
 
     def OnInit(self):
@@ -57,7 +61,7 @@ class MyApp(wx.App):
         """
         self.frame = MyFrame(None, -1, 'AccessPointCenter', self.process,
                              self.gui2msgcQueue, self.msgc2guiQueue,
-                             self.gui2drawerQueue)
+                             self.gui2drawerQueue, self.state_ring)
         self.frame.Show(True)
         return True
 
@@ -70,12 +74,15 @@ if __name__ == '__main__':
     gui2msgcQueue = Queue()
     msgc2guiQueue = Queue()
     gui2drawerQueue = Queue()
+    # ExpData states, written by the worker, read by the GUI and drawer
+    state_ring = StateRing(len(GUI_INDEX))
 
     # Create the worker process
-    msg_process = Process(target=worker, args=(gui2msgcQueue, msgc2guiQueue))
+    msg_process = Process(target=worker,
+            args=(gui2msgcQueue, msgc2guiQueue, state_ring))
     msg_process.start()
 
-    graph_process = Process(target=drawer, args=(gui2drawerQueue,))
+    graph_process = Process(target=drawer, args=(gui2drawerQueue, state_ring))
     graph_process.start()
 
     # Create the app
@@ -84,5 +91,6 @@ if __name__ == '__main__':
                 process=[msg_process, graph_process],
                 gui2drawerQueue=gui2drawerQueue,
                 gui2msgcQueue=gui2msgcQueue,
-                msgc2guiQueue=msgc2guiQueue)
+                msgc2guiQueue=msgc2guiQueue,
+                state_ring=state_ring)
     app.MainLoop()
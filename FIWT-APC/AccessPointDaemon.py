@@ -0,0 +1,230 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Headless Access Point Center in Python
+----------------------------------------
+
+Author: Zheng GONG(matthewzhenggong@gmail.com)
+
+This file is part of FIWT.
+
+FIWT is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 3.0 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library.
+
+Runs the Worker without wx: the node hosts come from [host] of
+config.ini, the ports from the optional [port] (ap, gnd, acm, cmp) and
+[matlab] (rx, tx) sections, else the GUI defaults. Recording starts
+right away unless told otherwise, and the statistics and log go to
+stdout.
+
+The control socket (UDP, [daemon] control, default 127.0.0.1:7140)
+takes one JSON object per datagram, the same dicts the GUI puts to the
+worker, e.g.
+
+    {"ID": "REC_START", "filename": "FIWT_Exp003_test.dat"}
+    {"ID": "AT", "target": "ACM", "options": "02", "command": "MY",
+     "parameter": ""}
+
+and answers {"ID": "OK"} or {"ID": "ERROR", "content": ...}. ATTACH
+makes the daemon forward every worker message (ExpData, Statistics,
+info, ...) to the sender as JSON as well, until DETACH.
+"""
+
+import argparse
+import json
+import Queue
+import signal
+import socket
+import sys
+import threading
+import time
+from ConfigParser import SafeConfigParser
+
+from MessageCenter import Worker
+from MessageFuncs import process_funcs
+
+DEFAULT_PORTS = {'ap':8192, 'gnd':9750, 'acm':8807, 'cmp':9847}
+DEFAULT_MATLAB_PORTS = {'rx':9090, 'tx':8080}
+DEFAULT_CONTROL = '127.0.0.1:7140'
+
+def parse_address(text):
+    host, port = text.rsplit(':', 1)
+    return host, int(port)
+
+def start_command(parser):
+    """
+    The START message for the hosts and ports of config.ini.
+    """
+    def port(section, name, default):
+        if parser.has_option(section, name):
+            return parser.getint(section, name)
+        return default
+    return {'ID':'START',
+            'xbee_hosts':[(parser.get('host', name),
+                port('port', name, DEFAULT_PORTS[name]))
+                for name in ('ap', 'gnd', 'acm', 'cmp')],
+            'matlab_ports':[port('matlab', name, DEFAULT_MATLAB_PORTS[name])
+                for name in ('rx', 'tx')]}
+
+def to_str(obj):
+    """
+    json gives unicode; the message functions expect byte strings.
+    """
+    if isinstance(obj, unicode):
+        return obj.encode('latin-1')
+    if isinstance(obj, list):
+        return [to_str(i) for i in obj]
+    if isinstance(obj, dict):
+        return dict((to_str(k), to_str(v)) for k, v in obj.iteritems())
+    return obj
+
+def format_statistics(output):
+    txt = 'C{:0>5d}/T{:<.2f} {:03.0f}Pps/{:05.0f}bps'.format(
+        output['arrv_cnt'], output['elapsed'],
+        output['arrv_cnt'] / output['elapsed'],
+        output['arrv_bcnt'] * 10 / output['elapsed'])
+    if 'rec_backlog' in output:
+        txt += ' REC{rec_backlog:d}B/D{rec_drop_cnt:d}'.format(**output)
+    if 'tx_depth' in output:
+        txt += ' TX{tx_depth:d}/S{tx_superseded_cnt:d}' \
+                '/D{tx_drop_cnt:d}/E{tx_error_cnt:d}'.format(**output)
+    if 'rx_kernel_drop_cnt' in output:
+        txt += ' KD{rx_kernel_drop_cnt:d}/G{rx_gap_cnt:d}' \
+                '/M{rx_missing_cnt:d}'.format(**output)
+    return txt
+
+class Daemon(object):
+    def __init__(self, control, latency=False, loss=False):
+        self.gui2msgcQueue = Queue.Queue()
+        self.msgc2guiQueue = Queue.Queue()
+        self.worker = Worker(self.gui2msgcQueue, self.msgc2guiQueue)
+        self.latency = latency
+        self.loss = loss
+        self.clients = set()
+        self.control = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.control.bind(control)
+        self.control.settimeout(0.2)
+        self.running = True
+        self.control_thread = threading.Thread(target=self.serve)
+        self.control_thread.daemon = True
+        self.main_thread = threading.Thread(target=self.worker.MainLoop)
+
+    def start(self, record=None):
+        self.gui2msgcQueue.put(start_command(self.worker.parser))
+        if record:
+            self.gui2msgcQueue.put({'ID':'REC_START', 'filename':record})
+        self.main_thread.start()
+        self.control_thread.start()
+
+    def stop(self):
+        self.gui2msgcQueue.put({'ID':'STOP'})
+
+    def serve(self):
+        while self.running:
+            try:
+                data, addr = self.control.recvfrom(65536)
+            except socket.timeout:
+                continue
+            except socket.error:
+                continue
+            self.reply(self.execute(data, addr), addr)
+
+    def execute(self, data, addr):
+        try:
+            cmd = to_str(json.loads(data))
+            name = cmd['ID']
+        except (ValueError, TypeError, KeyError):
+            return {'ID':'ERROR', 'content':'not a JSON command'}
+        if name == 'ATTACH':
+            self.clients.add(addr)
+        elif name == 'DETACH':
+            self.clients.discard(addr)
+        elif name in process_funcs:
+            if name == 'AT' and len(cmd.get('options', '')) == 2:
+                # hex, as typed in the GUI
+                cmd['options'] = cmd['options'].decode('hex')
+            self.gui2msgcQueue.put(cmd)
+        else:
+            return {'ID':'ERROR', 'content':'unknown command ' + name}
+        return {'ID':'OK'}
+
+    def reply(self, msg, addr):
+        try:
+            self.control.sendto(json.dumps(msg), addr)
+        except (socket.error, TypeError, ValueError):
+            self.clients.discard(addr)
+
+    def run(self):
+        """
+        Print and forward the worker messages until it ends.
+        """
+        while self.main_thread.is_alive() or not self.msgc2guiQueue.empty():
+            try:
+                output = self.msgc2guiQueue.get(block=True, timeout=0.2)
+            except Queue.Empty:
+                continue
+            if output['ID'] == 'info':
+                print output['content']
+            elif output['ID'] == 'Statistics':
+                print format_statistics(output)
+            elif output['ID'] == 'Latency' and self.latency:
+                print output['info']
+            elif output['ID'] == 'Loss' and self.loss:
+                print output['info']
+            sys.stdout.flush()
+            for addr in list(self.clients):
+                self.reply(output, addr)
+        self.running = False
+        self.control_thread.join()
+        self.control.close()
+
+if __name__ == '__main__' :
+    parser = argparse.ArgumentParser(
+        prog='AccessPointDaemon',
+        description='run the access point center without GUI')
+    parser.add_argument('-c', '--control',
+            help='control socket address, host:port (default from '
+            '[daemon] control or {})'.format(DEFAULT_CONTROL))
+    parser.add_argument('-o', '--output',
+            help='record to this file instead of the GUI style name')
+    parser.add_argument('-n', '--no-record', action='store_true',
+            help='do not start recording')
+    parser.add_argument('-l', '--latency', action='store_true',
+            help='print the latency summary with the statistics')
+    parser.add_argument('--loss', action='store_true',
+            help='print the packet loss summary with the statistics')
+    args = parser.parse_args()
+
+    config = SafeConfigParser()
+    config.read('config.ini')
+    control = args.control
+    if control is None:
+        control = config.get('daemon', 'control') \
+                if config.has_option('daemon', 'control') else DEFAULT_CONTROL
+
+    record = None
+    if not args.no_record:
+        record = args.output or time.strftime(
+                'FIWT_Exp{:03d}_%Y%m%d%H%M%S.dat'.format(
+                    int(config.get('rec', 'prefix')[:3])))
+
+    daemon = Daemon(parse_address(control), args.latency, args.loss)
+    def terminate(signum, frame):
+        daemon.stop()
+    signal.signal(signal.SIGTERM, terminate)
+    daemon.start(record)
+    while daemon.main_thread.is_alive():
+        try:
+            daemon.run()
+        except KeyboardInterrupt:
+            daemon.stop()
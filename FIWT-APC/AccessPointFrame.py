@@ -42,6 +42,8 @@ ACM_DatEvent, EVT_ACM_DAT = NewEvent()
 CMP_DatEvent, EVT_CMP_DAT = NewEvent()
 GND_DatEvent, EVT_GND_DAT = NewEvent()
 EXP_DatEvent, EVT_EXP_DAT = NewEvent()
+LatencyEvent, EVT_LATENCY = NewEvent()
+LossEvent, EVT_LOSS = NewEvent()
 
 ALPHA_ONLY = 1
 DIGIT_ONLY = 2
@@ -123,7 +125,7 @@ class MyFrame(wx.Frame):
     """
 
     def __init__(self, parent, id, title, process, gui2msgcQueue,
-            msgc2guiQueue, gui2drawerQueue):
+            msgc2guiQueue, gui2drawerQueue, state_ring=None):
         """
         Initialise the Frame.
         """
@@ -132,6 +134,9 @@ class MyFrame(wx.Frame):
         self.gui2msgcQueue = gui2msgcQueue
         self.msgc2guiQueue = msgc2guiQueue
         self.gui2drawerQueue = gui2drawerQueue
+        self.state_ring = state_ring
+        self.state_seq = -1
+        self.state_time = 0
 
         parser = SafeConfigParser()
         parser.read('config.ini')
@@ -524,12 +529,20 @@ Unused bits must be set to 0.  '''))
         self.btnResetRig.Enable(False)
         sizer.Add(self.btnResetRig, 0, wx.ALIGN_LEFT, 5)
 
+        self.btnMatlabLatency = wx.Button(panel, -1, "Matlab Latency")
+        self.btnMatlabLatency.Enable(False)
+        sizer.Add(self.btnMatlabLatency, 0, wx.ALIGN_LEFT, 5)
+
         sub_panel = wx.Panel(panel, -1)
         sub_panel.SetDoubleBuffered(True)
         sub_sizer = wx.BoxSizer(wx.VERTICAL)
 
         self.txtRXSta = wx.StaticText(sub_panel, wx.ID_ANY, "")
         sub_sizer.Add(self.txtRXSta, 0, wx.ALIGN_CENTRE | wx.ALL | wx.EXPAND, 1)
+        self.txtLatency = wx.StaticText(sub_panel, wx.ID_ANY, "")
+        sub_sizer.Add(self.txtLatency, 0, wx.ALIGN_CENTRE | wx.ALL | wx.EXPAND, 1)
+        self.txtLoss = wx.StaticText(sub_panel, wx.ID_ANY, "")
+        sub_sizer.Add(self.txtLoss, 0, wx.ALIGN_CENTRE | wx.ALL | wx.EXPAND, 1)
 
         self.txtGNDSta = wx.StaticText(sub_panel, wx.ID_ANY, "")
         sub_sizer.Add(self.txtGNDSta, 0, wx.ALIGN_CENTRE | wx.ALL | wx.EXPAND, 1)
@@ -599,8 +612,11 @@ Unused bits must be set to 0.  '''))
         self.Bind(EVT_CMP_DAT, self.OnCMPDat)
         self.Bind(EVT_GND_DAT, self.OnGNDDat)
         self.Bind(EVT_EXP_DAT, self.OnExpDat)
+        self.Bind(EVT_LATENCY, self.OnLatency)
+        self.Bind(EVT_LOSS, self.OnLoss)
         self.Bind(wx.EVT_BUTTON, self.OnTestMotor, self.btnTM)
         self.Bind(wx.EVT_BUTTON, self.OnRstRig, self.btnResetRig)
+        self.Bind(wx.EVT_BUTTON, self.OnMatlabLatency, self.btnMatlabLatency)
 
 
         # Set some program flags
@@ -640,21 +656,39 @@ Unused bits must be set to 0.  '''))
         Start the execution of tasks by the processes.
         """
         while self.keepgoing:
+            if self.state_ring:
+                self.pollStateRing()
             try:
-                output = self.msgc2guiQueue.get(block=True,timeout=0.2)
+                output = self.msgc2guiQueue.get(block=True,timeout=0.05)
                 if output['ID'] == 'ExpData':
                     wx.PostEvent(self, EXP_DatEvent(states=output['states']))
-                    self.gui2drawerQueue.put_nowait(output)
+                    # with a state ring the drawer reads it instead
+                    if not self.state_ring:
+                        self.gui2drawerQueue.put_nowait(output)
                 elif output['ID'] == 'info':
                     self.log.info(':'.join(['MSGC:',output['content']]))
                 elif output['ID'] == 'Statistics':
                     arrv_cnt = output['arrv_cnt']
                     arrv_bcnt = output['arrv_bcnt']
                     elapsed = output['elapsed']
-                    wx.PostEvent(self, RxStaEvent(txt=
-                    'C{:0>5d}/T{:<.2f} {:03.0f}Pps/{:05.0f}bps'.format(
+                    txt = 'C{:0>5d}/T{:<.2f} {:03.0f}Pps/{:05.0f}bps'.format(
                         arrv_cnt, elapsed, arrv_cnt / elapsed,
-                        arrv_bcnt * 10 / elapsed)))
+                        arrv_bcnt * 10 / elapsed)
+                    if 'rec_backlog' in output:
+                        txt += ' REC{rec_backlog:d}B/D{rec_drop_cnt:d}'.format(
+                            **output)
+                    if 'tx_depth' in output:
+                        txt += ' TX{tx_depth:d}/S{tx_superseded_cnt:d}' \
+                                '/D{tx_drop_cnt:d}/E{tx_error_cnt:d}'.format(
+                                    **output)
+                    if 'rx_kernel_drop_cnt' in output:
+                        txt += ' KD{rx_kernel_drop_cnt:d}/G{rx_gap_cnt:d}' \
+                                '/M{rx_missing_cnt:d}'.format(**output)
+                    wx.PostEvent(self, RxStaEvent(txt=txt))
+                elif output['ID'] == 'Latency':
+                    wx.PostEvent(self, LatencyEvent(txt=output['info']))
+                elif output['ID'] == 'Loss':
+                    wx.PostEvent(self, LossEvent(txt=output['info']))
                 elif output['ID'] == 'ACM_STA':
                     wx.PostEvent(self, ACM_StaEvent(txt=output['info']))
                 elif output['ID'] == 'ACM_DAT':
@@ -670,6 +704,20 @@ Unused bits must be set to 0.  '''))
             except Queue.Empty:
                 pass
 
+    def pollStateRing(self):
+        """
+        Show the newest ExpData states from the shared ring, at most every
+        50 ms; the drawer reads every sample from the ring itself.
+        """
+        now = time.time()
+        if now - self.state_time < 0.05:
+            return
+        latest = self.state_ring.latest()
+        if latest and latest[0] != self.state_seq:
+            self.state_seq = latest[0]
+            self.state_time = now
+            wx.PostEvent(self, EXP_DatEvent(states=latest[1].tolist()))
+
     def processTerm(self):
         """
         Stop the execution of tasks by the processes.
@@ -711,6 +759,7 @@ Unused bits must be set to 0.  '''))
         self.btnTX.Enable(True)
         self.btnTM.Enable(True)
         self.btnResetRig.Enable(True)
+        self.btnMatlabLatency.Enable(True)
 
     def OnRecALL(self, event) :
         if event.IsChecked():
@@ -755,6 +804,12 @@ Unused bits must be set to 0.  '''))
     def OnRXSta(self, event) :
         self.txtRXSta.SetLabel(event.txt)
 
+    def OnLatency(self, event) :
+        self.txtLatency.SetLabel(event.txt)
+
+    def OnLoss(self, event) :
+        self.txtLoss.SetLabel(event.txt)
+
     def OnACMSta(self, event) :
         self.txtACMSta.SetLabel(event.txt)
 
@@ -798,6 +853,8 @@ Unused bits must be set to 0.  '''))
     def OnClr(self, event):
         self.log_txt.Clear()
         self.txtRXSta.SetLabel('')
+        self.txtLatency.SetLabel('')
+        self.txtLoss.SetLabel('')
         self.txtACMSta.SetLabel('')
         self.txtCMPSta.SetLabel('')
         self.txtGNDSta.SetLabel('')
@@ -814,6 +871,9 @@ Unused bits must be set to 0.  '''))
     def OnRstRig(self, event):
         self.gui2msgcQueue.put({'ID': 'RESET_RIG'})
 
+    def OnMatlabLatency(self, event):
+        self.gui2msgcQueue.put({'ID': 'MATLAB_LATENCY', 'reset':True})
+
     def OnTestMotor(self, event):
         InputType = self.InputType.GetSelection()+1
         if self.target == 'CMP' :
@@ -0,0 +1,300 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Chunked columnar recording format in Python
+----------------------------------------
+
+Author: Zheng GONG(matthewzhenggong@gmail.com)
+
+This file is part of FIWT.
+
+FIWT is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 3.0 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library.
+
+File layout, all little-endian:
+
+    MAGIC
+    chunk*      CHUNK_HDR(b'CHNK', code, count) + one column per field,
+                each count values long, in CHUNK_COLUMNS[code] order
+    index       INDEX_ENTRY(code, count, offset, t_min, t_max) per chunk
+    TRAILER     (index offset, number of chunks, MAGIC)
+
+Each chunk also has a recv_us column: recv_ts unwrapped to 64-bit µs
+over the whole recording, as Timebase.unwrap does, so it does not wrap
+every 35.8 minutes. t_min/t_max are the recv_us range of a chunk, and
+ChunkReader.read windows on recv_us. A file without trailer (recording
+not stopped cleanly) is read by walking the chunk headers.
+"""
+
+import argparse
+import mmap
+import os
+import struct
+import threading
+import numpy as np
+
+import recparse
+from Timebase import ts_delta, unwrap
+
+MAGIC = 'FIWTCRF2'
+CHUNK_HDR = struct.Struct('<4sB3xI')
+INDEX_ENTRY = struct.Struct('<B3xIQqq')
+TRAILER = struct.Struct('<QI8s')
+
+CHUNK_CODES = {
+    recparse.CODE_AC_MODEL_SERVO_POS: recparse.dtypeCODE_AC_MODEL_SERVO_POS,
+    recparse.CODE_AEROCOMP_SERVO_POS: recparse.dtypeCODE_AEROCOMP_SERVO_POS,
+    recparse.CODE_GNDBOARD_ADCM_READ: recparse.dtypeCODE_GNDBOARD_ADCM_READ,
+    recparse.CODE_GNDBOARD_MANI_READ: recparse.dtypeCODE_GNDBOARD_MANI_READ,
+    recparse.CODE_AEROCOMP_SERV_CMD: recparse.dtypeCODE_AEROCOMP_SERV_CMD,
+    }
+HDR_COLUMNS = [('gen_ts', '<u4'), ('sent_ts', '<u4'), ('recv_ts', '<u4'),
+        ('port', '<u2')]
+# recv_ts unwrapped, int64 µs
+TIME_COLUMN = ('recv_us', '<i8')
+
+def chunk_columns(dtype):
+    return [(name, dtype.fields[name][0].newbyteorder('<').str)
+            for name in dtype.names[1:]] + HDR_COLUMNS + [TIME_COLUMN]
+
+CHUNK_COLUMNS = dict((code, chunk_columns(dtype))
+        for code, dtype in CHUNK_CODES.iteritems())
+
+def encode_chunk(code, count, columns):
+    """
+    columns maps every name of CHUNK_COLUMNS[code] to an array of at
+    least count values.
+    """
+    data = [CHUNK_HDR.pack('CHNK', code, count)]
+    for name, dtype in CHUNK_COLUMNS[code]:
+        data.append(np.asarray(columns[name][:count], dtype=dtype).tostring())
+    return ''.join(data)
+
+def chunk_size(code, count):
+    return CHUNK_HDR.size + sum(np.dtype(dtype).itemsize*count
+            for name, dtype in CHUNK_COLUMNS[code])
+
+class ChunkWriter(object):
+    """
+    Collects saved packets per message code and emits a chunk once
+    chunk_records of one code are buffered. Chunks are written through
+    out, which is a file or a Recorder; write() of a Recorder may drop
+    a chunk, which is then left out of the index.
+    """
+    def __init__(self, out, chunk_records=4096):
+        self.out = out
+        self.chunk_records = chunk_records
+        self.offset = 0
+        self.index = []
+        self.lock = threading.Lock()
+        self.last_recv = None
+        self.recv_us = 0
+        self.buffers = {}
+        for code, dtype in CHUNK_CODES.iteritems():
+            self.buffers[code] = [0, bytearray(dtype.itemsize*chunk_records),
+                    np.zeros((chunk_records, 4), dtype=np.uint32),
+                    np.zeros(chunk_records, dtype=np.int64)]
+        self.emit(MAGIC)
+
+    def emit(self, data):
+        if self.out.write(data) is False:
+            return False
+        self.offset += len(data)
+        return True
+
+    def unwrap(self, recv_ts):
+        """
+        recv_ts in 64-bit µs, carried on from the one saved before, the
+        same as Timebase.unwrap of all the recv_ts of the .rec.
+        """
+        if self.last_recv is None:
+            self.recv_us = recv_ts
+        else:
+            self.recv_us += ts_delta(recv_ts, self.last_recv)
+        self.last_recv = recv_ts
+        return self.recv_us
+
+    def save(self, rf_data, gen_ts, sent_ts, recv_ts, addr):
+        code = ord(rf_data[0])
+        buf = self.buffers.get(code)
+        with self.lock:
+            recv_us = self.unwrap(recv_ts)
+            if buf is None:
+                return
+            raw = buf[1]
+            size = len(raw)//self.chunk_records
+            if len(rf_data) != size:
+                return
+            n = buf[0]
+            raw[n*size:(n+1)*size] = rf_data
+            buf[2][n] = (gen_ts, sent_ts, recv_ts, addr[1])
+            buf[3][n] = recv_us
+            buf[0] = n+1
+            if n+1 == self.chunk_records:
+                self.flushChunk(code)
+
+    def flushChunk(self, code):
+        n, raw, hdr, recv_us = self.buffers[code]
+        if not n:
+            return
+        self.buffers[code][0] = 0
+        payload = np.frombuffer(raw, dtype=CHUNK_CODES[code])[:n]
+        columns = dict((name, payload[name]) for name in payload.dtype.names)
+        for i, (name, dtype) in enumerate(HDR_COLUMNS):
+            columns[name] = hdr[:n, i]
+        columns[TIME_COLUMN[0]] = recv_us[:n]
+        self.writeChunk(code, n, columns)
+
+    def writeChunk(self, code, count, columns):
+        offset = self.offset
+        if self.emit(encode_chunk(code, count, columns)):
+            recv_us = columns['recv_us'][:count]
+            self.index.append((code, count, offset,
+                int(recv_us.min()), int(recv_us.max())))
+
+    def close(self):
+        """
+        Flush partial chunks and append the index and trailer.
+        """
+        with self.lock:
+            for code in sorted(self.buffers):
+                self.flushChunk(code)
+        index_offset = self.offset
+        self.emit(''.join(INDEX_ENTRY.pack(*i) for i in self.index)
+                + TRAILER.pack(index_offset, len(self.index), MAGIC))
+
+class ChunkReader(object):
+    """
+    Random access to a chunked file: only the chunks of the wanted code
+    and time window, and only the wanted columns, are read.
+    """
+    def __init__(self, filename):
+        self.f = open(filename, 'rb')
+        if os.path.getsize(filename):
+            self.buf = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.buf = ''
+        if self.buf[:len(MAGIC)] != MAGIC:
+            raise ValueError('{} is not a chunked record file'.format(filename))
+        self.index = self.readIndex()
+
+    def close(self):
+        if self.buf:
+            self.buf.close()
+        self.f.close()
+
+    def readIndex(self):
+        buf = self.buf
+        if len(buf) >= len(MAGIC) + TRAILER.size:
+            index_offset, cnt, magic = TRAILER.unpack_from(buf,
+                    len(buf)-TRAILER.size)
+            if magic == MAGIC:
+                return [INDEX_ENTRY.unpack_from(buf,
+                    index_offset+i*INDEX_ENTRY.size) for i in xrange(cnt)]
+        # no trailer: walk the chunk headers
+        index = []
+        pos = len(MAGIC)
+        while pos + CHUNK_HDR.size <= len(buf):
+            tag, code, count = CHUNK_HDR.unpack_from(buf, pos)
+            if tag != 'CHNK' or code not in CHUNK_COLUMNS:
+                break
+            size = chunk_size(code, count)
+            if pos + size > len(buf):
+                break
+            recv_us = self.column(pos, code, count, 'recv_us')
+            index.append((code, count, pos, int(recv_us.min()),
+                int(recv_us.max())))
+            pos += size
+        return index
+
+    def column(self, offset, code, count, name):
+        pos = offset + CHUNK_HDR.size
+        for col, dtype in CHUNK_COLUMNS[code]:
+            dtype = np.dtype(dtype)
+            if col == name:
+                return np.frombuffer(self.buf, dtype=dtype, count=count,
+                        offset=pos)
+            pos += dtype.itemsize*count
+        raise KeyError(name)
+
+    def read(self, code, columns=None, t_min=None, t_max=None):
+        """
+        Returns a dict of column arrays for one message code, optionally
+        only the given columns and only rows with t_min <= recv_us <= t_max.
+        """
+        if columns is None:
+            columns = [name for name, dtype in CHUNK_COLUMNS[code]]
+        parts = dict((name, []) for name in columns)
+        for c, count, offset, lo, hi in self.index:
+            if c != code or (t_min is not None and hi < t_min) \
+                    or (t_max is not None and lo > t_max):
+                continue
+            sel = slice(None)
+            if (t_min is not None and lo < t_min) \
+                    or (t_max is not None and hi > t_max):
+                recv_us = self.column(offset, code, count, 'recv_us')
+                sel = np.ones(count, dtype=bool)
+                if t_min is not None:
+                    sel &= recv_us >= t_min
+                if t_max is not None:
+                    sel &= recv_us <= t_max
+            for name in columns:
+                parts[name].append(self.column(offset, code, count, name)[sel])
+        result = {}
+        for name, dtype in CHUNK_COLUMNS[code]:
+            if name in parts:
+                result[name] = np.concatenate(parts[name]) if parts[name] \
+                        else np.empty(0, dtype=dtype)
+        return result
+
+def convert(rec_filename, crf_filename, chunk_records=4096):
+    """
+    Convert a raw .rec file into the chunked format.
+    """
+    with open(rec_filename, 'rb') as f:
+        if os.path.getsize(rec_filename):
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            buf = ''
+        try:
+            hdr, records = recparse.decode_buffer(buf)
+            recv_us = unwrap(hdr['recv_ts'])
+            with open(crf_filename, 'wb') as out:
+                writer = ChunkWriter(out, chunk_records)
+                for code in sorted(records):
+                    sel, payload = records[code]
+                    columns = dict((name, payload[name])
+                            for name in payload.dtype.names)
+                    for name, dtype in HDR_COLUMNS:
+                        columns[name] = hdr[name][sel]
+                    columns[TIME_COLUMN[0]] = recv_us[sel]
+                    for i in xrange(0, len(sel), chunk_records):
+                        count = min(chunk_records, len(sel)-i)
+                        writer.writeChunk(code, count, dict((name, v[i:i+count])
+                            for name, v in columns.iteritems()))
+                writer.close()
+        finally:
+            if buf:
+                buf.close()
+
+if __name__=='__main__' :
+    parser = argparse.ArgumentParser(
+        prog='ChunkFile',
+        description='convert rec data file to chunked columnar format')
+    parser.add_argument('filenames', metavar='file',
+            nargs='+', help='data filename')
+    parser.add_argument('-n', '--chunk-records', type=int, default=4096,
+            help='records per chunk')
+    args = parser.parse_args()
+    for filename in args.filenames :
+        convert(filename, filename+'.crf', args.chunk_records)
@@ -0,0 +1,225 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Node clock synchronization in Python
+----------------------------------------
+
+Author: Zheng GONG(matthewzhenggong@gmail.com)
+
+This file is part of FIWT.
+
+FIWT is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 3.0 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library.
+
+The AP sends CODE_NTP_REQUEST with its send time T1 as sent_ts; the
+node answers CODE_NTP_RESPONSE with T1 and its receive time T2, sent at
+T3 (its sent_ts) and received at T4 (recv_ts). Then
+
+    offset = ((T2-T1) + (T3-T4))/2      node clock minus AP clock
+    delay  = (T4-T1) - (T3-T2)
+
+All four are 31-bit µs timestamps that wrap every 35 minutes, so every
+difference is taken with ts_delta. The live estimates give the latency
+tracker its transit offsets; ExpData and the recordings keep the raw node
+ts_ADC. The response records are saved with the packets, and
+read_exchanges/fit_offsets/to_local map node stamps to the AP timebase
+offline, the one place that mapping is done, whether the file was
+recorded live or through Replay: recparse adds the mapped times as the
+*_AP_TS columns of a file that has exchanges.
+"""
+
+import collections
+import random
+import struct
+import time
+import numpy as np
+
+import recparse
+from Timebase import ts_delta, unwrap
+
+CODE_NTP_REQUEST = 0x01
+CODE_NTP_RESPONSE = 0x02
+packCODE_NTP_REQUEST = struct.Struct('>BH')
+packCODE_NTP_RESPONSE = struct.Struct('>BH2I')
+
+def exchange(t1, t2, t3, t4):
+    """
+    (offset, delay) in µs of one exchange; works on numpy arrays too.
+    """
+    return (ts_delta(t2, t1) + ts_delta(t3, t4))/2.0, \
+            ts_delta(t4, t1) - ts_delta(t3, t2)
+
+class NodeClock(object):
+    """
+    Offset and drift of one node clock against the AP clock. Of the last
+    window exchanges the one with the least delay gives the offset (it
+    had the least queueing to make it asymmetric); a least squares line
+    through those filtered offsets over the last span µs gives the
+    drift. now() is the unwrapped AP time in µs.
+    """
+    def __init__(self, now, window=8, span=120e6):
+        self.now = now
+        self.span = span
+        self.samples = collections.deque(maxlen=window)
+        self.points = collections.deque(maxlen=256)
+        self.reset()
+
+    def reset(self):
+        self.samples.clear()
+        self.points.clear()
+        self.offset = 0.0
+        self.drift = 0.0
+        self.t_ref = 0
+        self.delay = None
+        self.count = 0
+
+    def add(self, t1, t2, t3, t4):
+        offset, delay = exchange(t1, t2, t3, t4)
+        if delay < 0:
+            return False
+        t = self.now()
+        self.count += 1
+        self.samples.append((t, offset, delay))
+        best = min(self.samples, key=lambda s: s[2])
+        if not self.points or self.points[-1][0] != best[0]:
+            self.points.append(best[:2])
+        while self.points[-1][0] - self.points[0][0] > self.span:
+            self.points.popleft()
+        self.t_ref, self.offset, self.delay = best
+        if len(self.points) >= 3 and \
+                self.points[-1][0] - self.points[0][0] > 10e6:
+            t, o = np.array(self.points, dtype=np.float64).T
+            self.drift, intercept = np.polyfit(t - self.t_ref, o, 1)
+            self.offset = intercept
+        return True
+
+    def offsetAt(self, t):
+        return self.offset + self.drift*(t - self.t_ref)
+
+    def format(self, name):
+        return '{} offset {:.0f}us drift {:.2f}ppm delay {}us ({} samples)' \
+                .format(name, self.offset, self.drift*1e6, self.delay,
+                        self.count)
+
+class ClockSync(object):
+    """
+    Polls every node each interval seconds from tick() and keeps a
+    NodeClock per node address; with interval <= 0 it polls only when
+    asked to (cmd_ntp).
+    """
+    def __init__(self, network, interval=0):
+        self.network = network
+        self.parent = network.parent
+        self.interval = interval
+        self.names = dict((addr, name)
+                for name, addr in self.parent.node_addr.iteritems())
+        self.clocks = dict((addr, NodeClock(self.now))
+                for addr in self.names)
+        self.tokens = {}
+        self.last_poll = 0
+
+    def now(self):
+        return self.parent.timebase.now()
+
+    def reset(self):
+        """
+        Forget the estimates, for when T0 changes.
+        """
+        for clock in self.clocks.itervalues():
+            clock.reset()
+        self.tokens.clear()
+        self.network.latency.offsets.clear()
+
+    def clock(self, name):
+        return self.clocks[self.parent.node_addr[name]]
+
+    def tick(self):
+        if self.interval > 0 and time.time() - self.last_poll >= self.interval:
+            self.last_poll = time.time()
+            for addr in self.clocks:
+                self.poll(addr)
+
+    def poll(self, addr):
+        token = random.randint(0, 0xffff)
+        self.tokens[addr] = token
+        self.network.send(packCODE_NTP_REQUEST.pack(CODE_NTP_REQUEST, token),
+                addr)
+
+    def addResponse(self, addr, token, t1, t2, t3, t4):
+        if self.tokens.get(addr) != token:
+            return
+        del self.tokens[addr]
+        clock = self.clocks[addr]
+        if clock.add(t1, t2, t3, t4):
+            self.network.latency.offsets[addr] = -int(
+                    clock.offsetAt(self.now()))
+
+    def report(self):
+        return '\n'.join(clock.format(self.names[addr])
+                for addr, clock in sorted(self.clocks.iteritems()))
+
+def read_exchanges(filename):
+    """
+    The clock sync exchanges saved in a .rec file, as a dict of port to
+    (t4 record number, t1, t2, t3, t4) int64 arrays. t4 is unwrapped to
+    64-bit µs as Timebase.unwrap does all the recv_ts of the file, from
+    the first record on.
+    """
+    with recparse.map_file(filename) as buf:
+        offsets, lengths = recparse.index_records(buf)
+        data = np.frombuffer(buf, dtype=np.uint8)
+        sel = np.flatnonzero((lengths == packCODE_NTP_RESPONSE.size)
+                & (data[offsets] == CODE_NTP_RESPONSE))
+        result = {}
+        if not len(sel):
+            return result
+        hdr = recparse.gather_records(data,
+                offsets[sel]-recparse.packHdr.size, recparse.dtypeHdr)
+        rsp = recparse.gather_records(data, offsets[sel], np.dtype([
+            ('Id', 'u1'), ('token', '>u2'), ('t1', '>u4'), ('t2', '>u4')]))
+        recv0 = recparse.packHdr.unpack_from(buf,
+                offsets[0]-recparse.packHdr.size)[3]
+        t4 = unwrap(hdr['recv_ts'], recv0)
+        for port in np.unique(hdr['port']):
+            s = hdr['port'] == port
+            result[int(port)] = (sel[s], rsp['t1'][s].astype(np.int64),
+                    rsp['t2'][s].astype(np.int64),
+                    hdr['sent_ts'][s].astype(np.int64),
+                    t4[s])
+        return result
+
+def fit_offsets(t1, t2, t3, t4, window=8):
+    """
+    Offline counterpart of NodeClock: t4, unwrapped (as read_exchanges
+    gives it already), and the offset of the least delay exchange among
+    the last window up to each one.
+    """
+    offset, delay = exchange(np.asarray(t1), np.asarray(t2), np.asarray(t3),
+            np.asarray(t4))
+    n = len(offset)
+    best = np.empty(n)
+    for i in xrange(n):
+        lo = max(0, i-window+1)
+        best[i] = offset[lo + np.argmin(delay[lo:i+1])]
+    return unwrap(t4), best
+
+def to_local(ts, recv, t_fit, offset_fit):
+    """
+    Node timestamps ts of packets received at recv, unwrapped as the t4
+    of read_exchanges, in that same AP timebase.
+    """
+    recv = np.asarray(recv, dtype=np.int64)
+    offset = np.interp(recv, t_fit, offset_fit)
+    local = (np.asarray(ts, dtype=np.int64) - offset.astype(np.int64)) \
+            & 0x7fffffff
+    return recv + ts_delta(local, recv & 0x7fffffff)
@@ -31,11 +31,12 @@ import wx
 from dynamic_chart import HistChart
 
 class MyFrame(wx.Frame):
-    def __init__(self, parent, id, title, gui2drawerQueue):
+    def __init__(self, parent, id, title, gui2drawerQueue, state_ring=None):
         """
         Initialise the Frame.
         """
         self.gui2drawerQueue = gui2drawerQueue
+        self.state_ring = state_ring
 
         wx.Frame.__init__(self, parent, id, title, wx.Point(650, 0),
                           wx.Size(650, 800))
@@ -59,20 +60,39 @@ class MyFrame(wx.Frame):
         Start the execution of tasks by the processes.
         """
         while self.keepgoing:
+            if self.state_ring:
+                self.drawStateRing()
             try:
-                output = self.gui2drawerQueue.get(block=True,timeout=0.2)
+                output = self.gui2drawerQueue.get(block=True,timeout=0.05)
                 if output['ID'] == 'ExpData':
                     states = output['states']
-                    ht = self.hpanel
-                    ht.data_t.append(states[0])
-                    ht.data_y.append(states[19])
-                    ht.data_y2.append(states[20])
-                    ht.draw_plot()
+                    wx.CallAfter(self.plot, [states[0]], [states[19]],
+                            [states[20]])
                 elif output['ID'] == 'STOP':
                     self.Destroy()
             except Queue.Empty:
                 pass
 
+    def drawStateRing(self):
+        """
+        Plot every sample written to the state ring since the last call.
+        """
+        states = self.state_ring.read()
+        if not len(states):
+            return
+        wx.CallAfter(self.plot, states[:, 0].tolist(),
+                states[:, 19].tolist(), states[:, 20].tolist())
+
+    def plot(self, t, y, y2):
+        """
+        Add samples to the chart and redraw it, on the GUI thread.
+        """
+        ht = self.hpanel
+        ht.data_t.extend(t)
+        ht.data_y.extend(y)
+        ht.data_y2.extend(y2)
+        ht.draw_plot()
+
 class MyApp(wx.App):
     """
     A simple App class, modified to hold the processes and task queues.
@@ -83,29 +103,32 @@ class MyApp(wx.App):
                  filename=None,
                  useBestVisual=False,
                  clearSigInt=True,
-                 gui2drawerQueue=None):
+                 gui2drawerQueue=None,
+                 state_ring=None):
         """
         Initialise the App.
         """
         self.gui2drawerQueue=gui2drawerQueue
+        self.state_ring = state_ring
         wx.App.__init__(self, redirect, filename, useBestVisual, clearSigInt)
 
     def OnInit(self):
         """
         Initialise the App with a Frame.
         """
-        self.frame = MyFrame(None, -1, 'Drawer', self.gui2drawerQueue)
+        self.frame = MyFrame(None, -1, 'Drawer', self.gui2drawerQueue,
+                self.state_ring)
         self.frame.Show(True)
         return True
 
-def drawer(gui2drawerQueue):
-    return
+def drawer(gui2drawerQueue, state_ring=None):
     """
-    Worker process to draw data
+    Worker process to draw data, from the state ring if there is one
     """
     # Create the app
     app = MyApp(redirect=True,
                 filename='DynamicGraph.stderr.log',
-                gui2drawerQueue=gui2drawerQueue)
+                gui2drawerQueue=gui2drawerQueue,
+                state_ring=state_ring)
     app.MainLoop()
 
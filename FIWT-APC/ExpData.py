@@ -22,8 +22,12 @@ You should have received a copy of the GNU Lesser General Public
 License along with this library.
 """
 
-import math, struct
-from Butter import Butter
+import math, struct, threading
+from array import array
+from operator import itemgetter
+import numpy as np
+from Butter import FilterBank
+from Timebase import ts_delta, unwrap
 
 def Get14bit(val) :
     if val & 0x2000 :
@@ -40,40 +44,156 @@ def getPeriodDiff(EncPos, EncPos0, peroid=4096):
         diff += peroid
     return diff
 
+def Get14bitArray(val) :
+    val = np.asarray(val, dtype=np.int32) & 0x3FFF
+    return (val ^ 0x2000) - 0x2000
+
+def getPeriodDiffArray(EncPos, EncPos0, peroid=4096):
+    diff = np.asarray(EncPos, dtype=np.int32) - EncPos0
+    half_peroid = (peroid>>1)
+    diff[diff > half_peroid] -= peroid
+    diff[diff < -half_peroid] += peroid
+    return diff
+
+def getStepMask(ts, ts0):
+    """
+    Which of the 31-bit µs stamps ts are ahead of every stamp before
+    them and of ts0, the last one taken (None for none): the samples
+    updateRigPos/updateACM take, the others they skip.
+    """
+    ts = np.asarray(ts, dtype=np.int64)
+    if not len(ts):
+        return np.ones(0, dtype=bool)
+    ref = int(ts[0])-1 if ts0 is None else ts0
+    u = unwrap(ts, ref)
+    return u > np.maximum.accumulate(np.concatenate(([ref], u[:-1])))
+
+def getRateArray(filtered, filtered0, ts, ts0):
+    """
+    Rates of filtered over the 31-bit µs stamps ts, which step forward as
+    getStepMask keeps them, from filtered0 at ts0; 0 for the first sample
+    if ts0 is None.
+    """
+    ts = np.asarray(ts, dtype=np.int64)
+    dt = np.empty(len(ts))
+    dt[1:] = ts_delta(ts[1:], ts[:-1])*1e-6
+    dt[0] = np.inf if ts0 is None else ts_delta(int(ts[0]), ts0)*1e-6
+    return np.diff(np.concatenate(([filtered0], filtered)))/dt
+
+# Live state layout: one float per name, the ACM, CMP and GND blocks each
+# in the column order of getACMdata/getCMPdata/getGNDdata.
+ACM_STATE = ["ACM_ADC_TS", "ACM_CmdTime", "ACM_svoref1",
+        "ACM_servo1", "ACM_svoref2", "ACM_servo2",
+        "ACM_svoref3", "ACM_servo3", "ACM_svoref4",
+        "ACM_servo4", "ACM_svoref5", "ACM_servo5",
+        "ACM_svoref6", "ACM_servo6", "ACM_roll",
+        "ACM_roll_filtered", "ACM_roll_rate",
+        "ACM_pitch", "ACM_pitch_filtered", "ACM_pitch_rate",
+        "ACM_yaw", "ACM_yaw_filtered", "ACM_yaw_rate",
+        "GX", "GY", "GZ", "AX", "AY", "AZ",
+        "ACM_mot1", "ACM_mot2", "ACM_mot3", "ACM_mot4",
+        "ACM_mot5", "ACM_mot6"]
+CMP_STATE = ["CMP_ADC_TS", "CMP_CmdTime", "CMP_svoref1",
+        "CMP_servo1", "CMP_svoref2", "CMP_servo2",
+        "CMP_svoref3", "CMP_servo3", "CMP_svoref4",
+        "CMP_servo4", "CMP_mot1", "CMP_mot2",
+        "CMP_mot3", "CMP_mot4"]
+GND_STATE = ["GND_ADC_TS", "RigRollRawPos", "RigRollPos",
+        "RigRollPosFiltered", "RigRollPosRate",
+        "RigPitchRawPos", "RigPitchPos",
+        "RigPitchPosFiltered", "RigPitchPosRate",
+        "RigYawRawPos", "RigYawPos",
+        "RigYawPosFiltered", "RigYawPosRate",
+        "Vel", "DP"]
+TAIL_COLUMNS = ["gen_ts", "sent_ts", "recv_ts", "port"]
+
+STATE_NAMES = ACM_STATE + CMP_STATE + GND_STATE
+STATE_INDEX = dict((name, i) for i, name in enumerate(STATE_NAMES))
+ACM_BLOCK = slice(0, len(ACM_STATE))
+CMP_BLOCK = slice(ACM_BLOCK.stop, ACM_BLOCK.stop+len(CMP_STATE))
+GND_BLOCK = slice(CMP_BLOCK.stop, len(STATE_NAMES))
+# the part of GND_BLOCK updateRigPos writes, all but Vel and DP
+RIG_BLOCK = slice(GND_BLOCK.start, STATE_INDEX['Vel'])
+
+S_ACM_ADC_TS = STATE_INDEX['ACM_ADC_TS']
+S_ACM_roll_filtered = STATE_INDEX['ACM_roll_filtered']
+S_ACM_pitch_filtered = STATE_INDEX['ACM_pitch_filtered']
+S_ACM_yaw_filtered = STATE_INDEX['ACM_yaw_filtered']
+S_GND_ADC_TS = STATE_INDEX['GND_ADC_TS']
+S_RigRollRawPos = STATE_INDEX['RigRollRawPos']
+S_RigPitchRawPos = STATE_INDEX['RigPitchRawPos']
+S_RigYawRawPos = STATE_INDEX['RigYawRawPos']
+S_RigRollPosFiltered = STATE_INDEX['RigRollPosFiltered']
+S_RigPitchPosFiltered = STATE_INDEX['RigPitchPosFiltered']
+S_RigYawPosFiltered = STATE_INDEX['RigYawPosFiltered']
+S_Vel = STATE_INDEX['Vel']
+S_DP = STATE_INDEX['DP']
+
+# Snapshots taken straight from the state vector: the 'ExpData' GUI
+# message and the reply to Matlab.
+GUI_INDEX = [STATE_INDEX[name] for name in ("GND_ADC_TS",
+        "GX", "GY", "GZ", "AX", "AY",
+        "AZ", "ACM_roll_filtered", "ACM_roll_rate",
+        "ACM_pitch_filtered", "ACM_pitch_rate",
+        "ACM_yaw_filtered", "ACM_yaw_rate",
+        "RigRollPosFiltered", "RigRollPosRate",
+        "RigPitchPosFiltered", "RigPitchPosRate",
+        "RigYawPosFiltered", "RigYawPosRate",
+        "ACM_svoref1", "ACM_servo1", #19 20
+        "ACM_svoref2", "ACM_servo2",
+        "ACM_svoref3", "ACM_servo3",
+        "ACM_svoref4", "ACM_servo4",
+        "ACM_svoref5", "ACM_servo5",
+        "ACM_svoref6", "ACM_servo6",
+        "CMP_servo1", "CMP_svoref1", #31 32
+        "CMP_servo2", "CMP_svoref2",
+        "CMP_servo3", "CMP_svoref3",
+        "CMP_servo4", "CMP_svoref4",
+        "Vel", "DP")]
+GUI_STATE = itemgetter(*GUI_INDEX)
+MATLAB_STATE = itemgetter(*[STATE_INDEX[name] for name in ("ACM_CmdTime",
+        "GX", "GY", "GZ", "AX", "AY",
+        "AZ", "ACM_roll_filtered", "ACM_roll_rate",
+        "ACM_pitch_filtered", "ACM_pitch_rate",
+        "ACM_yaw_filtered", "ACM_yaw_rate",
+        "RigRollPosFiltered", "RigRollPosRate",
+        "RigPitchPosFiltered", "RigPitchPosRate",
+        "RigYawPosFiltered", "RigYawPosRate",
+        "Vel")])
+
 class ExpData(object):
-    def __init__(self, parent, msgc2guiQueue):
+    """
+    The live state is the array('d') self.values laid out as STATE_NAMES;
+    self.view is a NumPy view of it. Each name in STATE_NAMES is also a
+    property of the same name.
+
+    The updates come from the MainLoop thread and write their blocks
+    under self.lock; other threads read the state through snapshot().
+    sendServoCommands may be called from any thread.
+
+    Rates are taken over the 31-bit node stamps with ts_delta, so they
+    hold across the wrap every 35.8 minutes. updateRigPos and updateACM
+    skip a sample whose stamp is not ahead of the last one taken (a
+    duplicate or a late packet) and return False; GND_ts and ACM_ts are
+    the last stamps taken.
+    """
+    def __init__(self, parent, msgc2guiQueue, parser=None):
         self.parent = parent
-        self.RigRollRawPos = 0
+        self.filters = FilterBank(parser)
+        self.values = array('d', [0.0]*len(STATE_NAMES))
+        self.view = np.frombuffer(self.values, dtype=np.float64)
+        self.lock = threading.Lock()
+        self.cmd_lock = threading.Lock()
         self.RigRollPos0 = 0
-        self.RigPitchRawPos = 0
         self.RigPitchPos0 = 0
-        self.RigYawRawPos = 0
         self.RigYawPos0 = 0
-        self.Vel = 0
-        self.DP = 0
-        self.GND_ADC_TS = 0
         self.msgc2guiQueue = msgc2guiQueue
-
-        self.ACM_servo1 = 0
-        self.ACM_servo2 = 0
-        self.ACM_servo3 = 0
-        self.ACM_servo4 = 0
-        self.ACM_servo5 = 0
-        self.ACM_servo6 = 0
-
-        self.CMP_servo1 = 0
-        self.CMP_svoref1 = 0
-        self.CMP_servo2 = 0
-        self.CMP_svoref2 = 0
-        self.CMP_servo3 = 0
-        self.CMP_svoref3 = 0
-        self.CMP_servo4 = 0
-        self.CMP_svoref4 = 0
-
-        self.CMP_servo1 = 0
-        self.CMP_servo2 = 0
-        self.CMP_servo3 = 0
-        self.CMP_servo4 = 0
+        self.state_ring = None
+        # µs of ts_ADC between rows written to the state ring
+        self.ring_interval = 50000
+        if parser and parser.has_option('gui', 'ring_interval'):
+            self.ring_interval = int(parser.getfloat('gui',
+                'ring_interval')*1000)
 
         self.ACM_servo1_0 = 1967
         self.ACM_servo2_0 = 2259
@@ -87,25 +207,6 @@ class ExpData(object):
         self.CMP_servo3_0 = 2000
         self.CMP_servo4_0 = 2020
 
-        self.GX = 0
-        self.GY = 0
-        self.GZ = 0
-        self.AX = 0
-        self.AY = 0
-        self.AZ = 0
-        self.ACM_svoref1 = 0
-        self.ACM_svoref2 = 0
-        self.ACM_svoref3 = 0
-        self.ACM_svoref4 = 0
-        self.ACM_svoref5 = 0
-        self.ACM_svoref6 = 0
-        self.ACM_ADC_TS = 0
-        self.ACM_CmdTime = 0
-
-        self.ACM_pitch = 0
-        self.ACM_roll = 0
-        self.ACM_yaw = 0
-
         self.ACM_pitch0 = 236
         self.ACM_roll0 = 4964
         self.ACM_yaw0 = 0
@@ -116,266 +217,383 @@ class ExpData(object):
         self.RigScale = 120/3873.0
         self.RigScaleYZ = 360/4095.0
 
-        self.RigRollPos = 0
-        self.RigPitchPos = 0
-        self.RigYawPos = 0
-
-        self.RigRollPosRate = 0
-        self.RigPitchPosRate = 0
-        self.RigYawPosRate = 0
-        self.RigRollPosFiltered = 0
-        self.RigPitchPosFiltered = 0
-        self.RigYawPosFiltered = 0
-        self.RigRollPosButt = Butter()
-        self.RigPitchPosButt = Butter()
-        self.RigYawPosButt = Butter()
-
-        self.ACM_pitch_rate = 0
-        self.ACM_roll_rate = 0
-        self.ACM_yaw_rate = 0
-        self.ACM_pitch_filtered = 0
-        self.ACM_roll_filtered = 0
-        self.ACM_yaw_filtered = 0
-        self.ACM_pitch_butt = Butter()
-        self.ACM_roll_butt = Butter()
-        self.ACM_yaw_butt = Butter()
+        self.RigRollPosButt = self.filters.make('RigRollPos', 'rig')
+        self.RigPitchPosButt = self.filters.make('RigPitchPos', 'rig')
+        self.RigYawPosButt = self.filters.make('RigYawPos', 'rig')
+
+        self.ACM_pitch_butt = self.filters.make('ACM_pitch', 'enc')
+        self.ACM_roll_butt = self.filters.make('ACM_roll', 'enc')
+        self.ACM_yaw_butt = self.filters.make('ACM_yaw', 'enc')
 
         self.A5 = struct.Struct('>BfB6H')
-        self.AA = struct.Struct('>BI6f')
+        self.AA = struct.Struct('>BI7f')
         self.last_update_ts = 0
+        self.last_ring_ts = 0
+        self.GND_ts = None
+        self.ACM_ts = None
+
+    def snapshot(self, getter):
+        """
+        getter(self.values), e.g. MATLAB_STATE, taken between updates.
+        """
+        with self.lock:
+            return getter(self.values)
 
     def resetRigAngel(self):
-        self.RigRollPos0 += self.RigRollRawPos
-        self.RigPitchPos0 += self.RigPitchRawPos
-        self.RigYawPos0 += self.RigYawRawPos
+        roll, pitch, yaw = self.snapshot(itemgetter(S_RigRollRawPos,
+            S_RigPitchRawPos, S_RigYawRawPos))
+        self.RigRollPos0 += int(roll)
+        self.RigPitchPos0 += int(pitch)
+        self.RigYawPos0 += int(yaw)
 
     def updateRigPos(self, RigRollPos,RigPitchPos,RigYawPos, ts_ADC):
-        self.RigRollRawPos = RigRollPos - self.RigRollPos0
-        self.RigPitchRawPos = RigPitchPos - self.RigPitchPos0
-        self.RigYawRawPos = RigYawPos - self.RigYawPos0
-        ts = self.GND_ADC_TS
-        self.GND_ADC_TS = ts_ADC*1e-6
-        dt = self.GND_ADC_TS - ts
-
-        self.RigRollPos = self.RigRollRawPos*self.RigScale
-        self.RigPitchPos = self.RigPitchRawPos*self.RigScaleYZ
-        self.RigYawPos = self.RigYawRawPos*self.RigScaleYZ
-        roll = self.RigRollPosButt.update(self.RigRollPos)
-        pitch = self.RigPitchPosButt.update(self.RigPitchPos)
-        yaw = self.RigYawPosButt.update(self.RigYawPos)
-        self.RigRollPosRate = (roll - self.RigRollPosFiltered)/dt
-        self.RigPitchPosRate = (pitch - self.RigPitchPosFiltered)/dt
-        self.RigYawPosRate = (yaw - self.RigYawPosFiltered)/dt
-        self.RigRollPosFiltered = roll
-        self.RigPitchPosFiltered = pitch
-        self.RigYawPosFiltered = yaw
+        if self.GND_ts is None:
+            dt = float('inf')
+        else:
+            dt = ts_delta(ts_ADC, self.GND_ts)*1e-6
+            if dt <= 0:
+                return False
+        self.GND_ts = ts_ADC
+        s = self.values
+        RigRollRawPos = RigRollPos - self.RigRollPos0
+        RigPitchRawPos = RigPitchPos - self.RigPitchPos0
+        RigYawRawPos = RigYawPos - self.RigYawPos0
+        GND_ADC_TS = ts_ADC*1e-6
+
+        RigRollPos = RigRollRawPos*self.RigScale
+        RigPitchPos = RigPitchRawPos*self.RigScaleYZ
+        RigYawPos = RigYawRawPos*self.RigScaleYZ
+        roll = self.RigRollPosButt.update(RigRollPos)
+        pitch = self.RigPitchPosButt.update(RigPitchPos)
+        yaw = self.RigYawPosButt.update(RigYawPos)
+        row = array('d', (GND_ADC_TS,
+                RigRollRawPos, RigRollPos,
+                roll, (roll - s[S_RigRollPosFiltered])/dt,
+                RigPitchRawPos, RigPitchPos,
+                pitch, (pitch - s[S_RigPitchPosFiltered])/dt,
+                RigYawRawPos, RigYawPos,
+                yaw, (yaw - s[S_RigYawPosFiltered])/dt))
+        with self.lock:
+            s[RIG_BLOCK] = row
 
         self.update2GUI(ts_ADC)
+        return True
+
+    def updateRigPosArray(self, RigRollPos,RigPitchPos,RigYawPos, ts_ADC,
+            Vel=None, DP=None):
+        """
+        Array counterpart of updateRigPos for offline reprocessing, for
+        the samples getStepMask(ts_ADC, self.GND_ts) keeps. Returns one
+        getGNDdata() row per sample and leaves the state as if updateRigPos
+        had been called on each of them. Vel/DP default to the current
+        manometer reading.
+        """
+        if not len(ts_ADC):
+            return np.empty((0, len(self.getGNDhdr())-4))
+        GND_ts, self.GND_ts = self.GND_ts, int(ts_ADC[-1])
+        RigRollRawPos = np.asarray(RigRollPos, dtype=np.int64) - self.RigRollPos0
+        RigPitchRawPos = np.asarray(RigPitchPos, dtype=np.int64) - self.RigPitchPos0
+        RigYawRawPos = np.asarray(RigYawPos, dtype=np.int64) - self.RigYawPos0
+        GND_ADC_TS = np.asarray(ts_ADC)*1e-6
+
+        RigRollPos = RigRollRawPos*self.RigScale
+        RigPitchPos = RigPitchRawPos*self.RigScaleYZ
+        RigYawPos = RigYawRawPos*self.RigScaleYZ
+        roll = self.RigRollPosButt.update_block(RigRollPos)
+        pitch = self.RigPitchPosButt.update_block(RigPitchPos)
+        yaw = self.RigYawPosButt.update_block(RigYawPos)
+        RigRollPosRate = getRateArray(roll, self.RigRollPosFiltered,
+                ts_ADC, GND_ts)
+        RigPitchPosRate = getRateArray(pitch, self.RigPitchPosFiltered,
+                ts_ADC, GND_ts)
+        RigYawPosRate = getRateArray(yaw, self.RigYawPosFiltered,
+                ts_ADC, GND_ts)
+        n = len(GND_ADC_TS)
+        Vel = np.broadcast_to(self.Vel if Vel is None else Vel, (n,))
+        DP = np.broadcast_to(self.DP if DP is None else DP, (n,))
+
+        return self.setArrayState(self.getGNDhdr(),
+                [GND_ADC_TS, RigRollRawPos, RigRollPos,
+                roll, RigRollPosRate,
+                RigPitchRawPos, RigPitchPos,
+                pitch, RigPitchPosRate,
+                RigYawRawPos, RigYawPos,
+                yaw, RigYawPosRate,
+                Vel, DP])
+
+    def setArrayState(self, hdr, columns):
+        """
+        Keep the last sample of each column as the live state, so scalar
+        updates can carry on after an array update, and stack the columns.
+        """
+        s = self.values
+        with self.lock:
+            for name, column in zip(hdr, columns):
+                s[STATE_INDEX[name]] = column[-1].item()
+        return np.column_stack(columns).astype(np.float64)
 
     def updateMani(self, vel, dp):
-        self.Vel = vel
-        self.DP = dp
+        s = self.values
+        with self.lock:
+            s[S_Vel] = vel
+            s[S_DP] = dp
 
     def getCMDhdr(self):
-        return ['TS', 'Dac','Deac','Dec','Drc','Dac_cmp', 'Dec_cmp', 'Drc_cmp']
+        return ['TS', 'Dac','Deac','Dec','Drc','Dac_cmp', 'Dec_cmp', 'Drc_cmp'] \
+                        + TAIL_COLUMNS
 
     def getGNDhdr(self):
-        return ["GND_ADC_TS", "RigRollRawPos", "RigRollPos",
-                "RigRollPosFiltered", "RigRollPosRate",
-                "RigPitchRawPos", "RigPitchPos",
-                "RigPitchPosFiltered", "RigPitchPosRate",
-                "RigYawRawPos", "RigYawPos",
-                "RigYawPosFiltered", "RigYawPosRate",
-                "Vel", "DP"] \
-                        + ["gen_ts", "sent_ts", "recv_ts", "port"]
+        return GND_STATE + TAIL_COLUMNS
 
     def getGNDdata(self):
-        return [self.GND_ADC_TS, self.RigRollRawPos, self.RigRollPos,
-                self.RigRollPosFiltered, self.RigRollPosRate,
-                self.RigPitchRawPos, self.RigPitchPos,
-                self.RigPitchPosFiltered, self.RigPitchPosRate,
-                self.RigYawRawPos, self.RigYawPos,
-                self.RigYawPosFiltered, self.RigYawPosRate,
-                self.Vel, self.DP]
+        return self.values[GND_BLOCK].tolist()
 
     def updateACM(self, ServoPos1,ServoPos2,ServoPos3,ServoPos4,ServoPos5, \
             ServoPos6, EncPos1,EncPos2,EncPos3, Gx,Gy,Gz, Nx,Ny,Nz, ts_ADC, \
             ServoCtrl1,ServoCtrl2,ServoCtrl3,ServoCtrl4,ServoCtrl5,ServoCtrl6, \
             ServoRef1,ServoRef2,ServoRef3,ServoRef4,ServoRef5,ServoRef6, \
             CmdTime):
-        self.ACM_servo1 = (ServoPos1-self.ACM_servo1_0)*self.ACMScale
-        self.ACM_servo2 = (ServoPos2-self.ACM_servo2_0)*self.ACMScale
-        self.ACM_servo3 = (ServoPos3-self.ACM_servo3_0)*self.ACMScale
-        self.ACM_servo4 = (ServoPos4-self.ACM_servo4_0)*self.ACMScale
-        self.ACM_servo5 = (ServoPos5-self.ACM_servo5_0)*self.ACMScale
-        self.ACM_servo6 = (ServoPos6-self.ACM_servo6_0)*self.ACMScale
-        self.ACM_roll = getPeriodDiff(EncPos1, self.ACM_roll0)*self.EncScale
-        self.ACM_pitch = getPeriodDiff(EncPos2, self.ACM_pitch0)*self.EncScale
-        self.ACM_yaw = getPeriodDiff(EncPos3, self.ACM_yaw0)*self.EncScale
-        self.GX = Get14bit(Gx)*0.05
-        self.GY = Get14bit(Gy)*-0.05
-        self.GZ = Get14bit(Gz)*-0.05
-        self.AX = Get14bit(Nx)*-0.003333
-        self.AY = Get14bit(Ny)*0.003333
-        self.AZ = Get14bit(Nz)*0.003333
-        ts = self.ACM_ADC_TS
-        self.ACM_ADC_TS = ts_ADC*1e-6
-        dt = self.ACM_ADC_TS - ts
-        self.ACM_svoref1 = (ServoRef1-self.ACM_servo1_0)*self.ACMScale
-        self.ACM_svoref2 = (ServoRef2-self.ACM_servo2_0)*self.ACMScale
-        self.ACM_svoref3 = (ServoRef3-self.ACM_servo3_0)*self.ACMScale
-        self.ACM_svoref4 = (ServoRef4-self.ACM_servo4_0)*self.ACMScale
-        self.ACM_svoref5 = (ServoRef5-self.ACM_servo5_0)*self.ACMScale
-        self.ACM_svoref6 = (ServoRef6-self.ACM_servo6_0)*self.ACMScale
-        self.ACM_mot1 = ServoCtrl1
-        self.ACM_mot2 = ServoCtrl2
-        self.ACM_mot3 = ServoCtrl3
-        self.ACM_mot4 = ServoCtrl4
-        self.ACM_mot5 = ServoCtrl5
-        self.ACM_mot6 = ServoCtrl6
-        self.ACM_CmdTime = CmdTime
-
-
-        pitch = self.ACM_pitch_butt.update(self.ACM_pitch)
-        roll = self.ACM_roll_butt.update(self.ACM_roll)
-        yaw = self.ACM_yaw_butt.update(self.ACM_yaw)
-        self.ACM_pitch_rate = (pitch - self.ACM_pitch_filtered)/dt
-        self.ACM_roll_rate = (roll - self.ACM_roll_filtered)/dt
-        self.ACM_yaw_rate = (yaw - self.ACM_yaw_filtered)/dt
-        self.ACM_pitch_filtered = pitch
-        self.ACM_roll_filtered = roll
-        self.ACM_yaw_filtered = yaw
+        if self.ACM_ts is None:
+            dt = float('inf')
+        else:
+            dt = ts_delta(ts_ADC, self.ACM_ts)*1e-6
+            if dt <= 0:
+                return False
+        self.ACM_ts = ts_ADC
+        s = self.values
+        scale = self.ACMScale
+        ACM_roll = getPeriodDiff(EncPos1, self.ACM_roll0)*self.EncScale
+        ACM_pitch = getPeriodDiff(EncPos2, self.ACM_pitch0)*self.EncScale
+        ACM_yaw = getPeriodDiff(EncPos3, self.ACM_yaw0)*self.EncScale
+        ACM_ADC_TS = ts_ADC*1e-6
+
+        pitch = self.ACM_pitch_butt.update(ACM_pitch)
+        roll = self.ACM_roll_butt.update(ACM_roll)
+        yaw = self.ACM_yaw_butt.update(ACM_yaw)
+        row = array('d', (ACM_ADC_TS, CmdTime,
+                (ServoRef1-self.ACM_servo1_0)*scale,
+                (ServoPos1-self.ACM_servo1_0)*scale,
+                (ServoRef2-self.ACM_servo2_0)*scale,
+                (ServoPos2-self.ACM_servo2_0)*scale,
+                (ServoRef3-self.ACM_servo3_0)*scale,
+                (ServoPos3-self.ACM_servo3_0)*scale,
+                (ServoRef4-self.ACM_servo4_0)*scale,
+                (ServoPos4-self.ACM_servo4_0)*scale,
+                (ServoRef5-self.ACM_servo5_0)*scale,
+                (ServoPos5-self.ACM_servo5_0)*scale,
+                (ServoRef6-self.ACM_servo6_0)*scale,
+                (ServoPos6-self.ACM_servo6_0)*scale,
+                ACM_roll, roll, (roll - s[S_ACM_roll_filtered])/dt,
+                ACM_pitch, pitch, (pitch - s[S_ACM_pitch_filtered])/dt,
+                ACM_yaw, yaw, (yaw - s[S_ACM_yaw_filtered])/dt,
+                # Get14bit inlined
+                (((Gx&0x3FFF)^0x2000)-0x2000)*0.05,
+                (((Gy&0x3FFF)^0x2000)-0x2000)*-0.05,
+                (((Gz&0x3FFF)^0x2000)-0x2000)*-0.05,
+                (((Nx&0x3FFF)^0x2000)-0x2000)*-0.003333,
+                (((Ny&0x3FFF)^0x2000)-0x2000)*0.003333,
+                (((Nz&0x3FFF)^0x2000)-0x2000)*0.003333,
+                ServoCtrl1, ServoCtrl2, ServoCtrl3,
+                ServoCtrl4, ServoCtrl5, ServoCtrl6))
+        with self.lock:
+            s[ACM_BLOCK] = row
 
         self.update2GUI(ts_ADC)
+        return True
+
+    def updateACMArray(self, ServoPos1,ServoPos2,ServoPos3,ServoPos4,ServoPos5, \
+            ServoPos6, EncPos1,EncPos2,EncPos3, Gx,Gy,Gz, Nx,Ny,Nz, ts_ADC, \
+            ServoCtrl1,ServoCtrl2,ServoCtrl3,ServoCtrl4,ServoCtrl5,ServoCtrl6, \
+            ServoRef1,ServoRef2,ServoRef3,ServoRef4,ServoRef5,ServoRef6, \
+            CmdTime):
+        """
+        Array counterpart of updateACM for offline reprocessing, for the
+        samples getStepMask(ts_ADC, self.ACM_ts) keeps. Returns one
+        getACMdata() row per sample and leaves the state as if updateACM
+        had been called on each of them.
+        """
+        if not len(ts_ADC):
+            return np.empty((0, len(self.getACMhdr())-4))
+        ACM_ts, self.ACM_ts = self.ACM_ts, int(ts_ADC[-1])
+        scale = lambda pos, pos0 : \
+                (np.asarray(pos, dtype=np.int64)-pos0)*self.ACMScale
+        ACM_roll = getPeriodDiffArray(EncPos1, self.ACM_roll0)*self.EncScale
+        ACM_pitch = getPeriodDiffArray(EncPos2, self.ACM_pitch0)*self.EncScale
+        ACM_yaw = getPeriodDiffArray(EncPos3, self.ACM_yaw0)*self.EncScale
+        ACM_ADC_TS = np.asarray(ts_ADC)*1e-6
+
+        pitch = self.ACM_pitch_butt.update_block(ACM_pitch)
+        roll = self.ACM_roll_butt.update_block(ACM_roll)
+        yaw = self.ACM_yaw_butt.update_block(ACM_yaw)
+        ACM_pitch_rate = getRateArray(pitch, self.ACM_pitch_filtered,
+                ts_ADC, ACM_ts)
+        ACM_roll_rate = getRateArray(roll, self.ACM_roll_filtered,
+                ts_ADC, ACM_ts)
+        ACM_yaw_rate = getRateArray(yaw, self.ACM_yaw_filtered,
+                ts_ADC, ACM_ts)
+
+        return self.setArrayState(self.getACMhdr(),
+                [ACM_ADC_TS, np.asarray(CmdTime),
+                scale(ServoRef1, self.ACM_servo1_0),
+                scale(ServoPos1, self.ACM_servo1_0),
+                scale(ServoRef2, self.ACM_servo2_0),
+                scale(ServoPos2, self.ACM_servo2_0),
+                scale(ServoRef3, self.ACM_servo3_0),
+                scale(ServoPos3, self.ACM_servo3_0),
+                scale(ServoRef4, self.ACM_servo4_0),
+                scale(ServoPos4, self.ACM_servo4_0),
+                scale(ServoRef5, self.ACM_servo5_0),
+                scale(ServoPos5, self.ACM_servo5_0),
+                scale(ServoRef6, self.ACM_servo6_0),
+                scale(ServoPos6, self.ACM_servo6_0),
+                ACM_roll, roll, ACM_roll_rate,
+                ACM_pitch, pitch, ACM_pitch_rate,
+                ACM_yaw, yaw, ACM_yaw_rate,
+                Get14bitArray(Gx)*0.05, Get14bitArray(Gy)*-0.05,
+                Get14bitArray(Gz)*-0.05, Get14bitArray(Nx)*-0.003333,
+                Get14bitArray(Ny)*0.003333, Get14bitArray(Nz)*0.003333,
+                np.asarray(ServoCtrl1), np.asarray(ServoCtrl2),
+                np.asarray(ServoCtrl3), np.asarray(ServoCtrl4),
+                np.asarray(ServoCtrl5), np.asarray(ServoCtrl6)])
 
     def getACMdata(self):
-        return [self.ACM_ADC_TS, self.ACM_CmdTime, self.ACM_svoref1,
-                self.ACM_servo1, self.ACM_svoref2, self.ACM_servo2,
-                self.ACM_svoref3, self.ACM_servo3, self.ACM_svoref4,
-                self.ACM_servo4, self.ACM_svoref5, self.ACM_servo5,
-                self.ACM_svoref6, self.ACM_servo6, self.ACM_roll,
-                self.ACM_roll_filtered, self.ACM_roll_rate,
-                self.ACM_pitch, self.ACM_pitch_filtered, self.ACM_pitch_rate,
-                self.ACM_yaw, self.ACM_yaw_filtered, self.ACM_yaw_rate,
-                self.GX, self.GY, self.GZ, self.AX, self.AY, self.AZ,
-                self.ACM_mot1, self.ACM_mot2, self.ACM_mot3, self.ACM_mot4,
-                self.ACM_mot5, self.ACM_mot6]
+        return self.values[ACM_BLOCK].tolist()
 
     def getACMhdr(self):
-        return ["ACM_ADC_TS", "ACM_CmdTime", "ACM_svoref1",
-                "ACM_servo1", "ACM_svoref2", "ACM_servo2",
-                "ACM_svoref3", "ACM_servo3", "ACM_svoref4",
-                "ACM_servo4", "ACM_svoref5", "ACM_servo5",
-                "ACM_svoref6", "ACM_servo6", "ACM_roll",
-                "ACM_roll_filtered", "ACM_roll_rate",
-                "ACM_pitch", "ACM_pitch_filtered", "ACM_pitch_rate",
-                "ACM_yaw", "ACM_yaw_filtered", "ACM_yaw_rate",
-                "GX", "GY", "GZ", "AX", "AY", "AZ",
-                "ACM_mot1", "ACM_mot2", "ACM_mot3", "ACM_mot4",
-                "ACM_mot5", "ACM_mot6"] \
-                        + ["gen_ts", "sent_ts", "recv_ts", "port"]
-
+        return ACM_STATE + TAIL_COLUMNS
 
     def updateCMP(self, ServoPos1,ServoPos2,ServoPos3,ServoPos4, \
             EncPos1,EncPos2,EncPos3,EncPos4,ts_ADC, \
             ServoCtrl1,ServoCtrl2,ServoCtrl3,ServoCtrl4, \
             ServoRef1,ServoRef2,ServoRef3,ServoRef4, \
             CmdTime):
-        self.CMP_servo1 = (EncPos1-self.CMP_servo1_0)*self.CMPScale
-        self.CMP_servo2 = (EncPos2-self.CMP_servo2_0)*self.CMPScale
-        self.CMP_servo3 = (EncPos3-self.CMP_servo3_0)*self.CMPScale
-        self.CMP_servo4 = (EncPos4-self.CMP_servo4_0)*self.CMPScale
-        self.CMP_ADC_TS = ts_ADC*1e-6
-        self.CMP_svoref1 = (ServoRef1-self.CMP_servo1_0)*self.CMPScale
-        self.CMP_svoref2 = (ServoRef2-self.CMP_servo2_0)*self.CMPScale
-        self.CMP_svoref3 = (ServoRef3-self.CMP_servo3_0)*self.CMPScale
-        self.CMP_svoref4 = (ServoRef4-self.CMP_servo4_0)*self.CMPScale
-        self.CMP_mot1 = ServoCtrl1
-        self.CMP_mot2 = ServoCtrl2
-        self.CMP_mot3 = ServoCtrl3
-        self.CMP_mot4 = ServoCtrl4
-        self.CMP_CmdTime = CmdTime
+        scale = self.CMPScale
+        row = array('d', (ts_ADC*1e-6, CmdTime,
+                (ServoRef1-self.CMP_servo1_0)*scale,
+                (EncPos1-self.CMP_servo1_0)*scale,
+                (ServoRef2-self.CMP_servo2_0)*scale,
+                (EncPos2-self.CMP_servo2_0)*scale,
+                (ServoRef3-self.CMP_servo3_0)*scale,
+                (EncPos3-self.CMP_servo3_0)*scale,
+                (ServoRef4-self.CMP_servo4_0)*scale,
+                (EncPos4-self.CMP_servo4_0)*scale,
+                ServoCtrl1, ServoCtrl2, ServoCtrl3, ServoCtrl4))
+        with self.lock:
+            self.values[CMP_BLOCK] = row
 
         self.update2GUI(ts_ADC)
 
+    def updateCMPArray(self, ServoPos1,ServoPos2,ServoPos3,ServoPos4, \
+            EncPos1,EncPos2,EncPos3,EncPos4,ts_ADC, \
+            ServoCtrl1,ServoCtrl2,ServoCtrl3,ServoCtrl4, \
+            ServoRef1,ServoRef2,ServoRef3,ServoRef4, \
+            CmdTime):
+        """
+        Array counterpart of updateCMP for offline reprocessing.
+        Returns one getCMPdata() row per sample.
+        """
+        if not len(ts_ADC):
+            return np.empty((0, len(self.getCMPhdr())-4))
+        scale = lambda pos, pos0 : \
+                (np.asarray(pos, dtype=np.int64)-pos0)*self.CMPScale
+        return self.setArrayState(self.getCMPhdr(),
+                [np.asarray(ts_ADC)*1e-6, np.asarray(CmdTime),
+                scale(ServoRef1, self.CMP_servo1_0),
+                scale(EncPos1, self.CMP_servo1_0),
+                scale(ServoRef2, self.CMP_servo2_0),
+                scale(EncPos2, self.CMP_servo2_0),
+                scale(ServoRef3, self.CMP_servo3_0),
+                scale(EncPos3, self.CMP_servo3_0),
+                scale(ServoRef4, self.CMP_servo4_0),
+                scale(EncPos4, self.CMP_servo4_0),
+                np.asarray(ServoCtrl1), np.asarray(ServoCtrl2),
+                np.asarray(ServoCtrl3), np.asarray(ServoCtrl4)])
+
     def getCMPdata(self):
-        return [self.CMP_ADC_TS, self.CMP_CmdTime, self.CMP_svoref1,
-                self.CMP_servo1, self.CMP_svoref2, self.CMP_servo2,
-                self.CMP_svoref3, self.CMP_servo3, self.CMP_svoref4,
-                self.CMP_servo4, self.CMP_mot1, self.CMP_mot2,
-                self.CMP_mot3, self.CMP_mot4]
+        return self.values[CMP_BLOCK].tolist()
 
     def getCMPhdr(self):
-        return ["CMP_ADC_TS", "CMP_CmdTime", "CMP_svoref1",
-                "CMP_servo1", "CMP_svoref2", "CMP_servo2",
-                "CMP_svoref3", "CMP_servo3", "CMP_svoref4",
-                "CMP_servo4", "CMP_mot1", "CMP_mot2",
-                "CMP_mot3", "CMP_mot4"] \
-                        + ["gen_ts", "sent_ts", "recv_ts", "port"]
+        return CMP_STATE + TAIL_COLUMNS
 
     def sendCommand(self, time_token, dac, deac, dec, drc, dac_cmp, dec_cmp, drc_cmp):
-        ts1 = int((time.clock()-self.parent.T0)*1e6)&0x7fffffff
-        da = int(dac/self.ACMScale)
-        dea = int(deac/self.ACMScale)
-        de = int(dec/self.ACMScale)
-        dr = int(drc/self.ACMScale)
-
-        da_cmp = int(dac_cmp/self.CMPScale)
-        de_cmp = int(dec_cmp/self.CMPScale)
-        dr_cmp = int(drc_cmp/self.CMPScale)
-
-        self.ACM_servo1_cmd = self.ACM_servo1_0 - da
-        self.ACM_servo2_cmd = self.ACM_servo2_0 - da
-        self.ACM_servo3_cmd = self.ACM_servo3_0 + dr
-        self.ACM_servo4_cmd = self.ACM_servo4_0 + dr
-        self.ACM_servo5_cmd = self.ACM_servo5_0 + de -dea
-        self.ACM_servo6_cmd = self.ACM_servo6_0 - de =dea
-        dataA5 = self.A5.pack(0xA5, time_token, 1, self.ACM_servo1_cmd,
-                self.ACM_servo2_cmd, self.ACM_servo3_cmd, self.ACM_servo4_cmd,
-                self.ACM_servo5_cmd,self.ACM_servo6_cmd)
-        self.xbee_network.send(dataA5,self.ACM_node)
-        ts2 = int((time.clock()-self.parent.T0)*1e6)&0x7fffffff
-
-        self.CMP_servo1_cmd = self.CMP_servo1_0 + da_cmp +de_cmp
-        self.CMP_servo2_cmd = self.CMP_servo2_0 + da_cmp -dr_cmp
-        self.CMP_servo3_cmd = self.CMP_servo3_0 + da_cmp -de_cmp
-        self.CMP_servo4_cmd = self.CMP_servo4_0 + da_cmp +dr_cmp
-
-        dataA6 = self.A5.pack(0xA6, time_token, 1, self.CMP_servo1_cmd,
-                self.CMP_servo2_cmd, self.CMP_servo3_cmd, self.CMP_servo4_cmd,
-                2000,2000)
-        self.xbee_network.send(dataA6,self.CMP_node)
-        ts3 = int((time.clock()-self.parent.T0)*1e6)&0x7fffffff
+        ts1, ts2, ts3 = self.sendServoCommands(time_token, dac, deac, dec,
+                drc, dac_cmp, dec_cmp, drc_cmp)
+        self.recordCommand(ts1, ts2, ts3, dac, deac, dec, drc,
+                dac_cmp, dec_cmp, drc_cmp)
 
+    def sendServoCommands(self, time_token, dac, deac, dec, drc, dac_cmp,
+            dec_cmp, drc_cmp):
+        """
+        Hand the A5 frame for ACM and the A6 frame for CMP to the send
+        scheduler; returns the timestamps before, between and after.
+        """
+        with self.cmd_lock:
+            ticks = self.parent.timebase.ticks
+            ts1 = ticks()
+            da = int(dac/self.ACMScale)
+            dea = int(deac/self.ACMScale)
+            de = int(dec/self.ACMScale)
+            dr = int(drc/self.ACMScale)
+
+            da_cmp = int(dac_cmp/self.CMPScale)
+            de_cmp = int(dec_cmp/self.CMPScale)
+            dr_cmp = int(drc_cmp/self.CMPScale)
+
+            self.ACM_servo1_cmd = self.ACM_servo1_0 - da
+            self.ACM_servo2_cmd = self.ACM_servo2_0 - da
+            self.ACM_servo3_cmd = self.ACM_servo3_0 + dr
+            self.ACM_servo4_cmd = self.ACM_servo4_0 + dr
+            self.ACM_servo5_cmd = self.ACM_servo5_0 + de -dea
+            self.ACM_servo6_cmd = self.ACM_servo6_0 - de - dea
+            dataA5 = self.A5.pack(0xA5, time_token, 1, self.ACM_servo1_cmd,
+                    self.ACM_servo2_cmd, self.ACM_servo3_cmd,
+                    self.ACM_servo4_cmd, self.ACM_servo5_cmd,
+                    self.ACM_servo6_cmd)
+            self.xbee_network.schedule(dataA5,self.ACM_node)
+            ts2 = ticks()
+
+            self.CMP_servo1_cmd = self.CMP_servo1_0 + da_cmp +de_cmp
+            self.CMP_servo2_cmd = self.CMP_servo2_0 + da_cmp -dr_cmp
+            self.CMP_servo3_cmd = self.CMP_servo3_0 + da_cmp -de_cmp
+            self.CMP_servo4_cmd = self.CMP_servo4_0 + da_cmp +dr_cmp
+
+            dataA6 = self.A5.pack(0xA6, time_token, 1, self.CMP_servo1_cmd,
+                    self.CMP_servo2_cmd, self.CMP_servo3_cmd,
+                    self.CMP_servo4_cmd, 2000,2000)
+            self.xbee_network.schedule(dataA6,self.CMP_node)
+            ts3 = ticks()
+            return ts1, ts2, ts3
+
+    def recordCommand(self, ts1, ts2, ts3, dac, deac, dec, drc, dac_cmp,
+            dec_cmp, drc_cmp):
         data = self.AA.pack(0xA6, ts1, dac, deac, dec, drc,
                 dac_cmp, dec_cmp, drc_cmp)
-        self.parent.save(data, ts1, ts2, ts3, 0)
+        self.parent.save(data, ts1, ts2, ts3, ('', 0))
 
     def update2GUI(self, ts_ADC):
+        """
+        With a GUI state ring (a StateRing of len(GUI_INDEX) wide), one
+        update every ring_interval µs goes into it, every update if that
+        is 0 ([gui] ring_interval, ms); else one every 50 ms goes through
+        the queue.
+        """
+        if self.state_ring is not None:
+            deltaT = ts_ADC - self.last_ring_ts
+            if deltaT >= self.ring_interval or deltaT < 0:
+                self.last_ring_ts = ts_ADC
+                self.state_ring.write(self.view, GUI_INDEX)
+            return
         if not self.msgc2guiQueue:
             return
         deltaT = ts_ADC - self.last_update_ts
         if deltaT > 50000 or deltaT < 0:
             self.last_update_ts = ts_ADC
             self.msgc2guiQueue.put_nowait({'ID':'ExpData',
-                'states':[self.GND_ADC_TS,
-                        self.GX, self.GY, self.GZ, self.AX, self.AY,
-                        self.AZ, self.ACM_roll_filtered, self.ACM_roll_rate,
-                        self.ACM_pitch_filtered, self.ACM_pitch_rate,
-                        self.ACM_yaw_filtered, self.ACM_yaw_rate,
-                        self.RigRollPosFiltered, self.RigRollPosRate,
-                        self.RigPitchPosFiltered, self.RigPitchPosRate,
-                        self.RigYawPosFiltered, self.RigYawPosRate,
-                        self.ACM_svoref1, self.ACM_servo1, #19 20
-                        self.ACM_svoref2, self.ACM_servo2,
-                        self.ACM_svoref3, self.ACM_servo3,
-                        self.ACM_svoref4, self.ACM_servo4,
-                        self.ACM_svoref5, self.ACM_servo5,
-                        self.ACM_svoref6, self.ACM_servo6,
-                        self.CMP_servo1, self.CMP_svoref1, #31 32
-                        self.CMP_servo2, self.CMP_svoref2,
-                        self.CMP_servo3, self.CMP_svoref3,
-                        self.CMP_servo4, self.CMP_svoref4,
-                        self.Vel, self.DP
-                        ]})
+                'states':GUI_STATE(self.values)})
+
+def state_property(i):
+    return property(lambda self: self.values[i],
+            lambda self, value: self.values.__setitem__(i, value))
 
+for i, name in enumerate(STATE_NAMES):
+    setattr(ExpData, name, state_property(i))
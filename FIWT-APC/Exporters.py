@@ -0,0 +1,187 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Incremental exporters for parsed rec data in Python
+----------------------------------------
+
+Author: Zheng GONG(matthewzhenggong@gmail.com)
+
+This file is part of FIWT.
+
+FIWT is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 3.0 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library.
+
+Every exporter is created with the output base name and the
+(data, head) pairs of the streams, gets the rows of each stream block
+by block through append(data, rows) and is finished with close().
+Columns are stored one by one under the head names, so they can be
+read back alone (read_columns):
+
+    h5       <base>.h5, group per stream, chunked compressed dataset
+             per column (h5py)
+    parquet  <base>.<data>.parquet, row group per block (pyarrow)
+    npz      <base>.npz, member <data>/<column> per column plus the
+             head arrays; np.load(...)['data22/ACM_roll']
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+import zipfile
+import numpy as np
+
+NPY_HEADER_SIZE = 128
+
+def npy_header(count):
+    """
+    Fixed size .npy v1 header for count float64 values, so it can be
+    rewritten in place once the count is known.
+    """
+    header = "{'descr': '<f8', 'fortran_order': False, 'shape': (%d,), }" \
+            % count
+    size = NPY_HEADER_SIZE - 10
+    return '\x93NUMPY\x01\x00' + struct.pack('<H', size) \
+            + header.ljust(size-1) + '\n'
+
+class NPZExporter(object):
+    """
+    Each column goes to a temporary .npy file as it comes; close() packs
+    them into a deflated zip one file at a time.
+    """
+    def __init__(self, filename, heads, compression=None):
+        self.filename = filename + '.npz'
+        self.heads = heads
+        self.tmpdir = tempfile.mkdtemp(dir=os.path.dirname(
+            os.path.abspath(self.filename)))
+        self.columns = {}
+        for data, head in heads:
+            self.columns[data] = [[open(os.path.join(self.tmpdir,
+                '{}.{}.npy'.format(data, i)), 'w+b'), 0] for i in head]
+            for column in self.columns[data]:
+                column[0].write(npy_header(0))
+
+    def append(self, data, rows):
+        for i, column in enumerate(self.columns[data]):
+            np.ascontiguousarray(rows[:, i], dtype='<f8').tofile(column[0])
+            column[1] += len(rows)
+
+    def close(self):
+        try:
+            with zipfile.ZipFile(self.filename, 'w', zipfile.ZIP_DEFLATED,
+                    allowZip64=True) as zf:
+                for data, head in self.heads:
+                    for name, (f, count) in zip(head, self.columns[data]):
+                        f.seek(0)
+                        f.write(npy_header(count))
+                        f.close()
+                        zf.write(f.name, '{}/{}.npy'.format(data, name))
+                    f = open(os.path.join(self.tmpdir, 'head.npy'), 'w+b')
+                    np.save(f, np.array(head, dtype=str))
+                    f.close()
+                    zf.write(f.name, '{}.npy'.format(
+                        data.replace('data', 'head', 1)))
+        finally:
+            shutil.rmtree(self.tmpdir, True)
+
+    @staticmethod
+    def read_columns(filename, data, columns):
+        npz = np.load(filename + '.npz')
+        try:
+            return dict((name, npz['{}/{}'.format(data, name)])
+                    for name in columns)
+        finally:
+            npz.close()
+
+class HDF5Exporter(object):
+    """
+    One group per stream with the column order in its 'columns'
+    attribute, one resizable chunked dataset per column.
+    """
+    def __init__(self, filename, heads, compression='gzip',
+            chunk_rows=1<<14):
+        import h5py
+        self.f = h5py.File(filename + '.h5', 'w')
+        self.heads = dict(heads)
+        for data, head in heads:
+            group = self.f.create_group(data)
+            group.attrs['columns'] = np.array(head, dtype=str)
+            for name in head:
+                group.create_dataset(name, shape=(0,), maxshape=(None,),
+                        dtype='<f8', chunks=(chunk_rows,),
+                        compression=compression or 'gzip', shuffle=True)
+
+    def append(self, data, rows):
+        group = self.f[data]
+        for i, name in enumerate(self.heads[data]):
+            ds = group[name]
+            n = ds.shape[0]
+            ds.resize((n+len(rows),))
+            ds[n:] = rows[:, i]
+
+    def close(self):
+        self.f.close()
+
+    @staticmethod
+    def read_columns(filename, data, columns):
+        import h5py
+        with h5py.File(filename + '.h5', 'r') as f:
+            return dict((name, f[data][name][:]) for name in columns)
+
+class ParquetExporter(object):
+    """
+    One Parquet file per stream, one row group per appended block.
+    """
+    def __init__(self, filename, heads, compression='snappy'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.heads = dict(heads)
+        self.writers = {}
+        for data, head in heads:
+            schema = pa.schema([pa.field(name, pa.float64())
+                for name in head])
+            self.writers[data] = pq.ParquetWriter(
+                    '{}.{}.parquet'.format(filename, data), schema,
+                    compression=compression or 'snappy')
+
+    def append(self, data, rows):
+        pa = self.pa
+        self.writers[data].write_table(pa.Table.from_arrays(
+            [pa.array(np.ascontiguousarray(rows[:, i]))
+                for i in xrange(rows.shape[1])],
+            names=list(self.heads[data])))
+
+    def close(self):
+        for writer in self.writers.itervalues():
+            writer.close()
+
+    @staticmethod
+    def read_columns(filename, data, columns):
+        import pyarrow.parquet as pq
+        table = pq.read_table('{}.{}.parquet'.format(filename, data),
+                columns=list(columns))
+        return dict((name, table.column(name).to_pandas().values)
+                for name in columns)
+
+EXPORTERS = {
+        'npz':NPZExporter,
+        'h5':HDF5Exporter,
+        'parquet':ParquetExporter,
+        }
+
+def read_columns(filename, fmt, data, columns):
+    """
+    Read only the given columns of one stream of an export.
+    """
+    return EXPORTERS[fmt].read_columns(filename, data, columns)
@@ -0,0 +1,209 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Latency histograms in Python
+----------------------------------------
+
+Author: Zheng GONG(matthewzhenggong@gmail.com)
+
+This file is part of FIWT.
+
+FIWT is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 3.0 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library.
+"""
+
+import itertools
+import math
+import numpy as np
+
+from Timebase import ts_delta
+
+class LatencyHistogram(object):
+    """
+    Fixed log-spaced buckets from lo to hi (µs), bins_per_decade per
+    factor of ten, plus an underflow and an overflow bucket. Adding a
+    sample is O(1) and memory does not grow; quantiles are within half a
+    bucket width (about 6% with the default 20 per decade). Values below
+    lo, negative ones included, share the underflow bucket; min shows
+    how far they go.
+    """
+    def __init__(self, lo=1.0, hi=1e7, bins_per_decade=20):
+        self.lo = lo
+        self.scale = bins_per_decade/math.log(10)
+        self.nbins = int(math.ceil(math.log10(hi/lo)*bins_per_decade)) + 2
+        self.edges = [lo*10**(float(i)/bins_per_decade)
+                for i in xrange(self.nbins-1)]
+        self.reset()
+
+    def reset(self):
+        self.counts = [0]*self.nbins
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def add(self, us):
+        if us < self.lo:
+            i = 0
+        else:
+            i = int(math.log(us/self.lo)*self.scale) + 1
+            if i >= self.nbins:
+                i = self.nbins-1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += us
+        if us > self.max:
+            self.max = us
+        if us < self.min:
+            self.min = us
+
+    def add_array(self, us):
+        """
+        add() for every value of a numpy array.
+        """
+        if not len(us):
+            return
+        us = np.asarray(us, dtype=np.float64)
+        i = np.zeros(len(us), dtype=np.intp)
+        big = us >= self.lo
+        i[big] = np.minimum(np.log(us[big]/self.lo)*self.scale + 1,
+                self.nbins-1).astype(np.intp)
+        for b, n in enumerate(np.bincount(i, minlength=self.nbins).tolist()):
+            if n:
+                self.counts[b] += n
+        self.count += len(us)
+        self.total += float(us.sum())
+        self.max = max(self.max, float(us.max()))
+        self.min = min(self.min, float(us.min()))
+
+    def quantile(self, q):
+        """
+        Geometric middle of the bucket holding quantile q, capped at max.
+        """
+        if not self.count:
+            return 0.0
+        rank = q*self.count
+        acc = 0
+        for i, n in enumerate(self.counts):
+            acc += n
+            if acc >= rank and n:
+                break
+        if i == 0:
+            return min(self.lo, self.max)
+        if i == self.nbins-1:
+            return self.max
+        return min(math.sqrt(self.edges[i-1]*self.edges[i]), self.max)
+
+    def summary(self):
+        if not self.count:
+            return dict.fromkeys(('count', 'mean', 'min', 'p50', 'p95',
+                'p99', 'max'), 0)
+        return {'count':self.count, 'mean':self.total/self.count,
+                'min':self.min, 'p50':self.quantile(0.5),
+                'p95':self.quantile(0.95), 'p99':self.quantile(0.99),
+                'max':self.max}
+
+    def format(self, name):
+        return ('{} n{count} mean{mean:.0f} min {min:.0f} p50 {p50:.0f} '
+                'p95 {p95:.0f} p99 {p99:.0f} max {max:.0f}us').format(name,
+                        **self.summary())
+
+class LatencyTracker(object):
+    """
+    Per node and message code: queueing in the node (sent_ts-gen_ts, node
+    clock) and transit (recv_ts-sent_ts, corrected by offsets[addr], the
+    AP clock minus the node clock in µs, 0 until clock sync sets it).
+    Per node: processing from recv_ts to the end of the dispatch.
+
+    The receive path only appends raw timestamps to the lists from
+    rows(addr); they go into the histograms in bulk when flush() is
+    called.
+    """
+    def __init__(self, names=None):
+        self.names = names or {}
+        self.offsets = {}
+        self.pending = {}
+        self.codes = {}
+        self.processing = {}
+
+    def reset(self):
+        self.pending.clear()
+        self.codes.clear()
+        self.processing.clear()
+
+    def rows(self, addr):
+        """
+        Lists to append (code, gen_ts, sent_ts, recv_ts) per packet and
+        the processing time in µs per datagram from addr.
+        """
+        rows = self.pending.get(addr)
+        if rows is None:
+            rows = self.pending[addr] = ([], [])
+        return rows
+
+    def flush(self):
+        for addr, (rows, proc) in self.pending.items():
+            if not rows:
+                continue
+            self.pending[addr] = ([], [])
+            a = np.fromiter(itertools.chain.from_iterable(rows),
+                    dtype=np.int64, count=4*len(rows)).reshape(-1, 4)
+            code = a[:, 0]
+            queue = ts_delta(a[:, 2], a[:, 1])
+            transit = ts_delta(a[:, 3], a[:, 2] + self.offsets.get(addr, 0))
+            for c in np.unique(code):
+                sel = code == c
+                hists = self.codes.get((addr, c))
+                if hists is None:
+                    hists = self.codes[(addr, c)] = (LatencyHistogram(),
+                            LatencyHistogram())
+                hists[0].add_array(queue[sel])
+                hists[1].add_array(transit[sel])
+            if proc:
+                hist = self.processing.get(addr)
+                if hist is None:
+                    hist = self.processing[addr] = LatencyHistogram()
+                hist.add_array(np.array(proc, dtype=np.float64))
+
+    def name(self, addr):
+        return self.names.get(addr, '{}:{}'.format(*addr))
+
+    def brief(self):
+        """
+        One line per node: p50/p99 of queueing and transit of its most
+        frequent code, and p99 of processing.
+        """
+        self.flush()
+        lines = []
+        for addr, proc in sorted(self.processing.iteritems()):
+            hists = [h for (a, code), h in self.codes.iteritems()
+                    if a == addr]
+            if not hists:
+                continue
+            queue, transit = max(hists, key=lambda h: h[0].count)
+            lines.append('{} Q{:.0f}/{:.0f} T{:.0f}/{:.0f} P{:.0f}us'.format(
+                self.name(addr), queue.quantile(0.5), queue.quantile(0.99),
+                transit.quantile(0.5), transit.quantile(0.99),
+                proc.quantile(0.99)))
+        return '\n'.join(lines)
+
+    def report(self):
+        self.flush()
+        lines = []
+        for (addr, code), (queue, transit) in sorted(self.codes.iteritems()):
+            name = '{} 0x{:02x}'.format(self.name(addr), code)
+            lines.append(queue.format(name + ' queue'))
+            lines.append(transit.format(name + ' transit'))
+        for addr, proc in sorted(self.processing.iteritems()):
+            lines.append(proc.format(self.name(addr) + ' processing'))
+        return '\n'.join(lines)
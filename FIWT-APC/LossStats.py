@@ -0,0 +1,362 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Packet loss statistics in Python
+----------------------------------------
+
+Author: Zheng GONG(matthewzhenggong@gmail.com)
+
+This file is part of FIWT.
+
+FIWT is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 3.0 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library.
+
+The nodes send no sequence numbers, but they send periodically, so a
+lost packet shows as a step of their timestamps well over the period.
+The data packets carry the ADC sample time ts_ADC, the most regular
+stamp there is; the others go by gen_ts.
+
+A stamp more than RESET_JUMP behind the one before means the node
+clock was set back, not a late packet: the stream starts over there.
+Offline the streams are also cut at the CODE_TIMEBASE records, where
+T0 was reset.
+
+GapCounter follows one stream live, LossTracker one per node and code;
+gap_stats does the same for a whole stream at once, and analyze_file
+for every stream of a .rec file.
+"""
+
+import argparse
+import struct
+import numpy as np
+
+import recparse
+from Timebase import MASK, WRAP, HALF, CODE_TIMEBASE, packCODE_TIMEBASE, \
+        ts_delta, unwrap
+
+# µs a stamp may fall behind the one before and still be a late packet
+RESET_JUMP = 1000000
+
+# offset of ts_ADC in the packets that have one
+ADC_TS_OFFSETS = {0x22:31, 0x33:17, 0x44:17}
+# bytes from the port and gen_ts of a record header to its payload
+HDR_PORT = recparse.packHdr.size - 13
+HDR_GEN_TS = recparse.packHdr.size - 1
+
+CODE_LOSS_STATS = 0x04
+# node port, stream code, expected, received, gaps, duplicates,
+# reordered, period (µs), longest burst
+packCODE_LOSS_STATS = struct.Struct('>BHB6IH')
+
+class GapCounter(object):
+    """
+    Gaps in a periodic stream of 31-bit µs timestamps, O(1) per stamp.
+    The period is the median of the first learn steps, then follows an
+    EWMA of the steps of about one period. Each step forward is rounded
+    to whole periods and the stream is expected to fill every one, so
+    missing_cnt is expected minus received: a late stamp followed by an
+    early one (2 + 0 periods) costs nothing, and a stamp behind the
+    latest, reordered, fills its hole. A step of k > 1 periods is a gap,
+    a burst of k-1 lost, one shorter if the next stamp comes back within
+    half a period or is a late one.
+
+    offset is where the stamp is in the frames of the stream, None for
+    gen_ts.
+    """
+    def __init__(self, learn=16, alpha=1.0/64, offset=None):
+        self.learn = learn
+        self.alpha = alpha
+        self.offset = offset
+        self.reset()
+
+    def reset(self):
+        self.last = None
+        self.period = 0.0
+        self.steps = []
+        self.count = 0
+        self.expected = 0
+        self.gap_cnt = 0
+        self.dup_cnt = 0
+        self.reorder_cnt = 0
+        self.bursts = {}
+        self.burst = 0
+
+    @property
+    def missing_cnt(self):
+        return max(0, self.expected - self.count)
+
+    def endGap(self, refill):
+        """
+        Close the burst of the step before, one shorter if refill.
+        """
+        burst = self.burst
+        self.burst = 0
+        if refill:
+            bursts = self.bursts
+            bursts[burst] -= 1
+            if burst > 1:
+                bursts[burst-1] = bursts.get(burst-1, 0) + 1
+            else:
+                self.gap_cnt -= 1
+
+    def add(self, ts):
+        last = self.last
+        if last is None:
+            self.last = ts
+            self.count = self.expected = 1
+            return
+        # ts_delta inlined, this is per packet
+        step = (ts - last) & MASK
+        if step >= HALF:
+            step -= WRAP
+        if step <= 0:
+            if step == 0:
+                self.dup_cnt += 1
+                return
+            if step < -RESET_JUMP:
+                # the node clock was set back, start over from ts
+                self.count += 1
+                self.expected += 1
+                self.last = ts
+                if self.burst:
+                    self.endGap(False)
+                return
+            self.count += 1
+            self.reorder_cnt += 1
+            if self.burst:
+                self.endGap(True)
+            return
+        self.count += 1
+        self.last = ts
+        period = self.period
+        if not period:
+            self.expected += 1
+            self.steps.append(step)
+            if len(self.steps) >= self.learn:
+                self.period = float(sorted(self.steps)[len(self.steps)//2])
+                self.steps = []
+            return
+        k = int(step/period + 0.5)
+        self.expected += k
+        if self.burst:
+            self.endGap(k == 0)
+        if k == 1:
+            self.period = period + self.alpha*(step - period)
+        elif k > 1:
+            self.gap_cnt += 1
+            self.burst = k-1
+            self.bursts[k-1] = self.bursts.get(k-1, 0) + 1
+
+    def summary(self):
+        expected = max(self.expected, 1)
+        bursts = [b for b, n in self.bursts.iteritems() if n > 0]
+        return {'expected':self.expected, 'received':self.count,
+                'missing':self.missing_cnt,
+                'loss':float(self.missing_cnt)/expected,
+                'gaps':self.gap_cnt, 'dups':self.dup_cnt,
+                'reordered':self.reorder_cnt, 'period':self.period,
+                'max_burst':max(bursts) if bursts else 0}
+
+def format_summary(name, s):
+    return ('{} loss {loss:.2%} ({missing}/{expected}) gaps {gaps} '
+            'max burst {max_burst} dups {dups} reordered {reordered} '
+            'period {period:.0f}us').format(name, **s)
+
+class LossTracker(object):
+    """
+    A GapCounter per node address and message code, made by counter()
+    the first time a stream is seen.
+    """
+    def __init__(self, names=None):
+        self.names = names or {}
+        self.counters = {}
+
+    def reset(self):
+        self.counters.clear()
+
+    def counter(self, addr, code):
+        counter = self.counters[(addr, code)] = GapCounter(
+                offset=ADC_TS_OFFSETS.get(code))
+        return counter
+
+    def name(self, addr):
+        return self.names.get(addr, '{}:{}'.format(*addr))
+
+    def totals(self):
+        counters = self.counters.values()
+        return {'rx_gap_cnt':sum(c.gap_cnt for c in counters),
+                'rx_missing_cnt':sum(c.missing_cnt for c in counters),
+                'rx_dup_cnt':sum(c.dup_cnt for c in counters),
+                'rx_reorder_cnt':sum(c.reorder_cnt for c in counters)}
+
+    def brief(self):
+        """
+        One line per node: loss over all its streams and the longest
+        burst.
+        """
+        nodes = {}
+        for (addr, code), counter in self.counters.iteritems():
+            s = counter.summary()
+            n = nodes.setdefault(addr, [0, 0, 0, 0])
+            n[0] += s['missing']
+            n[1] += s['expected']
+            n[2] += s['gaps']
+            n[3] = max(n[3], s['max_burst'])
+        return '\n'.join('{} loss {:.2%} gaps {} max burst {}'.format(
+            self.name(addr), float(missing)/max(expected, 1), gaps, burst)
+            for addr, (missing, expected, gaps, burst)
+            in sorted(nodes.iteritems()))
+
+    def report(self):
+        return '\n'.join(format_summary('{} 0x{:02x}'.format(
+            self.name(addr), code), counter.summary())
+            for (addr, code), counter in sorted(self.counters.iteritems()))
+
+    def records(self):
+        """
+        A CODE_LOSS_STATS record per stream, for the recording.
+        """
+        result = []
+        for (addr, code), counter in sorted(self.counters.iteritems()):
+            s = counter.summary()
+            result.append(packCODE_LOSS_STATS.pack(CODE_LOSS_STATS, addr[1],
+                code, s['expected'], s['received'], s['gaps'], s['dups'],
+                s['reordered'], int(s['period']), min(s['max_burst'], 0xffff)))
+        return result
+
+def segment_stats(ts):
+    """
+    GapCounter.summary() of one unbroken stream of 31-bit stamps at
+    once. The period is the median step over the stream rather than
+    learnt as it goes, so it counts from the first stamp on.
+    """
+    ts = np.asarray(ts, dtype=np.int64)
+    n = len(ts)
+    if n < 2:
+        return {'expected':n, 'received':n, 'missing':0, 'loss':0.0,
+                'gaps':0, 'dups':0, 'reordered':0, 'period':0.0,
+                'max_burst':0}
+    u = unwrap(ts)
+    top = np.maximum.accumulate(u)
+    step = u[1:] - top[:-1]
+    fwd = step > 0
+    late = step < 0
+    dups = int((step == 0).sum())
+    period = float(np.median(step[fwd])) if fwd.any() else 0.0
+    k = np.zeros(n-1, dtype=np.int64)
+    if period:
+        k[fwd] = np.floor(step[fwd]/period + 0.5).astype(np.int64)
+    expected = 1 + int(k.sum())
+    received = n - dups
+    # a burst is one shorter if the next stamp is early or late
+    refill = np.zeros(n-1, dtype=np.int64)
+    refill[:-1] = (fwd[1:] & (k[1:] == 0)) | late[1:]
+    burst = np.where(k > 1, k - 1 - refill, 0)
+    missing = max(0, expected - received)
+    return {'expected':expected, 'received':received, 'missing':missing,
+            'loss':float(missing)/expected, 'gaps':int((burst > 0).sum()),
+            'dups':dups, 'reordered':int(late.sum()), 'period':period,
+            'max_burst':int(burst.max())}
+
+def split_stream(ts, starts=()):
+    """
+    ts cut before the indices starts and wherever a stamp is more than
+    RESET_JUMP behind the one before, without empty pieces.
+    """
+    ts = np.asarray(ts, dtype=np.int64)
+    jumps = np.flatnonzero(ts_delta(ts[1:], ts[:-1]) < -RESET_JUMP) + 1
+    cuts = np.union1d(np.asarray(starts, dtype=np.int64), jumps)
+    return [p for p in np.split(ts, cuts[(cuts > 0) & (cuts < len(ts))])
+            if len(p)]
+
+def gap_stats(ts, starts=()):
+    """
+    segment_stats of each piece of split_stream(ts, starts), summed; the
+    period is that of the piece with the most stamps.
+    """
+    pieces = [segment_stats(p) for p in split_stream(ts, starts)] or \
+            [segment_stats(ts)]
+    result = dict((key, sum(p[key] for p in pieces)) for key in
+            ('expected', 'received', 'missing', 'gaps', 'dups', 'reordered'))
+    result['loss'] = float(result['missing'])/max(result['expected'], 1)
+    result['period'] = max(pieces, key=lambda p: p['received'])['period']
+    result['max_burst'] = max(p['max_burst'] for p in pieces)
+    return result
+
+def read_streams(filename):
+    """
+    The stamps of each stream of a .rec file, as a dict of (port, code)
+    to an int64 array, ts_ADC where the packets have it, else gen_ts,
+    and the indices in it of the first stamps after each CODE_TIMEBASE
+    record.
+    """
+    with recparse.map_file(filename) as buf:
+        offsets, lengths = recparse.index_records(buf)
+        data = np.frombuffer(buf, dtype=np.uint8)
+        # only the port of every header, gen_ts where it is needed
+        ports = recparse.gather_records(data, offsets-HDR_PORT,
+                np.dtype('>u2'))
+        codes = data[offsets]
+        resets = np.flatnonzero((ports == 0) & (codes == CODE_TIMEBASE)
+                & (lengths == packCODE_TIMEBASE.size))
+        result = {}
+        for port in np.unique(ports[ports != 0]):
+            for code in np.unique(codes[ports == port]):
+                sel = np.flatnonzero((ports == port) & (codes == code))
+                offset = ADC_TS_OFFSETS.get(int(code))
+                if offset is None:
+                    ts = recparse.gather_records(data, offsets[sel]-HDR_GEN_TS,
+                            np.dtype('>u4'))
+                else:
+                    sel = sel[lengths[sel] >= offset+4]
+                    ts = recparse.gather_records(data, offsets[sel]+offset,
+                            np.dtype('>u4')) & MASK
+                result[(int(port), int(code))] = (ts.astype(np.int64),
+                        np.searchsorted(sel, resets))
+    return result
+
+def analyze_file(filename):
+    """
+    gap_stats of every stream of a .rec file, by (port, code), cut at
+    the T0 resets.
+    """
+    return dict((key, gap_stats(ts, starts))
+            for key, (ts, starts) in read_streams(filename).iteritems())
+
+def read_loss_records(filename):
+    """
+    The CODE_LOSS_STATS records saved live in a .rec file, in order, as
+    a structured array.
+    """
+    with recparse.map_file(filename) as buf:
+        offsets, lengths = recparse.index_records(buf)
+        data = np.frombuffer(buf, dtype=np.uint8)
+        sel = np.flatnonzero((lengths == packCODE_LOSS_STATS.size)
+                & (data[offsets] == CODE_LOSS_STATS))
+        return recparse.gather_records(data, offsets[sel], np.dtype([
+            ('Id', 'u1'), ('port', '>u2'), ('code', 'u1'),
+            ('expected', '>u4'), ('received', '>u4'), ('gaps', '>u4'),
+            ('dups', '>u4'), ('reordered', '>u4'), ('period', '>u4'),
+            ('max_burst', '>u2')]))
+
+if __name__ == '__main__' :
+    parser = argparse.ArgumentParser(
+        prog='LossStats',
+        description='packet loss of each node and code in rec data files')
+    parser.add_argument('filenames', metavar='file',
+            nargs='+', help='data filename')
+    args = parser.parse_args()
+    for filename in args.filenames:
+        print filename
+        for (port, code), s in sorted(analyze_file(filename).iteritems()):
+            print format_summary('  {} 0x{:02x}'.format(port, code), s)
@@ -24,8 +24,22 @@ License along with this library.
 
 import socket
 import struct
+import threading
+
+from ExpData import MATLAB_STATE
+from LatencyStats import LatencyHistogram
+from Timebase import clock
 
 class MatlabLink(object):
+    """
+    Serves the Simulink UDP link on its own thread: every command is
+    sent to the servos, answered with the current state, and only then
+    recorded. The rx to XBee sends and rx to reply times are kept in
+    two latency histograms. The reply is a snapshot of the ExpData
+    state taken under its lock, and the histograms are updated and read
+    under self.lock, as getLatency is called from the GUI message
+    thread.
+    """
     def __init__(self, parent, ports):
         self.parent = parent
         self.expData = parent.expData
@@ -36,8 +50,7 @@ class MatlabLink(object):
 
         self.rx_udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.rx_udp.bind((self.host,local_port))
-        self.rx_udp.setblocking(0)
-        self.socklist = [self.rx_udp]
+        self.rx_udp.settimeout(0.2)
 
         self.tx_udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.tx_udp.bind((self.host,remote_port))
@@ -45,30 +58,76 @@ class MatlabLink(object):
         self.tx_udp.setblocking(0)
 
         self.rx_pack = struct.Struct(">d4d3d")
+        self.rx_buf = bytearray(1000)
         self.tx_pack = struct.Struct(">20d")
+        self.tx_buf = bytearray(self.tx_pack.size)
+
+        self.send_latency = LatencyHistogram()
+        self.reply_latency = LatencyHistogram()
+        self.bad_cnt = 0
+        self.lock = threading.Lock()
+
+        self.running = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
 
     def getReadList(self):
-        return self.socklist
+        # the link thread reads its own socket
+        return []
+
+    def start(self):
+        self.running = True
+        self.thread.start()
 
-    def read(self, rlist, recv_ts):
-        if self.rx_udp in rlist:
+    def stop(self):
+        self.running = False
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def run(self):
+        recvfrom_into = self.rx_udp.recvfrom_into
+        rx_buf = self.rx_buf
+        while self.running:
+            try:
+                size, address = recvfrom_into(rx_buf)
+            except socket.timeout:
+                continue
+            except socket.error as e:
+                self.log.error('Matlab link: {}'.format(e))
+                continue
+            t_rx = clock()
+            if size != self.rx_pack.size:
+                with self.lock:
+                    self.bad_cnt += 1
+                self.log.warning('Matlab link: {} bytes packet from {} '
+                        'ignored'.format(size, address))
+                continue
             try:
-                (dat,address)=self.rx_udp.recvfrom(1000)
-                time_token, da, dea, de, dr, da_cmp, de_cmp, dr_cmp \
-                        = self.rx_pack.unpack(dat)
-                self.expData.sendCommand(time_token, da, dea, de, dr,
-                        da_cmp, de_cmp, dr_cmp)
-                exp = self.expData
-                data = self.tx_pack.pack(exp.ACM_CmdTime,
-                        exp.GX, exp.GY, exp.GZ, exp.AX, exp.AY,
-                        exp.AZ, exp.ACM_roll_filtered, exp.ACM_roll_rate,
-                        exp.ACM_pitch_filtered, exp.ACM_pitch_rate,
-                        exp.ACM_yaw_filtered, exp.ACM_yaw_rate,
-                        exp.RigRollPosFiltered, exp.RigRollPosRate,
-                        exp.RigPitchPosFiltered, exp.RigPitchPosRate,
-                        exp.RigYawPosFiltered, exp.RigYawPosRate,
-                        exp.Vel)
-                self.tx_udp.sendall(data)
-            except:
-                pass
+                self.reply(t_rx)
+            except Exception as e:
+                self.log.error('Matlab link: {}'.format(e))
+
+    def reply(self, t_rx):
+        expData = self.expData
+        cmd = self.rx_pack.unpack_from(self.rx_buf)
+        ts = expData.sendServoCommands(*cmd)
+        t_sent = clock()
+        self.tx_pack.pack_into(self.tx_buf, 0,
+                *expData.snapshot(MATLAB_STATE))
+        self.tx_udp.send(self.tx_buf)
+        t_reply = clock()
+        expData.recordCommand(*(ts + cmd[1:]))
+        with self.lock:
+            self.send_latency.add((t_sent-t_rx)*1e6)
+            self.reply_latency.add((t_reply-t_rx)*1e6)
 
+    def getLatency(self, reset=False):
+        with self.lock:
+            text = '\n'.join((self.send_latency.format('Matlab rx->XBee tx'),
+                self.reply_latency.format('Matlab rx->reply'),
+                'Matlab bad packets {}'.format(self.bad_cnt)))
+            if reset:
+                self.send_latency.reset()
+                self.reply_latency.reset()
+                self.bad_cnt = 0
+        return text
@@ -23,12 +23,16 @@ License along with this library.
 """
 
 import struct, math, time, traceback
-import select
 import Queue, threading
 import logging
+from ConfigParser import SafeConfigParser
 
 from MessageFuncs import process_funcs
 from ExpData import ExpData
+from Recorder import Recorder
+from ChunkFile import ChunkWriter
+from SocketPoller import SocketPoller
+from Timebase import Timebase, clock
 
 class RedirectText(object):
     def __init__(self, msg_queue):
@@ -42,15 +46,27 @@ class RedirectText(object):
             pass
 
 class Worker(object):
-    def __init__(self, gui2msgcQueue, msgc2guiQueue):
+    def __init__(self, gui2msgcQueue, msgc2guiQueue, state_ring=None):
         self.gui2msgcQueue = gui2msgcQueue
         self.msgc2guiQueue = msgc2guiQueue
         self.socklist = []
-        self.writing = False
-        self.fileALL = None
-        self.packHdr = struct.Struct(">B3I2H")
-        self.expData = ExpData(self, msgc2guiQueue)
+        self.parser = SafeConfigParser()
+        self.parser.read('config.ini')
+        self.recorder = Recorder(**self.getRecorderOptions())
+        self.chunk_recorder = Recorder(**self.getRecorderOptions())
+        self.chunk_writer = None
+        # save() goes to both outputs or neither
+        self.rec_lock = threading.Lock()
+        self.recording = False
+        self.expData = ExpData(self, msgc2guiQueue, self.parser)
+        self.expData.state_ring = state_ring
+        self.timebase = Timebase()
         self.max_dt = 0
+        # held while packets are dispatched, by MainLoop and Replay
+        self.rx_lock = threading.Lock()
+        self.max_batch = 64
+        if self.parser.has_option('net', 'max_batch'):
+            self.max_batch = self.parser.getint('net', 'max_batch')
 
         #logging
         self.log = logging.getLogger(__name__)
@@ -65,6 +81,14 @@ class Worker(object):
         self.msg_thread.daemon = True
         self.msg_thread.start()
 
+    def getRecorderOptions(self):
+        options = {}
+        for name, conv in (('buffer_size', int), ('batch_size', int),
+                ('interval', float), ('fsync', float)):
+            if self.parser.has_option('rec', name):
+                options[name] = conv(self.parser.get('rec', name))
+        return options
+
     def processGUImsg(self):
         while self.msg_thread_running:
             try:
@@ -82,35 +106,79 @@ class Worker(object):
             self.log.info('Waiting for start...')
 
         self.log.info('Started.')
+        poller = SocketPoller(self.socklist)
         while self.main_thread_running:
-            rlist,wlist,elist=select.select(self.socklist,[],[],0.2)
-            if rlist:
-                t_s = time.clock()
-                recv_ts = int((t_s-self.T0)*1e6)&0x7fffffff
-                self.xbee_network.read(rlist, recv_ts)
-                self.matlab_link.read(rlist, recv_ts)
-                dt = time.clock()-t_s
-                if dt > self.max_dt:
-                    self.max_dt = dt
-                    self.log.info('MainLoop Max DT={:.3f}'.format(dt))
+            rlist = poller.poll(0.2)
+            with self.rx_lock:
+                self.xbee_network.clock_sync.tick()
+                if rlist:
+                    t_s = clock()
+                    self.xbee_network.read(rlist)
+                    dt = clock()-t_s
+                    if dt > self.max_dt:
+                        self.max_dt = dt
+                        self.log.info('MainLoop Max DT={:.3f}'.format(dt))
+        poller.close()
+        if self.ready:
+            self.matlab_link.stop()
+            self.xbee_network.close()
         self.log.info('Work end.')
-        if self.fileALL:
-            self.fileALL.close()
-            self.log.info('Stop Recording to {}.'.format(self.filename))
-            self.fileALL = None
+        if self.recorder.isRecording():
+            self.stopRecording()
+
+    def startRecording(self, filename):
+        self.recorder.start(filename)
+        self.log.info('Recording to {}.'.format(filename))
+        chunk_writer = None
+        if self.parser.has_option('rec', 'chunk_records') :
+            self.chunk_recorder.start(filename+'.crf')
+            chunk_writer = ChunkWriter(self.chunk_recorder,
+                    self.parser.getint('rec', 'chunk_records'))
+            self.log.info('Recording chunks to {}.'.format(
+                self.chunk_recorder.filename))
+        with self.rec_lock:
+            self.chunk_writer = chunk_writer
+            self.recording = True
+        self.saveTimebase()
+
+    def saveTimebase(self):
+        """
+        Record the wall clock time of T0, for read_timebase.
+        """
+        ts = self.timebase.ticks()
+        self.save(self.timebase.record(), ts, ts, ts, ('', 0))
+
+    def stopRecording(self):
+        """
+        Stop taking packets into both outputs at once, then close the
+        .rec and the chunk file, so the .crf holds exactly the packets
+        of the .rec.
+        """
+        with self.rec_lock:
+            self.recording = False
+            chunk_writer, self.chunk_writer = self.chunk_writer, None
+        self.recorder.stop()
+        if chunk_writer:
+            chunk_writer.close()
+            self.chunk_recorder.stop()
+        self.log.info('Stop Recording to {}. {rec_bcnt} bytes written, '
+                '{rec_drop_cnt} packets/{rec_drop_bcnt} bytes dropped, '
+                'max backlog {rec_max_backlog} bytes.'.format(
+                    self.recorder.filename, **self.recorder.getStatistics()))
 
     def save(self,rf_data, gen_ts, sent_ts, recv_ts, addr):
-        if self.fileALL:
-            head = self.packHdr.pack(0x7e, gen_ts, sent_ts, recv_ts, addr[1],len(rf_data))
-            self.writing = True
-            self.fileALL.write(head)
-            self.fileALL.write(rf_data)
-            self.writing = False
-
-def worker(gui2msgcQueue, msgc2guiQueue):
+        with self.rec_lock:
+            if not self.recording:
+                return
+            self.recorder.save(rf_data, gen_ts, sent_ts, recv_ts, addr)
+            if self.chunk_writer:
+                self.chunk_writer.save(rf_data, gen_ts, sent_ts, recv_ts,
+                        addr)
+
+def worker(gui2msgcQueue, msgc2guiQueue, state_ring=None):
     """
     Worker process to manage all messages
     """
-    w = Worker(gui2msgcQueue, msgc2guiQueue)
+    w = Worker(gui2msgcQueue, msgc2guiQueue, state_ring)
     w.MainLoop()
 
@@ -22,10 +22,11 @@ You should have received a copy of the GNU Lesser General Public
 License along with this library.
 """
 
-import struct, math, time, traceback
+import struct, math, traceback
 
 from MatlabLink import MatlabLink
 from XBeeWifiNetwork import XBeeNetwork
+from Replay import Replay
 
 def msg_start(self, cmd):
     if not self.ready:
@@ -38,32 +39,32 @@ def msg_start(self, cmd):
         self.socklist += self.xbee_network.getReadList()
         self.matlab_link = MatlabLink(self, cmd['matlab_ports'])
         self.socklist += self.matlab_link.getReadList()
-        self.T0 = time.clock()
+        self.timebase.reset()
         self.ready = True
         self.expData.xbee_network = self.xbee_network
         self.expData.ACM_node = self.node_addr['ACM']
         self.expData.CMP_node = self.node_addr['CMP']
+        self.matlab_link.start()
 
 def msg_stop(self, cmd):
     self.main_thread_running = False
     self.msg_thread_running = False
 
 def cmd_rec_start(self, cmd):
-    self.filename = cmd['filename']
-    self.fileALL = open(self.filename, 'wb')
-    self.log.info('Recording to {}.'.format(self.filename))
+    if self.recorder.isRecording():
+        self.stopRecording()
+    self.startRecording(cmd['filename'])
 
 def cmd_rec_stop(self, cmd):
-    if self.fileALL:
-        while self.writing :
-            pass
-        a = self.fileALL
-        self.fileALL = None
-        a.close()
-        self.log.info('Stop Recording to {}.'.format(self.filename))
+    if self.recorder.isRecording():
+        self.stopRecording()
 
 def cmd_set_base_time(self, cmd):
-    self.T0 = time.clock()
+    self.timebase.reset()
+    if self.ready:
+        self.xbee_network.clock_sync.reset()
+    if self.recorder.isRecording():
+        self.saveTimebase()
     self.log.info('Reset T0')
 
 def cmd_at(self, cmd):
@@ -87,8 +88,10 @@ def cmd_at(self, cmd):
         command, parameter, frame_id=1, options=options)
 
 def cmd_ntp(self, cmd):
-    remote_host = cmd['target']
-    self.log.info('TODO')
+    target = cmd['target']
+    clock_sync = self.xbee_network.clock_sync
+    self.log.info(clock_sync.clock(target).format(target))
+    clock_sync.poll(self.node_addr[target])
 
 def cmd_command(self, cmd):
     da = cmd['da']
@@ -100,7 +103,7 @@ def cmd_command(self, cmd):
     self.expData.sendCommand(0, da, de, dr, da_cmp, de_cmp, dr_cmp)
 
 def cmd_clear(self, cmd):
-    self.xbee_network.arrv_cnt = -1
+    self.xbee_network.clearStatistics()
     self.max_dt = 0
 
 def cmd_A5(self, cmd):
@@ -113,6 +116,32 @@ def cmd_A5(self, cmd):
 def cmd_reset_rig(self, cmd):
     self.expData.resetRigAngel()
 
+def cmd_replay(self, cmd):
+    if not self.ready:
+        self.log.info('Start before replaying.')
+        return
+    cmd_replay_stop(self, cmd)
+    # recorded with this setup, so the node ports tell the nodes apart
+    self.replay = Replay(self.xbee_network, cmd['filename'],
+            cmd.get('speed', 1.0),
+            addrs=[(addr[1], addr) for addr in self.node_addr.itervalues()],
+            lock=self.rx_lock)
+    self.replay.start()
+    self.log.info('Replaying {} at speed {}.'.format(cmd['filename'],
+        cmd.get('speed', 1.0)))
+
+def cmd_replay_stop(self, cmd):
+    replay = getattr(self, 'replay', None)
+    if replay is not None:
+        self.replay = None
+        replay.stop()
+        self.log.info('Replayed {replay_datagram_cnt} datagrams in '
+                '{replay_elapsed:.2f}s.'.format(**replay.getStatistics()))
+
+def cmd_matlab_latency(self, cmd):
+    if self.ready:
+        self.log.info(self.matlab_link.getLatency(cmd.get('reset', False)))
+
 process_funcs = {'START':msg_start,
     'STOP':msg_stop,
     'REC_START':cmd_rec_start,
@@ -124,4 +153,7 @@ process_funcs = {'START':msg_start,
     'CLEAR':cmd_clear,
     'RESET_RIG':cmd_reset_rig,
     'A5':cmd_A5,
+    'MATLAB_LATENCY':cmd_matlab_latency,
+    'REPLAY':cmd_replay,
+    'REPLAY_STOP':cmd_replay_stop,
     }
@@ -0,0 +1,304 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+"""
+XBee node simulator in Python
+----------------------------------------
+
+Author: Zheng GONG(matthewzhenggong@gmail.com)
+
+This file is part of FIWT.
+
+FIWT is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 3.0 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library.
+
+Stands in for the GND, ACM and CMP boards on local addresses. Every
+node binds its own ip at its port and at 0xBEE, sends framed packets
+to the AP at its port, follows the A5/A6 servo commands it gets, and
+answers remote AT commands. On Linux any 127.x.y.z address is local,
+so the defaults put the nodes on 127.0.0.2-4 next to an AP on
+127.0.0.1 with the GUI's default ports.
+"""
+
+import argparse
+import heapq
+import math
+import random
+import select
+import socket
+import struct
+import time
+
+import PayloadPackage
+import XBeeMessageFuncs as msg
+
+AT_HEADER = struct.Struct('!2H4B')
+AT_RESPONSE = AT_HEADER.pack(0x4242, 0x0000, 0x00, 0x00, 0x82, 0x00)
+SERVO_CMD = struct.Struct('>BfB6H')
+
+# message code -> default rate in Hz, per node kind
+NODE_STREAMS = {
+    'GND': ((msg.CODE_GNDBOARD_ADCM_READ, 200.0),
+            (msg.CODE_GNDBOARD_MANI_READ, 2.0),
+            (msg.CODE_GNDBOARD_STATS, 1.0)),
+    'ACM': ((msg.CODE_AC_MODEL_SERVO_POS, 200.0),
+            (msg.CODE_AC_MODEL_STATS, 1.0)),
+    'CMP': ((msg.CODE_AEROCOMP_SERVO_POS, 200.0),
+            (msg.CODE_AEROCOMP_STATS, 1.0)),
+    }
+DEFAULT_NODES = ['GND:127.0.0.2:9750', 'ACM:127.0.0.3:8807',
+        'CMP:127.0.0.4:9847']
+
+def int16(v):
+    return ((int(v)+0x8000) & 0xffff) - 0x8000
+
+class SimNode(object):
+    def __init__(self, kind, ip, port, ap, rate_scale=1.0, clock_offset=0,
+            drift=0.0):
+        self.kind = kind
+        self.ip = ip
+        self.port = port
+        self.ap_addr = (ap, port)
+        self.clock_offset = clock_offset
+        self.clock_rate = 1e6*(1.0+drift)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((ip, port))
+        self.sock.setblocking(0)
+        self.at_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.at_sock.bind((ip, 0xBEE))
+        self.at_sock.setblocking(0)
+        self.streams = [(code, rate*rate_scale)
+                for code, rate in NODE_STREAMS[kind]]
+        self.servo_cmd = [2048]*6
+        self.servo_pos = [2048.0]*6
+        self.cmd_time = 0.0
+        self.cmd_cnt = 0
+        self.ntp_cnt = 0
+        self.at_cnt = 0
+        self.registers = {'MY':socket.inet_aton(ip),
+                'C0':struct.pack('>H', port),
+                'DL':socket.inet_aton(ap)}
+        self.t0 = time.time()
+
+    def clock(self):
+        return int((time.time()-self.t0)*self.clock_rate + self.clock_offset) \
+                & 0x7fffffff
+
+    def payload(self, code):
+        ts = self.clock()
+        t = ts*1e-6
+        wave = int(1000*math.sin(t))
+        if code == msg.CODE_AC_MODEL_SERVO_POS or \
+                code == msg.CODE_AEROCOMP_SERVO_POS:
+            n = 6 if code == msg.CODE_AC_MODEL_SERVO_POS else 4
+            pos = self.servo_pos
+            for i in xrange(n):
+                pos[i] += 0.2*(self.servo_cmd[i]-pos[i])
+            servo = [int(i) & 0xffff for i in pos[:n]]
+            ctrl = [int16(self.servo_cmd[i]-pos[i]) for i in xrange(n)]
+            ref = [int16(i) for i in self.servo_cmd[:n]]
+            if code == msg.CODE_AC_MODEL_SERVO_POS:
+                return msg.packCODE_AC_MODEL_SERVO_POS.pack(code,
+                        *(servo + [8192+wave, 8192, 8192, wave, 0, 0, 0, 0,
+                            4096, ts] + ctrl + ref
+                            + [self.cmd_time]))
+            return msg.packCODE_AEROCOMP_SERVO_POS.pack(code,
+                    *(servo + [8192+wave, 8192, 8192, 8192, ts] + ctrl
+                        + ref + [self.cmd_time]))
+        elif code == msg.CODE_GNDBOARD_ADCM_READ:
+            return msg.packCODE_GNDBOARD_ADCM_READ.pack(code, 2048+wave,
+                    2048, 2048, 2048, 100*wave, wave, -wave, ts)
+        elif code == msg.CODE_GNDBOARD_MANI_READ:
+            return msg.packCODE_GNDBOARD_MANI_READ.pack(code, 20.0, 250.0)
+        elif code == msg.CODE_GNDBOARD_STATS:
+            return msg.packCODE_GNDBOARD_STATS.pack(code, 0, 0, 10, 10, 10)
+        return msg.packCODE_AC_MODEL_STATS.pack(code, 0, 0, 120, 120, 120,
+                10, 10, 10)
+
+    def datagram(self, payloads):
+        frames = [PayloadPackage.pack(p, self.clock()) for p in payloads]
+        return PayloadPackage.packs(self.clock(), *frames)
+
+    def receive(self):
+        """
+        Take A5/A6 servo commands, the servo positions follow them, and
+        answer clock sync requests.
+        """
+        for data, address in self.drain(self.sock):
+            rx_ts = self.clock()
+            unpacked = PayloadPackage.unpack(data)
+            if not unpacked:
+                continue
+            for gen_ts, rf_data in unpacked[0]:
+                if ord(rf_data[0]) == msg.CODE_NTP_REQUEST:
+                    Id, token = msg.packCODE_NTP_REQUEST.unpack(rf_data)
+                    self.sock.sendto(self.datagram([
+                        msg.packCODE_NTP_RESPONSE.pack(msg.CODE_NTP_RESPONSE,
+                            token, unpacked[1], rx_ts)]), address)
+                    self.ntp_cnt += 1
+                elif ord(rf_data[0]) in (msg.CODE_AC_MODEL_SERV_CMD,
+                        msg.CODE_AEROCOMP_SERV_CMD) \
+                        and len(rf_data) == SERVO_CMD.size:
+                    v = SERVO_CMD.unpack(rf_data)
+                    self.cmd_time = v[1]
+                    self.servo_cmd = list(v[3:])
+                    self.cmd_cnt += 1
+
+    def answerAT(self):
+        for data, address in self.drain(self.at_sock):
+            if len(data) < AT_HEADER.size + 4 or \
+                    AT_HEADER.unpack_from(data)[4] != 0x02:
+                continue
+            body = data[AT_HEADER.size:]
+            frame_id, command, parameter = body[0], body[2:4], body[4:]
+            if parameter:
+                self.registers[command] = parameter
+            value = '' if parameter else self.registers.get(command, '\x00')
+            self.at_sock.sendto(AT_RESPONSE + frame_id + command + '\x00'
+                    + value, address)
+            self.at_cnt += 1
+
+    @staticmethod
+    def drain(sock):
+        while True:
+            try:
+                yield sock.recvfrom(1500)
+            except socket.error:
+                return
+
+class Simulator(object):
+    """
+    Emits the streams of all nodes from one loop; each datagram may be
+    lost (loss), held back behind the next one of the node (reorder),
+    or delayed by up to jitter seconds.
+    """
+    def __init__(self, nodes, frames=1, loss=0.0, reorder=0.0, jitter=0.0):
+        self.nodes = nodes
+        self.frames = frames
+        self.loss = loss
+        self.reorder = reorder
+        self.jitter = jitter
+        self.sent_cnt = 0
+        self.lost_cnt = 0
+        self.reorder_cnt = 0
+        self.held = {}
+        self.delayed = []
+        self.socks = {}
+        for node in nodes:
+            self.socks[node.sock] = node.receive
+            self.socks[node.at_sock] = node.answerAT
+
+    def emit(self, node, data, now):
+        if random.random() < self.loss:
+            self.lost_cnt += 1
+            return
+        held = self.held.pop(node, None)
+        if held is None and random.random() < self.reorder:
+            self.held[node] = data
+            self.reorder_cnt += 1
+            return
+        for d in (data, held):
+            if d is None:
+                continue
+            if self.jitter:
+                heapq.heappush(self.delayed,
+                        (now + random.random()*self.jitter, d, node))
+            else:
+                self.send(node, d)
+
+    def send(self, node, data):
+        try:
+            node.sock.sendto(data, node.ap_addr)
+            self.sent_cnt += 1
+        except socket.error:
+            self.lost_cnt += 1
+
+    def run(self, duration=None, report=1.0):
+        now = time.time()
+        end = now + duration if duration else None
+        due = []
+        for node in self.nodes:
+            for code, rate in node.streams:
+                if rate > 0:
+                    heapq.heappush(due, (now, 1.0/rate, code, node))
+        pending = dict((node, []) for node in self.nodes)
+        next_report = now + report
+        last_sent = 0
+        while end is None or now < end:
+            while due and due[0][0] <= now:
+                t, period, code, node = heapq.heappop(due)
+                frames = pending[node]
+                frames.append(node.payload(code))
+                if len(frames) >= self.frames or period >= 0.1:
+                    self.emit(node, node.datagram(frames), now)
+                    del frames[:]
+                # do not try to catch up after a stall
+                heapq.heappush(due, (max(t + period, now - period), period,
+                    code, node))
+            while self.delayed and self.delayed[0][0] <= now:
+                t, data, node = heapq.heappop(self.delayed)
+                self.send(node, data)
+            if now >= next_report:
+                print '{:.0f} datagrams/s sent, {} lost, {} reordered, ' \
+                        'cmds {}, NTP {}, AT {}'.format(
+                        (self.sent_cnt-last_sent)/report, self.lost_cnt,
+                        self.reorder_cnt,
+                        '/'.join(str(n.cmd_cnt) for n in self.nodes),
+                        '/'.join(str(n.ntp_cnt) for n in self.nodes),
+                        '/'.join(str(n.at_cnt) for n in self.nodes))
+                last_sent = self.sent_cnt
+                next_report += report
+            timeout = min([due[0][0] if due else now + 0.1,
+                self.delayed[0][0] if self.delayed else now + 0.1,
+                next_report]) - time.time()
+            if timeout > 0:
+                rlist = select.select(self.socks.keys(), [], [], timeout)[0]
+                for sock in rlist:
+                    self.socks[sock]()
+            now = time.time()
+
+if __name__ == '__main__' :
+    parser = argparse.ArgumentParser(
+        prog='NodeSimulator',
+        description='simulate XBee nodes on local addresses')
+    parser.add_argument('-n', '--node', action='append',
+            help='KIND:IP:PORT with KIND in GND, ACM, CMP (repeatable); '
+            'default ' + ' '.join(DEFAULT_NODES))
+    parser.add_argument('-a', '--ap', default='127.0.0.1',
+            help='AP address')
+    parser.add_argument('-r', '--rate', type=float, default=1.0,
+            help='scale all stream rates by this factor')
+    parser.add_argument('-f', '--frames', type=int, default=1,
+            help='frames per datagram')
+    parser.add_argument('--loss', type=float, default=0.0,
+            help='datagram loss probability')
+    parser.add_argument('--reorder', type=float, default=0.0,
+            help='probability a datagram is held back behind the next one')
+    parser.add_argument('--jitter', type=float, default=0.0,
+            help='max random delay per datagram in ms')
+    parser.add_argument('--drift', type=float, default=0.0,
+            help='max node clock drift in ppm')
+    parser.add_argument('-t', '--time', type=float,
+            help='run for this many seconds')
+    args = parser.parse_args()
+    nodes = []
+    for spec in args.node or DEFAULT_NODES:
+        kind, ip, port = spec.split(':')
+        nodes.append(SimNode(kind.upper(), ip, int(port), args.ap, args.rate,
+            clock_offset=random.randint(0, 1<<29),
+            drift=random.uniform(-args.drift, args.drift)*1e-6))
+    simulator = Simulator(nodes, args.frames, args.loss, args.reorder,
+            args.jitter*1e-3)
+    try:
+        simulator.run(args.time)
+    except KeyboardInterrupt:
+        pass
@@ -22,6 +22,7 @@ You should have received a copy of the GNU Lesser General Public
 License along with this library.
 """
 
+import re
 import struct
 
 MSG_DILIMITER = '\x9E' #0x80+0x1E(RS)
@@ -29,40 +30,80 @@ MSG_ESC = '\x9B'     #0x80+0x1B(ESC)
 ESCAPE_BYTES = (MSG_DILIMITER, MSG_ESC)
 TS = struct.Struct('>I')
 
+ESCAPE_RE = re.compile('[\x9E\x9B]')
+UNESCAPE_MAP = dict((chr(i), chr(i^0x20)) for i in xrange(256))
+
+def escape(data) :
+    if ESCAPE_RE.search(data) is None:
+        return data
+    return data.replace(MSG_ESC, MSG_ESC+chr(0x20^ord(MSG_ESC))) \
+            .replace(MSG_DILIMITER, MSG_ESC+chr(0x20^ord(MSG_DILIMITER)))
+
+def unescape(data) :
+    s = data.split(MSG_ESC)
+    return ''.join([s[0]]+[UNESCAPE_MAP[i[0]]+i[1:] for i in s[1:]])
 
 def unpack(data) :
-    packs = []
-    group = data.split(MSG_DILIMITER)[1:]
-    for pkg in group:
-        s = pkg.split(MSG_ESC)
-        packs.append(''.join([s[0]]+[chr(ord(i[0])^0x20)+i[1:]
-            for i in s[1:]]))
+    packs = [unescape(pkg) if MSG_ESC in pkg else pkg
+            for pkg in data.split(MSG_DILIMITER)[1:]]
     if len(packs):
         last = packs[-1]
         sent_timestamp = TS.unpack(last[-4:])[0]
         packs[-1] = last[:-4]
-        packs = [(TS.unpack(i[:4])[0], i[4:]) for i in packs]
+        packs = [(TS.unpack_from(i)[0], i[4:]) for i in packs]
         return packs, sent_timestamp
     else:
         return None
 
 def pack(data, timestamp) :
-    data = TS.pack(timestamp)+data
-    return "".join([MSG_DILIMITER]+[byte if byte not in ESCAPE_BYTES
-        else MSG_ESC+chr(0x20^ord(byte)) for byte in data])
+    return MSG_DILIMITER + escape(TS.pack(timestamp)+data)
 
 def packs(timestamp,*data_list) :
-    ts = TS.pack(timestamp)
-    ts = [byte if byte not in ESCAPE_BYTES else MSG_ESC+chr(0x20^ord(byte))
-            for byte in ts]
-    ts = "".join(ts)
-    return "".join(data_list)+ts
+    return "".join(data_list)+escape(TS.pack(timestamp))
 
 if __name__ == '__main__' :
     data = '\x9E"\x9B\x00\x00\x04I\x00\x00\x00\x00\x00\x00\x1f\xff\x1f\xff\x1f\xff\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\r\x90\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
     print unpack(data)
-    print ':'.join(['{:02x}'.format(ord(i)) for i in pack('Phello')])
-    print ':'.join(['{:02x}'.format(ord(i)) for i in pack('Phello')])
+    print ':'.join(['{:02x}'.format(ord(i)) for i in pack('Phello', 1)])
+    print ':'.join(['{:02x}'.format(ord(i)) for i in pack('Phello', 0x9E)])
     print ':'.join(['{:02x}'.format(ord(i))
-        for i in packs('Phello','Phello','Phello')])
+        for i in packs(0x9E9B, pack('Phello', 1), pack('Phello', 2))])
+
+    import timeit
+    # the per-byte codec this one replaced, as the baseline
+    def unpack_py(data) :
+        packs = []
+        group = data.split(MSG_DILIMITER)[1:]
+        for pkg in group:
+            s = pkg.split(MSG_ESC)
+            packs.append(''.join([s[0]]+[chr(ord(i[0])^0x20)+i[1:]
+                for i in s[1:]]))
+        last = packs[-1]
+        sent_timestamp = TS.unpack(last[-4:])[0]
+        packs[-1] = last[:-4]
+        return [(TS.unpack(i[:4])[0], i[4:]) for i in packs], sent_timestamp
+
+    def pack_py(data, timestamp) :
+        data = TS.pack(timestamp)+data
+        return "".join([MSG_DILIMITER]+[byte if byte not in ESCAPE_BYTES
+            else MSG_ESC+chr(0x20^ord(byte)) for byte in data])
 
+    setup = ('from __main__ import pack, packs, unpack, '
+            'pack_py, unpack_py, ESCAPE_RE\n'
+            'import random\n'
+            'random.seed(0)\n'
+            'acm = "".join(chr(random.randint(0, 255)) for i in xrange(63))\n'
+            'plain = ESCAPE_RE.sub("", acm)\n'
+            'dgram = packs(123, pack(plain, 1), pack(plain, 2))\n'
+            'dgram_esc = packs(0x9E9B, pack(acm, 0x9B), pack(acm, 2))\n')
+    n = 20000
+    for name, stmt, cnt in (
+            ('pack_py', 'pack_py(acm, 0x9E9B)', 1),
+            ('pack', 'pack(acm, 0x9E9B)', 1),
+            ('pack no-escape', 'pack(plain, 1)', 1),
+            ('unpack_py', 'unpack_py(dgram_esc)', 2),
+            ('unpack', 'unpack(dgram_esc)', 2),
+            ('unpack no-escape', 'unpack(dgram)', 2),
+            ):
+        t = min(timeit.repeat(stmt, setup, number=n, repeat=3))
+        print '{:<18s} {:10.0f} frames/s'.format(name, n*cnt/t)
@@ -0,0 +1,181 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Asynchronous Recorder in Python
+----------------------------------------
+
+Author: Zheng GONG(matthewzhenggong@gmail.com)
+
+This file is part of FIWT.
+
+FIWT is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 3.0 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library.
+"""
+
+import os, struct, time, threading
+
+class Recorder(object):
+    """
+    Records packets into a preallocated ring buffer; a writer thread
+    flushes it to disk in large batches, so a slow disk never blocks
+    the receive loop. When the ring is full, packets are dropped and
+    counted instead of waiting.
+
+    fsync: 0 never, <0 after every batch, >0 at most every fsync seconds.
+    """
+    def __init__(self, buffer_size=1<<22, batch_size=1<<16, interval=0.1,
+            fsync=0):
+        self.packHdr = struct.Struct(">B3I2H")
+        self.ring = bytearray(buffer_size)
+        self.view = memoryview(self.ring)
+        self.size = buffer_size
+        self.batch_size = batch_size
+        self.interval = interval
+        self.fsync = fsync
+        self.hdr = bytearray(self.packHdr.size)
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.fileRec = None
+        self.thread = None
+        self.filename = None
+        self.resetStatistics()
+
+    def resetStatistics(self):
+        self.head = 0
+        self.tail = 0
+        self.max_backlog = 0
+        self.drop_cnt = 0
+        self.drop_bcnt = 0
+        self.written_bcnt = 0
+
+    def isRecording(self):
+        return self.fileRec is not None
+
+    def start(self, filename):
+        self.stop()
+        self.resetStatistics()
+        self.filename = filename
+        self.fileRec = open(filename, 'wb')
+        self.thread = threading.Thread(target=self.writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Flush everything still buffered, then close the file.
+        """
+        if self.fileRec is None:
+            return
+        with self.cond:
+            self.fileRec, f = None, self.fileRec
+            self.cond.notify()
+        self.thread.join()
+        self.thread = None
+        self.flush(f)
+        f.close()
+
+    def save(self, rf_data, gen_ts, sent_ts, recv_ts, addr):
+        if self.fileRec is None:
+            return
+        length = len(rf_data)
+        with self.lock:
+            backlog = self.head - self.tail
+            if backlog + self.packHdr.size + length > self.size:
+                self.drop_cnt += 1
+                self.drop_bcnt += self.packHdr.size + length
+                return
+            self.packHdr.pack_into(self.hdr, 0, 0x7e, gen_ts, sent_ts,
+                    recv_ts, addr[1], length)
+            self.put(self.hdr)
+            self.put(rf_data)
+            backlog = self.head - self.tail
+            if backlog > self.max_backlog:
+                self.max_backlog = backlog
+            if backlog >= self.batch_size:
+                self.cond.notify()
+
+    def write(self, data):
+        """
+        Queue a block of raw bytes. Returns False if it was dropped.
+        """
+        if self.fileRec is None:
+            return False
+        length = len(data)
+        with self.lock:
+            if self.head - self.tail + length > self.size:
+                self.drop_cnt += 1
+                self.drop_bcnt += length
+                return False
+            self.put(data)
+            backlog = self.head - self.tail
+            if backlog > self.max_backlog:
+                self.max_backlog = backlog
+            self.cond.notify()
+        return True
+
+    def put(self, data):
+        pos = self.head % self.size
+        length = len(data)
+        end = pos + length
+        if end <= self.size:
+            self.ring[pos:end] = data
+        else:
+            split = self.size - pos
+            self.ring[pos:] = data[:split]
+            self.ring[:end-self.size] = data[split:]
+        self.head += length
+
+    def flush(self, f):
+        """
+        Write out what is buffered now. Only the writer thread, or stop()
+        after it has finished, calls this.
+        """
+        with self.lock:
+            tail = self.tail
+            head = self.head
+        if head == tail:
+            return False
+        pos = tail % self.size
+        end = pos + head - tail
+        if end <= self.size:
+            f.write(self.view[pos:end])
+        else:
+            f.write(self.view[pos:])
+            f.write(self.view[:end-self.size])
+        with self.lock:
+            self.tail = head
+            self.written_bcnt += head - tail
+        return True
+
+    def writer(self):
+        f = self.fileRec
+        last_sync = time.time()
+        while True:
+            with self.cond:
+                if self.fileRec is None:
+                    break
+                if self.head - self.tail < self.batch_size:
+                    self.cond.wait(self.interval)
+            if self.flush(f) and self.fsync:
+                now = time.time()
+                if self.fsync < 0 or now - last_sync >= self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+                    last_sync = now
+
+    def getStatistics(self):
+        return {'rec_backlog':self.head - self.tail,
+                'rec_max_backlog':self.max_backlog,
+                'rec_drop_cnt':self.drop_cnt,
+                'rec_drop_bcnt':self.drop_bcnt,
+                'rec_bcnt':self.written_bcnt}
@@ -0,0 +1,194 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Recorded data replay in Python
+----------------------------------------
+
+Author: Zheng GONG(matthewzhenggong@gmail.com)
+
+This file is part of FIWT.
+
+FIWT is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 3.0 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library.
+
+Packets of a .rec file are framed again as the nodes sent them and fed
+to XBeeNetwork.processRx, so they take the same dispatch path through
+XBeeMessageFuncs and ExpData as live ones. Consecutive records with the
+same sent_ts, recv_ts and port came in one datagram and go out as one.
+"""
+
+import argparse
+import mmap
+import os
+import threading
+import time
+
+import PayloadPackage
+import recparse
+
+def read_datagrams(filename):
+    """
+    Yield (recv_ts, port, datagram) for the node packets of a .rec file.
+    Recorded commands (port 0) are left out.
+    """
+    with open(filename, 'rb') as f:
+        if not os.path.getsize(filename):
+            return
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offsets, lengths = recparse.index_records(buf)
+            unpack_hdr = recparse.packHdr.unpack_from
+            hdr_size = recparse.packHdr.size
+            pack = PayloadPackage.pack
+            key = None
+            frames = []
+            for offset, length in zip(offsets.tolist(), lengths.tolist()):
+                header, gen_ts, sent_ts, recv_ts, port, length \
+                        = unpack_hdr(buf, offset-hdr_size)
+                if not port:
+                    continue
+                if (sent_ts, recv_ts, port) != key:
+                    if frames:
+                        yield key[1], key[2], PayloadPackage.packs(key[0],
+                                *frames)
+                    key = (sent_ts, recv_ts, port)
+                    frames = []
+                frames.append(pack(buf[offset:offset+length], gen_ts))
+            if frames:
+                yield key[1], key[2], PayloadPackage.packs(key[0], *frames)
+        finally:
+            buf.close()
+
+class Replay(object):
+    """
+    Feeds a .rec file to network.processRx at speed times the recorded
+    pace, or as fast as possible with speed 0. recv_ts is the recorded
+    one; its 31-bit wrap is followed.
+
+    addrs maps a recorded port to the node address its packets come
+    from, other ports come from (host, port). Each datagram is processed
+    holding lock, the one MainLoop holds while it reads the sockets.
+    """
+    def __init__(self, network, filename, speed=1.0, host='replay',
+            addrs=None, lock=None):
+        self.network = network
+        self.filename = filename
+        self.speed = speed
+        self.host = host
+        self.addrs = dict(addrs or {})
+        self.lock = lock or threading.Lock()
+        self.running = False
+        self.thread = None
+        self.datagram_cnt = 0
+        self.bcnt = 0
+        self.elapsed = 0.0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+
+    def isRunning(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def run(self):
+        self.running = True
+        processRx = self.network.processRx
+        host = self.host
+        addrs = self.addrs
+        lock = self.lock
+        scale = 1e-6/self.speed if self.speed > 0 else 0.0
+        t_start = time.time()
+        rec_t = 0
+        last_ts = None
+        for recv_ts, port, datagram in read_datagrams(self.filename):
+            if not self.running:
+                break
+            if scale:
+                if last_ts is not None:
+                    delta = (recv_ts - last_ts) & 0x7fffffff
+                    if delta < 0x40000000:
+                        rec_t += delta
+                last_ts = recv_ts
+                delay = t_start + rec_t*scale - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            addr = addrs.get(port)
+            if addr is None:
+                addr = addrs[port] = (host, port)
+            with lock:
+                processRx(datagram, addr, recv_ts)
+            self.datagram_cnt += 1
+            self.bcnt += len(datagram)
+        self.elapsed = time.time() - t_start
+        self.running = False
+
+    def getStatistics(self):
+        return {'replay_datagram_cnt':self.datagram_cnt,
+                'replay_bcnt':self.bcnt, 'replay_elapsed':self.elapsed}
+
+if __name__ == '__main__' :
+    import Queue
+    from MessageCenter import Worker
+    from AccessPointDaemon import start_command
+
+    parser = argparse.ArgumentParser(
+        prog='Replay',
+        description='replay rec data files through the receive pipeline')
+    parser.add_argument('filenames', metavar='file',
+            nargs='+', help='data filename')
+    parser.add_argument('-s', '--speed', type=float, default=1.0,
+            help='replay speed factor, 0 for as fast as possible')
+    parser.add_argument('-o', '--output',
+            help='record the replayed packets to this file')
+    args = parser.parse_args()
+
+    gui2msgcQueue = Queue.Queue()
+    msgc2guiQueue = Queue.Queue()
+    w = Worker(gui2msgcQueue, msgc2guiQueue)
+    # loopback sockets on any free port, the packets come from the files;
+    # each node gets a distinct address, its packets are told by the port
+    # of config.ini they were recorded with
+    ports = [port for host, port in
+            start_command(w.parser)['xbee_hosts'][1:]]
+    nodes = [('127.0.0.{}'.format(i+2), 0) for i in xrange(len(ports))]
+    gui2msgcQueue.put({'ID':'START',
+        'xbee_hosts':[('127.0.0.1', 0)] + nodes,
+        'matlab_ports':[9090, 8080]})
+    while not w.ready:
+        time.sleep(0.05)
+    if args.output:
+        w.startRecording(args.output)
+    for filename in args.filenames:
+        replay = Replay(w.xbee_network, filename, args.speed,
+                addrs=zip(ports, nodes), lock=w.rx_lock)
+        replay.run()
+        print '{}: {replay_datagram_cnt} datagrams in {replay_elapsed:.2f}s, ' \
+                '{:.0f} datagrams/s'.format(filename,
+                    replay.datagram_cnt/max(replay.elapsed, 1e-9),
+                    **replay.getStatistics())
+    if args.output:
+        w.stopRecording()
+    w.msg_thread_running = False
+    w.matlab_link.stop()
+    w.xbee_network.close()
+    while not msgc2guiQueue.empty():
+        output = msgc2guiQueue.get()
+        if output['ID'] == 'info':
+            print output['content']
@@ -0,0 +1,187 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Rate limited XBee send scheduler in Python
+----------------------------------------
+
+Author: Zheng GONG(matthewzhenggong@gmail.com)
+
+This file is part of FIWT.
+
+FIWT is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 3.0 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library.
+"""
+
+import socket
+import threading
+import time
+
+COALESCE_CODES = (0xA5, 0xA6)
+MAX_DATAGRAM = 1400
+
+class NodeQueue(object):
+    def __init__(self):
+        self.frames = []        # [code, pack, gen_ts]
+        self.latest = {}        # code -> entry of frames
+        self.next_time = 0.0
+
+class SendScheduler(object):
+    """
+    Sends frames to the nodes at most max_rate datagrams per second
+    each (0 for no limit). While a node is not due, a newer frame with
+    a code in COALESCE_CODES replaces the pending one with that code,
+    other frames queue up to max_queue per node, and everything pending
+    goes out together in as few datagrams as the packs framing allows.
+
+    send(frames, addr) is called with [(pack, gen_ts)] of one datagram,
+    under self.lock like every access to the queues and counters, so
+    submit() may come from any thread and the frames of a node go out
+    in order. A datagram that send fails with socket.error is counted
+    in error_cnt and lost; the rest still go out.
+    """
+    def __init__(self, send, max_rate=0, max_queue=64):
+        self.send = send
+        self.interval = 1.0/max_rate if max_rate > 0 else 0.0
+        self.max_queue = max_queue
+        self.nodes = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.superseded_cnt = 0
+        self.drop_cnt = 0
+        self.frame_cnt = 0
+        self.datagram_cnt = 0
+        self.error_cnt = 0
+        self.max_depth = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        if self.interval:
+            self.running = True
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.wakeup.notify()
+        if self.thread:
+            self.thread.join()
+
+    def submit(self, pack, gen_ts, addr):
+        """
+        Queue one frame for addr; it is sent right away if the node is
+        due.
+        """
+        code = ord(pack[0])
+        with self.lock:
+            node = self.nodes.get(addr)
+            if node is None:
+                node = self.nodes[addr] = NodeQueue()
+            entry = node.latest.get(code)
+            if entry is not None:
+                entry[1] = pack
+                entry[2] = gen_ts
+                self.superseded_cnt += 1
+            else:
+                if len(node.frames) >= self.max_queue:
+                    dropped = node.frames.pop(0)
+                    if node.latest.get(dropped[0]) is dropped:
+                        del node.latest[dropped[0]]
+                    self.drop_cnt += 1
+                entry = [code, pack, gen_ts]
+                node.frames.append(entry)
+                if code in COALESCE_CODES:
+                    node.latest[code] = entry
+            depth = len(node.frames)
+            if depth > self.max_depth:
+                self.max_depth = depth
+            now = time.time()
+            if now < node.next_time:
+                self.wakeup.notify()
+                return
+            self.flush(self.take(node, now), addr)
+
+    def take(self, node, now):
+        frames = [(pack, gen_ts) for code, pack, gen_ts in node.frames]
+        del node.frames[:]
+        node.latest.clear()
+        node.next_time = now + self.interval
+        return frames
+
+    def sendBatch(self, batch, addr):
+        try:
+            self.send(batch, addr)
+            self.datagram_cnt += 1
+        except socket.error:
+            self.error_cnt += 1
+
+    def flush(self, frames, addr):
+        batch = []
+        size = 0
+        for frame in frames:
+            if batch and size + len(frame[0]) > MAX_DATAGRAM:
+                self.sendBatch(batch, addr)
+                batch = []
+                size = 0
+            batch.append(frame)
+            size += len(frame[0])
+        if batch:
+            self.sendBatch(batch, addr)
+        self.frame_cnt += len(frames)
+
+    def run(self):
+        with self.lock:
+            while self.running:
+                now = time.time()
+                timeout = None
+                for addr, node in self.nodes.iteritems():
+                    if not node.frames:
+                        continue
+                    if node.next_time <= now:
+                        self.flush(self.take(node, now), addr)
+                    elif timeout is None or node.next_time - now < timeout:
+                        timeout = node.next_time - now
+                self.wakeup.wait(timeout)
+
+    def getStatistics(self):
+        with self.lock:
+            return {'tx_depth':sum(len(node.frames)
+                        for node in self.nodes.itervalues()),
+                    'tx_max_depth':self.max_depth,
+                    'tx_superseded_cnt':self.superseded_cnt,
+                    'tx_drop_cnt':self.drop_cnt,
+                    'tx_frame_cnt':self.frame_cnt,
+                    'tx_datagram_cnt':self.datagram_cnt,
+                    'tx_error_cnt':self.error_cnt}
+
+if __name__ == '__main__' :
+    sent = []
+    def send(frames, addr):
+        sent.append((time.time(), addr, [ord(pack[0]) for pack, ts in frames]))
+    scheduler = SendScheduler(send, max_rate=100)
+    scheduler.start()
+    t0 = time.time()
+    for i in xrange(1000):
+        scheduler.submit(chr(0xA5)+'acm', i, 'ACM')
+        scheduler.submit(chr(0xA6)+'cmp', i, 'CMP')
+        if i % 10 == 0:
+            scheduler.submit(chr(0x30)+'ping', i, 'ACM')
+        time.sleep(0.001)
+    time.sleep(0.05)
+    scheduler.stop()
+    elapsed = time.time() - t0
+    print '{:.2f}s, {} datagrams, {:.0f}/s per node'.format(elapsed,
+            len(sent), len(sent)/elapsed/2)
+    print scheduler.getStatistics()
@@ -0,0 +1,227 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Socket readiness polling in Python
+----------------------------------------
+
+Author: Zheng GONG(matthewzhenggong@gmail.com)
+
+This file is part of FIWT.
+
+FIWT is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 3.0 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library.
+
+On Linux the node sockets can carry the kernel receive time of every
+datagram (SO_TIMESTAMPNS) and the count of datagrams the kernel dropped
+for want of buffer (SO_RXQ_OVFL). Python 2 has no socket.recvmsg, so
+TimestampReceiver calls the libc one through ctypes.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import select
+import socket
+import struct
+import sys
+
+# WSAEWOULDBLOCK on Windows
+WOULDBLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, 10035)
+
+def drain(sock, size, max_batch=64):
+    """
+    Yield (data, address) from a non-blocking socket until it would
+    block, at most max_batch datagrams so one busy socket cannot starve
+    the others.
+    """
+    recvfrom = sock.recvfrom
+    for i in xrange(max_batch):
+        try:
+            packet = recvfrom(size)
+        except socket.error as e:
+            if e.args[0] in WOULDBLOCK:
+                return
+            raise
+        yield packet
+
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+SCM_TIMESTAMPNS = SO_TIMESTAMPNS
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40)
+MSG_DONTWAIT = 0x40
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+            ('msg_namelen', ctypes.c_uint32),
+            ('msg_iov', ctypes.POINTER(iovec)),
+            ('msg_iovlen', ctypes.c_size_t),
+            ('msg_control', ctypes.c_void_p),
+            ('msg_controllen', ctypes.c_size_t),
+            ('msg_flags', ctypes.c_int)]
+
+# struct cmsghdr {size_t len; int level; int type;} then struct timespec,
+# size_t being an unsigned long on Linux
+cmsghdr = struct.Struct('@Lii')
+timespec = struct.Struct('@ll')
+uint32 = struct.Struct('@I')
+first_timestamp = struct.Struct('@Liill')
+# family, port and IPv4 address of a struct sockaddr_in
+sockaddr_key = struct.Struct('=Q')
+
+_libc = None
+
+def _recvmsg():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        # no argtypes, converting them costs more than the call
+        _libc.recvmsg.restype = ctypes.c_ssize_t
+    return _libc.recvmsg
+
+class TimestampReceiver(object):
+    """
+    Reads IPv4 datagrams of at most size bytes from sock with recvmsg and
+    the kernel receive time, CLOCK_REALTIME in seconds (None if the
+    kernel gave none). drops is the number of datagrams the kernel has
+    dropped on sock, as of the latest one read. Use make_receiver, which
+    checks the platform.
+    """
+    def __init__(self, sock, size):
+        sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+            self.drop_counter = True
+        except socket.error:
+            self.drop_counter = False
+        self.drops = 0
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.recvmsg = _recvmsg()
+        self.buf = ctypes.create_string_buffer(size)
+        self.name = ctypes.create_string_buffer(128)
+        self.control = ctypes.create_string_buffer(64)
+        self.iov = iovec(ctypes.cast(self.buf, ctypes.c_void_p), size)
+        self.msg = msghdr()
+        self.msg.msg_name = ctypes.cast(self.name, ctypes.c_void_p)
+        self.msg.msg_iov = ctypes.pointer(self.iov)
+        self.msg.msg_iovlen = 1
+        self.msg.msg_control = ctypes.cast(self.control, ctypes.c_void_p)
+        self.msg_ref = ctypes.c_void_p(ctypes.addressof(self.msg))
+        self.addresses = {}
+
+    def address(self, key):
+        name = ctypes.string_at(self.name, 8)
+        port, = struct.unpack_from('!H', name, 2)
+        address = self.addresses[key] = (socket.inet_ntoa(name[4:8]), port)
+        return address
+
+    def stamp(self, controllen):
+        """
+        The receive time among the control messages, noting the drop
+        count on the way.
+        """
+        control = ctypes.string_at(self.control, controllen)
+        stamp = None
+        offset = 0
+        while offset + cmsghdr.size <= controllen:
+            length, level, kind = cmsghdr.unpack_from(control, offset)
+            if length < cmsghdr.size:
+                break
+            if level == socket.SOL_SOCKET:
+                if kind == SCM_TIMESTAMPNS:
+                    sec, nsec = timespec.unpack_from(control,
+                            offset + cmsghdr.size)
+                    stamp = sec + nsec*1e-9
+                elif kind == SO_RXQ_OVFL:
+                    self.drops, = uint32.unpack_from(control,
+                            offset + cmsghdr.size)
+            offset += (length + 7) & ~7
+        return stamp
+
+    def drain(self, max_batch=64):
+        """
+        Like drain(), yielding (data, address, kernel time).
+        """
+        msg = self.msg
+        fd = self.fd
+        recvmsg = self.recvmsg
+        msg_ref = self.msg_ref
+        buf = self.buf
+        string_at = ctypes.string_at
+        name_key = sockaddr_key.unpack_from
+        name = self.name
+        addresses = self.addresses
+        first = first_timestamp.unpack_from
+        control = self.control
+        for i in xrange(max_batch):
+            msg.msg_namelen = 128
+            msg.msg_controllen = 64
+            n = recvmsg(fd, msg_ref, MSG_DONTWAIT)
+            if n < 0:
+                err = ctypes.get_errno()
+                if err in WOULDBLOCK or err == errno.EINTR:
+                    return
+                raise socket.error(err, errno.errorcode.get(err, ''))
+            key, = name_key(name)
+            address = addresses.get(key)
+            if address is None:
+                address = self.address(key)
+            # the timestamp is the only control message until the kernel
+            # drops some
+            length, level, kind, sec, nsec = first(control)
+            if kind == SCM_TIMESTAMPNS and level == socket.SOL_SOCKET and \
+                    msg.msg_controllen == first_timestamp.size:
+                stamp = sec + nsec*1e-9
+            else:
+                stamp = self.stamp(msg.msg_controllen)
+            yield string_at(buf, n), address, stamp
+
+def make_receiver(sock, size):
+    """
+    A TimestampReceiver for an IPv4 UDP sock, or None where kernel
+    timestamps are not available.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        return TimestampReceiver(sock, size)
+    except (socket.error, OSError, AttributeError, TypeError):
+        return None
+
+class SocketPoller(object):
+    """
+    Waits for readable sockets with epoll where there is one (Linux),
+    select otherwise.
+    """
+    def __init__(self, socks):
+        self.socks = dict((sock.fileno(), sock) for sock in socks)
+        if hasattr(select, 'epoll'):
+            self.epoll = select.epoll()
+            for fd in self.socks:
+                self.epoll.register(fd, select.EPOLLIN)
+        else:
+            self.epoll = None
+
+    def poll(self, timeout):
+        if self.epoll:
+            socks = self.socks
+            return [socks[fd] for fd, event in self.epoll.poll(timeout)]
+        rlist, wlist, elist = select.select(self.socks.values(), [], [],
+                timeout)
+        return rlist
+
+    def close(self):
+        if self.epoll:
+            self.epoll.close()
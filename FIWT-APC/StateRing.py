@@ -0,0 +1,133 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Shared memory state ring in Python
+----------------------------------------
+
+Author: Zheng GONG(matthewzhenggong@gmail.com)
+
+This file is part of FIWT.
+
+FIWT is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 3.0 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library.
+
+Layout of the float64 buffer:
+
+    [count] [seq, value*width] * capacity
+
+count is the number of rows written so far; row seq lives in slot
+seq % capacity. The writer marks a slot -1 while it fills it, so a
+reader that copied a slot can tell whether it got row seq intact.
+"""
+
+import multiprocessing
+import numpy as np
+
+class StateRing(object):
+    """
+    One writer process appends state vectors, any number of reader
+    processes take the latest one or every row since their last read.
+    Pass the ring to the reader processes as a Process argument.
+    """
+    def __init__(self, width, capacity=4096, buf=None):
+        self.width = width
+        self.capacity = capacity
+        if buf is None:
+            buf = multiprocessing.RawArray('d', 1 + capacity*(width+1))
+        self.buf = buf
+        self.view = np.frombuffer(buf, dtype=np.float64)
+        self.rows = self.view[1:].reshape(capacity, width+1)
+        self.cursor = 0
+        self.lost = 0
+
+    def __getstate__(self):
+        return self.width, self.capacity, self.buf
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def count(self):
+        return int(self.view[0])
+
+    def write(self, values, index=None):
+        """
+        Append values, or values[index] if an index array is given.
+        """
+        seq = int(self.view[0])
+        row = self.rows[seq % self.capacity]
+        row[0] = -1.0
+        if index is None:
+            row[1:] = values
+        else:
+            np.take(values, index, out=row[1:])
+        row[0] = seq
+        self.view[0] = seq + 1
+
+    def latest(self):
+        """
+        (seq, copy of the newest row), or None if there is none yet or
+        it was being overwritten.
+        """
+        seq = int(self.view[0]) - 1
+        if seq < 0:
+            return None
+        slot = self.rows[seq % self.capacity]
+        row = slot.copy()
+        if row[0] != seq or slot[0] != seq:
+            return None
+        return seq, row[1:]
+
+    def read(self):
+        """
+        Rows written since the previous read(), as an (n, width) array.
+        Rows the writer has already overwritten are skipped and counted
+        in self.lost.
+        """
+        end = int(self.view[0])
+        # leave out the slot the writer may be filling now
+        start = max(self.cursor, end - self.capacity + 1)
+        self.lost += start - self.cursor
+        self.cursor = end
+        if start >= end:
+            return np.empty((0, self.width))
+        seqs = np.arange(start, end)
+        slots = seqs % self.capacity
+        rows = self.rows[slots]
+        ok = (rows[:, 0] == seqs) & (self.rows[slots, 0] == seqs)
+        self.lost += len(ok) - np.count_nonzero(ok)
+        return rows[ok, 1:]
+
+def reader(ring, n, result):
+    got = 0
+    while ring.count() < n:
+        got += len(ring.read())
+    got += len(ring.read())
+    result.put((got, ring.lost))
+
+if __name__ == '__main__' :
+    import time
+    multiprocessing.freeze_support()
+    ring = StateRing(41, 1024)
+    n = 200000
+    result = multiprocessing.Queue()
+    p = multiprocessing.Process(target=reader, args=(ring, n, result))
+    p.start()
+    values = np.arange(200.0)
+    index = np.arange(41)*3
+    t = time.time()
+    for i in xrange(n):
+        ring.write(values, index)
+    t = time.time() - t
+    got, lost = result.get()
+    p.join()
+    print '{:.0f} rows/s written, reader got {} lost {}'.format(n/t, got, lost)
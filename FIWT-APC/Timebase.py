@@ -0,0 +1,185 @@
+#!/bin/env python
+# -*- coding: utf-8 -*-
+"""
+AP timebase in Python
+----------------------------------------
+
+Author: Zheng GONG(matthewzhenggong@gmail.com)
+
+This file is part of FIWT.
+
+FIWT is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 3.0 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library.
+
+The AP stamps packets with µs since T0 in 31 bits, as the nodes do, so
+the stamps wrap every 35.8 minutes. Timebase gives those ticks from a
+monotonic high resolution clock; unwrap gives back the 64 bit µs an
+array of ticks stands for.
+
+A recording gets a CODE_TIMEBASE record with the wall clock time of T0
+and the full µs count when it starts and whenever T0 is reset, so
+read_timebase/to_absolute can turn its AP stamps into absolute times.
+"""
+
+import ctypes
+import ctypes.util
+import struct
+import sys
+import time
+import numpy as np
+
+MASK = 0x7fffffff
+WRAP = 0x80000000
+HALF = 0x40000000
+
+CODE_TIMEBASE = 0x03
+packCODE_TIMEBASE = struct.Struct('>BdQ')
+
+def _monotonic():
+    """
+    Seconds of the best monotonic clock there is: time.clock on Windows
+    (QueryPerformanceCounter), clock_gettime(CLOCK_MONOTONIC) on Linux,
+    time.time elsewhere.
+    """
+    if hasattr(time, 'perf_counter'):
+        return time.perf_counter
+    if sys.platform == 'win32':
+        return time.clock
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        clock_gettime = libc.clock_gettime
+    except (OSError, AttributeError, TypeError):
+        return time.time
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    ts = timespec()
+    ref = ctypes.byref(ts)
+    CLOCK_MONOTONIC = 1
+    if clock_gettime(CLOCK_MONOTONIC, ref):
+        return time.time
+    def monotonic():
+        clock_gettime(CLOCK_MONOTONIC, ref)
+        return ts.tv_sec + ts.tv_nsec*1e-9
+    return monotonic
+
+clock = _monotonic()
+
+def ts_delta(a, b):
+    """
+    a-b for 31-bit wrapping µs timestamps, negative if a is before b;
+    works on numpy arrays too.
+    """
+    d = (a - b) & MASK
+    return d - (d >= HALF)*WRAP
+
+class Timebase(object):
+    """
+    µs since T0. ticks() is the 31-bit stamp, now() the full count;
+    both are closures over T0 rebuilt by reset(), so a hot path can
+    keep the bound function.
+    """
+    def __init__(self, clock=clock):
+        self.clock = clock
+        self.reset()
+
+    def reset(self):
+        self.T0 = self.clock()
+        self.wall0 = time.time()
+        clock = self.clock
+        T0 = self.T0
+        def now():
+            return int((clock()-T0)*1e6)
+        def ticks():
+            return int((clock()-T0)*1e6) & MASK
+        self.now = now
+        self.ticks = ticks
+
+    def fromClock(self, t):
+        """
+        31-bit stamp of a clock() reading.
+        """
+        return int((t-self.T0)*1e6) & MASK
+
+    def wallOffset(self):
+        """
+        Seconds to add to a time.time() value, such as a kernel receive
+        time, to get seconds since T0.
+        """
+        return self.clock() - time.time() - self.T0
+
+    def record(self):
+        """
+        The CODE_TIMEBASE record for this T0, as of now.
+        """
+        return packCODE_TIMEBASE.pack(CODE_TIMEBASE, self.wall0, self.now())
+
+def unwrap(ts, ref=None):
+    """
+    31-bit stamps made continuous, as an int64 array; the first one is
+    taken as the one nearest to the 64-bit ref if there is one, else as
+    in epoch 0.
+    """
+    ts = np.asarray(ts, dtype=np.int64)
+    if not len(ts):
+        return ts
+    first = int(ts[0]) if ref is None else \
+            int(ref) + ts_delta(int(ts[0]), int(ref) & MASK)
+    return first + np.concatenate(([0], np.cumsum(ts_delta(ts[1:], ts[:-1]))))
+
+def read_timebase(filename):
+    """
+    (record number, wall clock time of T0, µs since T0) of the
+    CODE_TIMEBASE records in a .rec file.
+    """
+    import recparse
+    with recparse.map_file(filename) as buf:
+        offsets, lengths = recparse.index_records(buf)
+        data = np.frombuffer(buf, dtype=np.uint8)
+        sel = np.flatnonzero((lengths == packCODE_TIMEBASE.size)
+                & (data[offsets] == CODE_TIMEBASE))
+        rec = recparse.gather_records(data, offsets[sel], np.dtype([
+            ('Id', 'u1'), ('wall0', '>f8'), ('now', '>u8')]))
+    return sel, rec['wall0'].astype(np.float64), rec['now'].astype(np.int64)
+
+def to_absolute(ts, index, timebase):
+    """
+    Wall clock seconds of the AP stamps ts (recv_ts, or node stamps
+    mapped by ClockSync.to_local) of records index (record numbers,
+    ascending) of a .rec file, from its read_timebase(). Each record
+    goes by the latest CODE_TIMEBASE before it, the stamps being
+    unwrapped from there; NaN before the first.
+    """
+    sel, wall0, base = timebase
+    ts = np.asarray(ts, dtype=np.int64)
+    result = np.full(len(ts), np.nan)
+    which = np.searchsorted(sel, index, side='right') - 1
+    for i in np.unique(which[which >= 0]):
+        s = which == i
+        result[s] = wall0[i] + unwrap(ts[s], base[i])*1e-6
+    return result
+
+if __name__ == '__main__' :
+    timebase = Timebase()
+    ticks = timebase.ticks
+    n = 200000
+    t = time.time()
+    for i in xrange(n):
+        ticks()
+    print 'ticks() {:.3f}us'.format((time.time()-t)/n*1e6)
+    T0 = timebase.T0
+    t = time.time()
+    for i in xrange(n):
+        int((clock()-T0)*1e6) & MASK
+    print 'inline {:.3f}us'.format((time.time()-t)/n*1e6)
+    ts = (np.arange(0, 5*WRAP, 997, dtype=np.int64)[::1000])
+    assert (unwrap(ts & MASK) == ts).all()
@@ -18,20 +18,23 @@ class XBeeApplicationService(object):
     def getPacket(self):
         try:
             (data,address)=self.sock.recvfrom(1500)
-            Number1,Number2,PacketID,EncPad,CommandID,CommandOptions = \
-                    self.header.unpack_from(data,offset=0)
-            if CommandID == 0x00 :
-                return {'id':'rx', 'source_addr':address, 'rf_data':data[self.header.size:]}
-            elif CommandID == 0x82 :
-                return {'id':'remote_at_response', 'source_addr':address,
-                        'frame_id':ord(data[self.header.size]),
-                        'command':data[self.header.size+1:self.header.size+3],
-                        'status':ord(data[self.header.size+3]),
-                        'parameter':data[self.header.size+4:],
-                        }
+            return self.parsePacket(data, address)
         except socket.timeout :
             return None
 
+    def parsePacket(self, data, address):
+        Number1,Number2,PacketID,EncPad,CommandID,CommandOptions = \
+                self.header.unpack_from(data,offset=0)
+        if CommandID == 0x00 :
+            return {'id':'rx', 'source_addr':address, 'rf_data':data[self.header.size:]}
+        elif CommandID == 0x82 :
+            return {'id':'remote_at_response', 'source_addr':address,
+                    'frame_id':ord(data[self.header.size]),
+                    'command':data[self.header.size+1:self.header.size+3],
+                    'status':ord(data[self.header.size+3]),
+                    'parameter':data[self.header.size+4:],
+                    }
+
     def sendConfigCommand(self, host, command, parameter=None,
             frame_id=0, options='\x02') :
         data = self.header_RmtATCmd+chr(frame_id)+options+command
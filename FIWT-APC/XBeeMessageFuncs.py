@@ -24,6 +24,9 @@ License along with this library.
 
 import struct, math, time, traceback
 
+# Handlers take (network, rf_data, gen_ts, sent_ts, recv_ts, addr); rf_data
+# may be a str or a memoryview of the received datagram. The code byte is
+# known from the dispatch, the length is checked by each handler.
 process_funcs = {}
 
 CODE_AC_MODEL_SERVO_POS = 0x22
@@ -49,10 +52,15 @@ packCODE_NTP_RESPONSE = struct.Struct('>BH2I')
 
 cnt = [0,0,0]
 
+def bad_length(rf_data, pack):
+    raise struct.error('message 0x{:02x} of {} bytes, expected {}'.format(
+        ord(rf_data[0]), len(rf_data), pack.size))
+
 def process_CODE_NTP_REQUEST(self, rf_data, gen_ts, sent_ts, recv_ts, addr):
-    Id, NTP_Token = packCODE_NTP_REQUEST.unpack(rf_data)
-    if Id == CODE_NTP_REQUEST and sent_ts-gen_ts < 1000 \
-            and sent_ts-gen_ts > 0:
+    if len(rf_data) != packCODE_NTP_REQUEST.size:
+        bad_length(rf_data, packCODE_NTP_REQUEST)
+    Id, NTP_Token = packCODE_NTP_REQUEST.unpack_from(rf_data)
+    if sent_ts-gen_ts < 1000 and sent_ts-gen_ts > 0:
         #self.log.info('NTP request {} from {}'.format(
         #    sent_ts-recv_ts, addr.__repr__()))
         resp = packCODE_NTP_RESPONSE.pack(CODE_NTP_RESPONSE, NTP_Token,
@@ -62,51 +70,66 @@ def process_CODE_NTP_REQUEST(self, rf_data, gen_ts, sent_ts, recv_ts, addr):
 
 process_funcs[CODE_NTP_REQUEST] = process_CODE_NTP_REQUEST
 
+def process_CODE_NTP_RESPONSE(self, rf_data, gen_ts, sent_ts, recv_ts, addr):
+    if len(rf_data) != packCODE_NTP_RESPONSE.size:
+        bad_length(rf_data, packCODE_NTP_RESPONSE)
+    Id, NTP_Token, T1, T2 = packCODE_NTP_RESPONSE.unpack_from(rf_data)
+    self.clock_sync.addResponse(addr, NTP_Token, T1, T2, sent_ts, recv_ts)
+    self.parent.save(rf_data, gen_ts, sent_ts, recv_ts, addr)
+
+
+process_funcs[CODE_NTP_RESPONSE] = process_CODE_NTP_RESPONSE
+
 packCODE_GNDBOARD_STATS = struct.Struct('>B2h3H')
 
 
 def process_CODE_GNDBOARD_STATS(self, rf_data, gen_ts, sent_ts, recv_ts, addr):
-    Id, NTP_delay, NTP_offset, load_sen, load_rsen, load_msg = packCODE_GNDBOARD_STATS.unpack(
-        rf_data)
-    if Id == CODE_GNDBOARD_STATS:
-        info = 'GND states NTP{}/{} Load{}/{}/{}'.format(
-            NTP_delay, NTP_offset, load_sen, load_rsen, load_msg)
-        self.msgc2guiQueue.put_nowait({'ID':'GND_STA', 'info':info})
+    if len(rf_data) != packCODE_GNDBOARD_STATS.size:
+        bad_length(rf_data, packCODE_GNDBOARD_STATS)
+    Id, NTP_delay, NTP_offset, load_sen, load_rsen, load_msg = \
+            packCODE_GNDBOARD_STATS.unpack_from(rf_data)
+    info = 'GND states NTP{}/{} Load{}/{}/{}'.format(
+        NTP_delay, NTP_offset, load_sen, load_rsen, load_msg)
+    self.msgc2guiQueue.put_nowait({'ID':'GND_STA', 'info':info})
 
 
 process_funcs[CODE_GNDBOARD_STATS] = process_CODE_GNDBOARD_STATS
 
 packCODE_GNDBOARD_ADCM_READ = struct.Struct('>B4Hi2hI')
+# fields after the code byte: RigPos1-4, RigRollPos, RigPitchPos,
+# RigYawPos, ADC_TimeStamp
+unpackCODE_GNDBOARD_ADCM_READ = struct.Struct('>4Hi2hI').unpack_from
 
 
 def process_CODE_GNDBOARD_ADCM_READ(self, rf_data, gen_ts, sent_ts, recv_ts,
                                     addr):
-    Id, RigPos1, RigPos2, RigPos3, RigPos4, RigRollPos, RigPitchPos, RigYawPos, ADC_TimeStamp = packCODE_GNDBOARD_ADCM_READ.unpack(
-        rf_data)
-    if Id == CODE_GNDBOARD_ADCM_READ:
-        self.expData.updateRigPos(RigRollPos, RigPitchPos, RigYawPos, ADC_TimeStamp)
-        if cnt[2] > 25:
-            cnt[2] = 0
-            info = ('RIG {:.3f} rawdat {}/{}/{}').format( ADC_TimeStamp*1e-6,
-                    RigRollPos, RigPitchPos, RigYawPos)
-            self.msgc2guiQueue.put_nowait({'ID':'GND_DAT', 'info':info})
-        else:
-            cnt[2] += 1
-        self.parent.save(rf_data, gen_ts, sent_ts, recv_ts, addr)
+    if len(rf_data) != packCODE_GNDBOARD_ADCM_READ.size:
+        bad_length(rf_data, packCODE_GNDBOARD_ADCM_READ)
+    v = unpackCODE_GNDBOARD_ADCM_READ(rf_data, 1)
+    self.expData.updateRigPos(*v[4:])
+    if cnt[2] > 25:
+        cnt[2] = 0
+        info = ('RIG {:.3f} rawdat {}/{}/{}').format(v[7]*1e-6, *v[4:7])
+        self.msgc2guiQueue.put_nowait({'ID':'GND_DAT', 'info':info})
+    else:
+        cnt[2] += 1
+    self.parent.save(rf_data, gen_ts, sent_ts, recv_ts, addr)
 
 
 process_funcs[CODE_GNDBOARD_ADCM_READ] = process_CODE_GNDBOARD_ADCM_READ
 
 packCODE_GNDBOARD_MANI_READ = struct.Struct('>B2f')
+unpackCODE_GNDBOARD_MANI_READ = struct.Struct('>2f').unpack_from
 
 
 def process_CODE_GNDBOARD_MANI_READ(self, rf_data, gen_ts, sent_ts, recv_ts,
                                     addr):
-    Id, Vel, DP = packCODE_GNDBOARD_MANI_READ.unpack(rf_data)
-    if Id == CODE_GNDBOARD_MANI_READ:
-        self.expData.updateMani(Vel, DP)
-        self.parent.save(rf_data, gen_ts, sent_ts, recv_ts, addr)
-        self.log.info('Manimeter Vel{:.2f} DP{:.1f}'.format(Vel,DP))
+    if len(rf_data) != packCODE_GNDBOARD_MANI_READ.size:
+        bad_length(rf_data, packCODE_GNDBOARD_MANI_READ)
+    Vel, DP = unpackCODE_GNDBOARD_MANI_READ(rf_data, 1)
+    self.expData.updateMani(Vel, DP)
+    self.parent.save(rf_data, gen_ts, sent_ts, recv_ts, addr)
+    self.log.info('Manimeter Vel{:.2f} DP{:.1f}'.format(Vel,DP))
 
 
 process_funcs[CODE_GNDBOARD_MANI_READ] = process_CODE_GNDBOARD_MANI_READ
@@ -115,12 +138,13 @@ packCODE_AEROCOMP_STATS = struct.Struct('>B2h3B3H')
 
 
 def process_CODE_AEROCOMP_STATS(self, rf_data, gen_ts, sent_ts, recv_ts, addr):
-    Id, NTP_delay, NTP_offset, B1, B2, B3, load_sen, load_rsen, load_msg = packCODE_AEROCOMP_STATS.unpack(
-        rf_data)
-    if Id == CODE_AEROCOMP_STATS:
-        info = 'CMP states NTP{}/{} B{}/{}/{} Load{}/{}/{}'.format(
-            NTP_delay, NTP_offset, B1, B2, B3, load_sen, load_rsen, load_msg)
-        self.msgc2guiQueue.put_nowait({'ID':'CMP_STA', 'info':info})
+    if len(rf_data) != packCODE_AEROCOMP_STATS.size:
+        bad_length(rf_data, packCODE_AEROCOMP_STATS)
+    Id, NTP_delay, NTP_offset, B1, B2, B3, load_sen, load_rsen, load_msg = \
+            packCODE_AEROCOMP_STATS.unpack_from(rf_data)
+    info = 'CMP states NTP{}/{} B{}/{}/{} Load{}/{}/{}'.format(
+        NTP_delay, NTP_offset, B1, B2, B3, load_sen, load_rsen, load_msg)
+    self.msgc2guiQueue.put_nowait({'ID':'CMP_STA', 'info':info})
 
 
 process_funcs[CODE_AEROCOMP_STATS] = process_CODE_AEROCOMP_STATS
@@ -129,70 +153,72 @@ packCODE_AC_MODEL_STATS = struct.Struct('>B2h3B3H')
 
 
 def process_CODE_AC_MODEL_STATS(self, rf_data, gen_ts, sent_ts, recv_ts, addr):
-    Id, NTP_delay, NTP_offset, B1, B2, B3, load_sen, load_rsen, load_msg = packCODE_AC_MODEL_STATS.unpack(
-        rf_data)
-    if Id == CODE_AC_MODEL_STATS:
-        info = 'ACM states NTP{}/{} B{}/{}/{} Load{}/{}/{}'.format(
-            NTP_delay, NTP_offset, B1, B2, B3, load_sen, load_rsen, load_msg)
-        self.msgc2guiQueue.put_nowait({'ID':'ACM_STA', 'info':info})
+    if len(rf_data) != packCODE_AC_MODEL_STATS.size:
+        bad_length(rf_data, packCODE_AC_MODEL_STATS)
+    Id, NTP_delay, NTP_offset, B1, B2, B3, load_sen, load_rsen, load_msg = \
+            packCODE_AC_MODEL_STATS.unpack_from(rf_data)
+    info = 'ACM states NTP{}/{} B{}/{}/{} Load{}/{}/{}'.format(
+        NTP_delay, NTP_offset, B1, B2, B3, load_sen, load_rsen, load_msg)
+    self.msgc2guiQueue.put_nowait({'ID':'ACM_STA', 'info':info})
 
 
 process_funcs[CODE_AC_MODEL_STATS] = process_CODE_AC_MODEL_STATS
 
 packCODE_AC_MODEL_SERVO_POS = struct.Struct('>B6H3H6hI6h6hf')
+# fields after the code byte, in ExpData.updateACM order: ServoPos1-6,
+# EncPos1-3, Gx,Gy,Gz, Nx,Ny,Nz, ts_ADC, ServoCtrl1-6, ServoRef1-6, CmdTime
+unpackCODE_AC_MODEL_SERVO_POS = struct.Struct('>6H3H6hI6h6hf').unpack_from
 
 def process_CODE_AC_MODEL_SERVO_POS(self, rf_data, gen_ts, sent_ts, recv_ts, addr):
-    Id, ServoPos1,ServoPos2,ServoPos3,ServoPos4,ServoPos5,ServoPos6, \
-            EncPos1,EncPos2,EncPos3, Gx,Gy,Gz, Nx,Ny,Nz, ts_ADC, \
-            ServoCtrl1,ServoCtrl2,ServoCtrl3,ServoCtrl4,ServoCtrl5,ServoCtrl6, \
-            ServoRef1,ServoRef2,ServoRef3,ServoRef4,ServoRef5,ServoRef6, \
-            CmdTime = packCODE_AC_MODEL_SERVO_POS.unpack(rf_data)
-    if Id == CODE_AC_MODEL_SERVO_POS:
-        self.expData.updateACM(ServoPos1,ServoPos2,ServoPos3,ServoPos4,ServoPos5, \
-            ServoPos6, EncPos1,EncPos2,EncPos3, Gx,Gy,Gz, Nx,Ny,Nz, ts_ADC, \
-            ServoCtrl1,ServoCtrl2,ServoCtrl3,ServoCtrl4,ServoCtrl5,ServoCtrl6, \
-            ServoRef1,ServoRef2,ServoRef3,ServoRef4,ServoRef5,ServoRef6, \
-            CmdTime)
-        if cnt[0] > 25:
-            cnt[0] = 0
-            info = ('ACM {:.3f} rawdat S{:04d}/{:04d}/{:04d}/{:04d}/{:04d}/{:04d} '
-            'E{:04d}/{:04d}/{:04d} '
-            'GX{:05d} AY{:05d}').format(ts_ADC*1e-6,
-                ServoPos1,ServoPos2,ServoPos3,ServoPos4,ServoPos5,ServoPos6,
-                EncPos1,EncPos2,EncPos3, Gx,Ny)
-            self.msgc2guiQueue.put_nowait({'ID':'ACM_DAT', 'info':info})
-        else:
-            cnt[0] += 1
-        self.parent.save(rf_data, gen_ts, sent_ts, recv_ts, addr)
+    if len(rf_data) != packCODE_AC_MODEL_SERVO_POS.size:
+        bad_length(rf_data, packCODE_AC_MODEL_SERVO_POS)
+    v = unpackCODE_AC_MODEL_SERVO_POS(rf_data, 1)
+    self.expData.updateACM(*v)
+    if cnt[0] > 25:
+        cnt[0] = 0
+        info = ('ACM {:.3f} rawdat S{:04d}/{:04d}/{:04d}/{:04d}/{:04d}/{:04d} '
+        'E{:04d}/{:04d}/{:04d} '
+        'GX{:05d} AY{:05d}').format(v[15]*1e-6, *v[:10]+v[13:14])
+        self.msgc2guiQueue.put_nowait({'ID':'ACM_DAT', 'info':info})
+    else:
+        cnt[0] += 1
+    self.parent.save(rf_data, gen_ts, sent_ts, recv_ts, addr)
 
 
 process_funcs[CODE_AC_MODEL_SERVO_POS] = process_CODE_AC_MODEL_SERVO_POS
 
 packCODE_AEROCOMP_SERVO_POS = struct.Struct('>B4H4HI4h4hf')
+# fields after the code byte, in ExpData.updateCMP order: ServoPos1-4,
+# EncPos1-4, ts_ADC, ServoCtrl1-4, ServoRef1-4, CmdTime
+unpackCODE_AEROCOMP_SERVO_POS = struct.Struct('>4H4HI4h4hf').unpack_from
 
 def process_CODE_AEROCOMP_SERVO_POS(self, rf_data, gen_ts, sent_ts, recv_ts, addr):
-    Id, ServoPos1,ServoPos2,ServoPos3,ServoPos4, \
-            EncPos1,EncPos2,EncPos3,EncPos4,ts_ADC, \
-            ServoCtrl1,ServoCtrl2,ServoCtrl3,ServoCtrl4, \
-            ServoRef1,ServoRef2,ServoRef3,ServoRef4, \
-            CmdTime = packCODE_AEROCOMP_SERVO_POS.unpack(rf_data)
-    if Id == CODE_AEROCOMP_SERVO_POS:
-        self.expData.updateCMP(ServoPos1,ServoPos2,ServoPos3,ServoPos4, \
-            EncPos1,EncPos2,EncPos3,EncPos4,ts_ADC, \
-            ServoCtrl1,ServoCtrl2,ServoCtrl3,ServoCtrl4, \
-            ServoRef1,ServoRef2,ServoRef3,ServoRef4, \
-            CmdTime)
-        if cnt[1] > 25:
-            cnt[1] = 0
-            info = ('CMP {:.3f} rawdat S{:04d}/{:04d}/{:04d}/{:04d} '
-            'E{:04d}/{:04d}/{:04d}/{:04d} ').format(ts_ADC*1e-6,
-                ServoPos1,ServoPos2,ServoPos3,ServoPos4,
-                EncPos1,EncPos2,EncPos3,EncPos4,
-                )
-            self.msgc2guiQueue.put_nowait({'ID':'CMP_DAT', 'info':info})
-        else:
-            cnt[1] += 1
-        self.parent.save(rf_data, gen_ts, sent_ts, recv_ts, addr)
+    if len(rf_data) != packCODE_AEROCOMP_SERVO_POS.size:
+        bad_length(rf_data, packCODE_AEROCOMP_SERVO_POS)
+    v = unpackCODE_AEROCOMP_SERVO_POS(rf_data, 1)
+    self.expData.updateCMP(*v)
+    if cnt[1] > 25:
+        cnt[1] = 0
+        info = ('CMP {:.3f} rawdat S{:04d}/{:04d}/{:04d}/{:04d} '
+        'E{:04d}/{:04d}/{:04d}/{:04d} ').format(v[8]*1e-6, *v[:8])
+        self.msgc2guiQueue.put_nowait({'ID':'CMP_DAT', 'info':info})
+    else:
+        cnt[1] += 1
+    self.parent.save(rf_data, gen_ts, sent_ts, recv_ts, addr)
 
 process_funcs[CODE_AEROCOMP_SERVO_POS] = process_CODE_AEROCOMP_SERVO_POS
 
+def process_unknown(self, rf_data, gen_ts, sent_ts, recv_ts, addr):
+    self.log.error('Unknown message code 0x{:02x} from {}'.format(
+        ord(rf_data[0]), addr))
+
+def build_handlers():
+    """
+    Flatten process_funcs into a list indexed by message code.
+    """
+    table = [process_unknown]*256
+    for code, func in process_funcs.iteritems():
+        table[code] = func
+    return table
+
+handlers = build_handlers()
@@ -21,10 +21,19 @@ Lesser General Public License for more details.
 You should have received a copy of the GNU Lesser General Public
 License along with this library.
 """
-import socket, time, traceback
+import socket, traceback
 import XBeeIPServices
 import PayloadPackage
 import XBeeMessageFuncs
+from SocketPoller import drain, make_receiver
+from SendScheduler import SendScheduler
+from LatencyStats import LatencyTracker
+from LossStats import LossTracker
+from ClockSync import ClockSync
+from Timebase import Timebase, clock, MASK
+from PayloadPackage import MSG_DILIMITER, MSG_ESC, unescape
+
+ts_unpack_from = PayloadPackage.TS.unpack_from
 
 at_status = {
     0: 'OK',
@@ -35,6 +44,8 @@ at_status = {
 }
 
 
+SOCKET_NAMES = ('ap', 'gnd', 'acm', 'cmp')
+
 class XBeeNetwork(object):
     def __init__(self, parent, hosts):
         self.parent = parent
@@ -44,10 +55,12 @@ class XBeeNetwork(object):
         self.arrv_cnt = -1
         self.local = hosts[0]
         host = self.local[0]
+        parser = parent.parser
         self.socklist = []
-        for i in hosts :
+        for name, i in zip(SOCKET_NAMES, hosts) :
             try:
                 sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.setBuffers(sock, name)
                 sock.bind((host,i[1]))
                 sock.setblocking(0)
                 self.socklist.append(sock)
@@ -56,59 +69,223 @@ class XBeeNetwork(object):
         self.socklist_set = set(self.socklist)
         self.tx_socket = self.socklist[0]
 
+        self.receivers = {}
+        if not parser.has_option('net', 'kernel_timestamps') or \
+                parser.getboolean('net', 'kernel_timestamps'):
+            for sock in self.socklist:
+                receiver = make_receiver(sock, 1400)
+                if receiver:
+                    self.receivers[sock] = receiver
+        self.log.info('Kernel receive timestamps on {} of {} sockets.'.format(
+            len(self.receivers), len(self.socklist)))
+
         self.service = XBeeIPServices.XBeeApplicationService(host)
         self.socklist.append(self.service.sock)
 
+        options = {}
+        if parser.has_option('net', 'max_rate'):
+            options['max_rate'] = parser.getfloat('net', 'max_rate')
+        if parser.has_option('net', 'max_queue'):
+            options['max_queue'] = parser.getint('net', 'max_queue')
+        self.scheduler = SendScheduler(self.sendFrames, **options)
+        self.scheduler.start()
+
+        self.latency = LatencyTracker(dict((addr, name)
+            for name, addr in parent.node_addr.iteritems()))
+        self.latency_log = 10.0
+        if parser.has_option('net', 'latency_log'):
+            self.latency_log = parser.getfloat('net', 'latency_log')
+        self.last_latency_log = 0
+
+        ntp_interval = 0
+        if parser.has_option('net', 'ntp_interval'):
+            ntp_interval = parser.getfloat('net', 'ntp_interval')
+        self.clock_sync = ClockSync(self, ntp_interval)
+
+        self.loss = LossTracker(self.latency.names)
+        self.kernel_drop_base = 0
+
+    def setBuffers(self, sock, name):
+        """
+        SO_RCVBUF/SO_SNDBUF from [net] rcvbuf_<name>/sndbuf_<name>, else
+        [net] rcvbuf/sndbuf, in bytes; the kernel may round or double
+        them, so the sizes it took are logged.
+        """
+        parser = self.parent.parser
+        for option, opt in (('rcvbuf', socket.SO_RCVBUF),
+                ('sndbuf', socket.SO_SNDBUF)):
+            for key in (option + '_' + name, option):
+                if parser.has_option('net', key):
+                    sock.setsockopt(socket.SOL_SOCKET, opt,
+                            parser.getint('net', key))
+                    break
+        self.log.info('{} socket rcvbuf {} sndbuf {} bytes.'.format(
+            name.upper(), sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+            sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)))
+
+    def close(self):
+        self.scheduler.stop()
+
+    def getKernelDrops(self):
+        return sum(receiver.drops for receiver in self.receivers.itervalues())
+
+    def clearStatistics(self):
+        self.arrv_cnt = -1
+        self.latency.reset()
+        self.loss.reset()
+        self.kernel_drop_base = self.getKernelDrops()
+
+    def getLossStatistics(self):
+        """
+        Datagrams the kernel dropped for want of buffer (counted only on
+        sockets read by a TimestampReceiver), and the gaps, missing,
+        duplicate and reordered packets of all streams of self.loss.
+        """
+        stat = self.loss.totals()
+        stat['rx_kernel_drop_cnt'] = \
+                self.getKernelDrops() - self.kernel_drop_base
+        return stat
+
     def getReadList(self):
         return self.socklist
 
     def send(self, pack, addr):
-        ts = int((time.clock()-self.parent.T0)*1e6)&0x7fffffff
+        ts = self.parent.timebase.ticks()
         data = PayloadPackage.pack(pack,ts)
 
         data = PayloadPackage.packs(ts,data)
         self.tx_socket.sendto(data, addr)
 
-    def read(self, rlist, recv_ts):
+    def schedule(self, pack, addr):
+        """
+        Send through the scheduler, which may coalesce or delay pack;
+        returns the generation timestamp given to it.
+        """
+        ts = self.parent.timebase.ticks()
+        self.scheduler.submit(pack, ts, addr)
+        return ts
+
+    def sendFrames(self, frames, addr):
+        ts = self.parent.timebase.ticks()
+        data = PayloadPackage.packs(ts, *[PayloadPackage.pack(pack, gen_ts)
+            for pack, gen_ts in frames])
+        self.tx_socket.sendto(data, addr)
+
+    def read(self, rlist):
+        """
+        Drain every readable socket. Datagrams of sockets with a kernel
+        receive time are stamped with it, moved from the wall clock to
+        the T0 timebase by one clock reading per call; the others are
+        stamped when taken from the socket.
+        """
+        timebase = self.parent.timebase
+        ticks = timebase.ticks
+        max_batch = self.parent.max_batch
         rlist_ipv4 = self.socklist_set.intersection(rlist)
+        if rlist_ipv4 and self.receivers:
+            wall2clock = timebase.wallOffset()
         for rx in rlist_ipv4:
-            (rf_data,address)=rx.recvfrom(1400)
-            data = {'id':'rx', 'source_addr':address, 'rf_data':rf_data}
-            self.process(data, recv_ts)
+            receiver = self.receivers.get(rx)
+            if receiver is None:
+                for data_group,address in drain(rx, 1400, max_batch):
+                    self.processRx(data_group, address, ticks())
+                continue
+            for data_group,address,stamp in receiver.drain(max_batch):
+                if stamp is None:
+                    recv_ts = ticks()
+                else:
+                    recv_ts = int((stamp+wall2clock)*1e6)&MASK
+                self.processRx(data_group, address, recv_ts)
 
         if self.service.sock in rlist:
-            data = self.service.getPacket()
-            if data:
-                self.process(data, recv_ts)
+            for packet in drain(self.service.sock, 1500, max_batch):
+                recv_ts = ticks()
+                data = self.service.parsePacket(*packet)
+                if data:
+                    self.process(data, recv_ts)
 
     def updateStatistics(self, bcnt):
             if self.arrv_cnt < 0:
                 self.arrv_cnt = 0
                 self.arrv_bcnt = 0
-                self.ariv_T0 = time.clock()
+                self.ariv_T0 = clock()
                 self.last_elapsed = 0
             else:
                 self.arrv_cnt += 1
                 self.arrv_bcnt += bcnt
-                elapsed = time.clock() - self.ariv_T0
+                elapsed = clock() - self.ariv_T0
                 if elapsed - self.last_elapsed > 1 :
                     self.last_elapsed = elapsed
-                    self.parent.msgc2guiQueue.put_nowait({'ID':'Statistics',
+                    stat = {'ID':'Statistics',
                             'arrv_cnt':self.arrv_cnt, 'arrv_bcnt':self.arrv_bcnt,
-                            'elapsed':elapsed})
+                            'elapsed':elapsed}
+                    if self.parent.recorder.isRecording():
+                        stat.update(self.parent.recorder.getStatistics())
+                    stat.update(self.scheduler.getStatistics())
+                    stat.update(self.getLossStatistics())
+                    self.parent.msgc2guiQueue.put_nowait(stat)
+                    self.parent.msgc2guiQueue.put_nowait({'ID':'Latency',
+                        'info':self.latency.brief()})
+                    self.parent.msgc2guiQueue.put_nowait({'ID':'Loss',
+                        'info':self.loss.brief()})
+                    if self.latency_log > 0 and elapsed - \
+                            self.last_latency_log >= self.latency_log:
+                        self.last_latency_log = elapsed
+                        self.log.info(self.latency.report())
+                        self.log.info(self.clock_sync.report())
+                        self.log.info(self.loss.report())
+                        self.saveLoss()
+
+    def saveLoss(self):
+        """
+        Put the loss counts of every stream into the recording.
+        """
+        if not self.parent.recorder.isRecording():
+            return
+        ts = self.parent.timebase.ticks()
+        for record in self.loss.records():
+            self.parent.save(record, ts, ts, ts, ('', 0))
+
+    def processRx(self, data_group, addr, recv_ts) :
+        """
+        Dispatch the packets of one datagram straight from its frames;
+        see PayloadPackage.unpack for the framing.
+        """
+        try:
+            self.updateStatistics(len(data_group))
+            frames = data_group.split(MSG_DILIMITER)
+            del frames[0]
+            if not frames:
+                return
+            if MSG_ESC in data_group:
+                frames = [unescape(i) if MSG_ESC in i else i for i in frames]
+            last = frames[-1]
+            sent_ts = ts_unpack_from(last, len(last)-4)[0]
+            frames[-1] = last[:-4]
+            handlers = XBeeMessageFuncs.handlers
+            rows, proc = self.latency.rows(addr)
+            counters = self.loss.counters
+            for frame in frames :
+                code = ord(frame[4])
+                gen_ts = ts_unpack_from(frame)[0]
+                handlers[code](self, frame[4:], gen_ts, sent_ts, recv_ts, addr)
+                rows.append((code, gen_ts, sent_ts, recv_ts))
+                counter = counters.get((addr, code))
+                if counter is None:
+                    counter = self.loss.counter(addr, code)
+                if counter.offset is None:
+                    counter.add(gen_ts)
+                else:
+                    counter.add(ts_unpack_from(frame, 4+counter.offset)[0]
+                            & MASK)
+            proc.append((self.parent.timebase.ticks() - recv_ts) & MASK)
+        except:
+            self.log.error(repr(data_group))
+            self.log.error(traceback.format_exc())
 
     def process(self, data, recv_ts) :
         if data['id'] == 'rx':
-            try:
-              addr = data['source_addr']
-              data_group = data['rf_data']
-              self.updateStatistics(len(data_group))
-              rf_data_group,sent_ts = PayloadPackage.unpack(data_group)
-              for gen_ts,rf_data in rf_data_group :
-                XBeeMessageFuncs.process_funcs[ord(rf_data[0])](self, rf_data, gen_ts, sent_ts, recv_ts, addr)
-            except:
-                self.log.error(repr(data))
-                self.log.error(traceback.format_exc())
+            self.processRx(data['rf_data'], data['source_addr'], recv_ts)
         elif data['id'] == 'remote_at_response':
             try:
                 s = data['status']
@@ -124,4 +301,72 @@ class XBeeNetwork(object):
         else:
             self.log.info(repr(data))
 
+if __name__ == '__main__' :
+    import logging, random, timeit, Queue
+    logging.basicConfig()
+    from ExpData import ExpData
+    from Recorder import Recorder
+
+    class BenchParent(object):
+        """
+        Just enough of MessageCenter.Worker for XBeeNetwork.processRx.
+        """
+        def __init__(self):
+            self.msgc2guiQueue = Queue.Queue()
+            self.expData = ExpData(self, None)
+            self.log = logging.getLogger(__name__)
+            self.recorder = Recorder()
+            self.timebase = Timebase()
+
+        def save(self, rf_data, gen_ts, sent_ts, recv_ts, addr):
+            pass
+
+    parent = BenchParent()
+    net = XBeeNetwork.__new__(XBeeNetwork)
+    net.parent = parent
+    net.expData = parent.expData
+    net.msgc2guiQueue = parent.msgc2guiQueue
+    net.log = parent.log
+    net.arrv_cnt = -1
+    net.scheduler = SendScheduler(None)
+    net.latency = LatencyTracker()
+    net.latency_log = 0
+    net.loss = LossTracker()
+    net.receivers = {}
+    net.kernel_drop_base = 0
+
+    random.seed(0)
+    def payload(code, pack, fmt, ts):
+        # ts_ADC is the only 'I' field
+        values = [code]
+        for c in fmt:
+            values.append(ts if c == 'I' else random.random() if c == 'f'
+                    else random.randint(0, 0x7fff))
+        return pack.pack(*values)
+    traffic = [
+        (0x22, XBeeMessageFuncs.packCODE_AC_MODEL_SERVO_POS,
+            'HHHHHH' 'HHH' 'hhhhhh' 'I' 'hhhhhh' 'hhhhhh' 'f'),
+        (0x33, XBeeMessageFuncs.packCODE_AEROCOMP_SERVO_POS,
+            'HHHH' 'HHHH' 'I' 'hhhh' 'hhhh' 'f'),
+        (0x44, XBeeMessageFuncs.packCODE_GNDBOARD_ADCM_READ,
+            'HHHH' 'i' 'hh' 'I'),
+        ]
+    addr = ('192.168.191.4', 0x2616)
+    datagrams = []
+    for i in xrange(300):
+        code, pack, fmt = traffic[i%3]
+        datagrams.append(PayloadPackage.packs(i*3+2,
+            PayloadPackage.pack(payload(code, pack, fmt, i*2000+1000), i*3),
+            PayloadPackage.pack(payload(code, pack, fmt, i*2000+2000), i*3+1)))
 
+    # one core; the second round leaves out the ExpData updates to show
+    # the receive and dispatch overhead alone
+    n = 20
+    for label in ('with ExpData', 'dispatch only'):
+        if label == 'dispatch only':
+            for name in ('updateACM', 'updateCMP', 'updateRigPos'):
+                setattr(net.expData, name, lambda *args: None)
+        t = min(timeit.repeat(lambda: [net.processRx(d, addr, 0)
+            for d in datagrams], number=n, repeat=7))
+        print '{:<14s}processRx {:10.0f} packets/s'.format(label,
+                n*2*len(datagrams)/t)
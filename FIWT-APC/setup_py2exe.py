@@ -44,7 +44,7 @@ shutil.rmtree("build", ignore_errors=True)
 shutil.rmtree("dist", ignore_errors=True)
 
 # my setup.py is based on one generated with gui2exe, so data_files is done a bit differently
-includes = ['numpy']
+includes = ['numpy', 'scipy.signal']
 excludes = ['_gtkagg', '_tkagg', 'bsddb', 'curses', 'pywin.debugger',
             'pywin.debugger.dbgcon', 'pywin.dialogs', 'tcl',
             'Tkconstants', 'Tkinter', 'pydoc', 'doctest', 'test', 'sqlite3'